@@ -0,0 +1,686 @@
+import argparse as argparse
+import boto3 as boto3
+import contextlib as contextlib
+import datetime as datetime
+import emoji as emoji
+import io as io
+import json as json
+import logging as logging
+import openpyxl as openpyxl
+import pandas as pd
+import platform as platform
+import random as random
+import subprocess as subprocess
+import sys as sys
+import os as os
+import tempfile as tempfile
+import threading as threading
+import time as time
+import tracemalloc as tracemalloc
+import urllib.parse as urllib_parse
+from botocore.awsrequest import AWSResponse
+from shutil import get_terminal_size as get_terminal_size
+
+import generateAccountAuthorizationDetailReport as report
+
+logger = logging.getLogger(__name__)
+
+# The number of roles of each benchmark size.
+BENCHMARK_SIZES = {
+    "1k": 1000,
+    "10k": 10000,
+    "100k": 100000,
+}
+
+# The services and actions the synthetic policy statements are drawn from.
+SYNTHETIC_SERVICES = ("s3", "ec2", "iam", "lambda", "dynamodb", "sqs", "sns", "kms", "logs", "sts")
+SYNTHETIC_ACTIONS = ("Get*", "List*", "Describe*", "Put*", "Delete*", "Create*", "Update*", "*")
+
+# The date every synthetic entity is created at, so the payloads are reproducible.
+SYNTHETIC_DATE = datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc)
+
+# A stage is only reported as a regression past this number of seconds, below it is noise.
+REGRESSION_NOISE_SECONDS = 0.05
+
+# The modules a --json-only run must not import at startup.
+HEAVY_MODULES = ("pandas", "openpyxl", "pyarrow", "requests")
+
+# Import the report in a fresh interpreter and list the heavy modules it loaded.
+STARTUP_SCRIPT = (
+    "import sys, generateAccountAuthorizationDetailReport; "
+    "print(' '.join(m for m in {} if m in sys.modules))".format(HEAVY_MODULES)
+)
+
+
+class SyntheticAccount:
+    """
+    A synthetic account whose authorization details are generated on demand.
+
+    The account is sized by its number of roles: there is a user per 10 roles, a
+    group per 100 roles, a customer managed policy per 20 roles and up to 1,000 AWS
+    managed policies. Every entity is generated from the seed and its index, so the
+    same page is always the same and the account is never held in memory whole.
+    """
+
+    def __init__(self, roles, seed=0):
+        """
+        Size the synthetic account.
+
+        :param roles: The number of roles.
+        :param seed: The seed of the generated entities.
+        """
+        self.seed = seed
+        self.counts = {
+            "User": max(1, roles // 10),
+            "Group": max(1, roles // 100),
+            "Role": roles,
+            "LocalManagedPolicy": max(1, roles // 20),
+            "AWSManagedPolicy": min(1000, max(10, roles // 10)),
+        }
+
+    def _random(self, filter_name, index):
+        return random.Random(f"{self.seed}:{filter_name}:{index}")
+
+    def _document(self, rng, statements, encode=True):
+        # Policy documents travel URL encoded, botocore decodes them after the call.
+        document = {
+            "Version": "2012-10-17",
+            "Statement": [
+                {
+                    "Effect": rng.choice(("Allow", "Allow", "Allow", "Deny")),
+                    "Action": [
+                        f"{rng.choice(SYNTHETIC_SERVICES)}:{rng.choice(SYNTHETIC_ACTIONS)}"
+                        for _ in range(rng.randint(1, 6))
+                    ],
+                    "Resource": rng.choice(("*", [f"arn:aws:s3:::bucket-{rng.randint(0, 999)}/*"])),
+                }
+                for _ in range(statements)
+            ],
+        }
+        return urllib_parse.quote(json.dumps(document)) if encode else document
+
+    def _tags(self, rng):
+        return [
+            {"Key": f"tag-{number}", "Value": f"value-{rng.randint(0, 99)}"}
+            for number in range(rng.randint(0, 5))
+        ]
+
+    def _attached(self, rng, count):
+        attached = []
+        for _ in range(count):
+            if rng.random() < 0.5:
+                number = rng.randrange(self.counts["AWSManagedPolicy"])
+                attached.append({
+                    "PolicyName": f"SyntheticAWSPolicy{number}",
+                    "PolicyArn": f"arn:aws:iam::aws:policy/SyntheticAWSPolicy{number}",
+                })
+            else:
+                number = rng.randrange(self.counts["LocalManagedPolicy"])
+                attached.append({
+                    "PolicyName": f"policy-{number:06d}",
+                    "PolicyArn": f"arn:aws:iam::123456789012:policy/policy-{number:06d}",
+                })
+        return attached
+
+    def _inline(self, rng, count, encode=True):
+        return [
+            {
+                "PolicyName": f"inline-{number}",
+                "PolicyDocument": self._document(rng, rng.randint(1, 4), encode=encode),
+            }
+            for number in range(count)
+        ]
+
+    def _policy(self, filter_name, index, encode=True):
+        rng = self._random(filter_name, index)
+        if filter_name == "AWSManagedPolicy":
+            name = f"SyntheticAWSPolicy{index}"
+            arn = f"arn:aws:iam::aws:policy/{name}"
+            versions = rng.randint(1, 8)
+            attachment_count = rng.choice((0, 0, 1, 2, 5))
+        else:
+            name = f"policy-{index:06d}"
+            arn = f"arn:aws:iam::123456789012:policy/{name}"
+            versions = rng.randint(1, 5)
+            attachment_count = rng.randint(0, 10)
+        return {
+            "PolicyName": name,
+            "PolicyId": f"ANPA{filter_name[:1]}{index:015d}",
+            "Arn": arn,
+            "Path": "/",
+            "DefaultVersionId": f"v{versions}",
+            "AttachmentCount": attachment_count,
+            "PermissionsBoundaryUsageCount": 0,
+            "IsAttachable": True,
+            "CreateDate": SYNTHETIC_DATE,
+            "UpdateDate": SYNTHETIC_DATE,
+            "PolicyVersionList": [
+                {
+                    "Document": self._document(rng, rng.randint(1, 6), encode=encode),
+                    "VersionId": f"v{version}",
+                    "IsDefaultVersion": version == versions,
+                    "CreateDate": SYNTHETIC_DATE,
+                }
+                for version in range(versions, 0, -1)
+            ],
+        }
+
+    def entity(self, filter_name, index, encode=True):
+        """
+        Generate an entity.
+
+        :param filter_name: One of COLLECTION_FILTERS.
+        :param index: The index of the entity.
+        :param encode: URL encode the policy documents, as they are on the wire.
+        :return: A tuple of the report list name and the entity.
+        """
+        rng = self._random(filter_name, index)
+        if filter_name == "User":
+            return "UserDetailList", {
+                "Path": "/",
+                "UserName": f"user-{index:06d}",
+                "UserId": f"AIDA{index:016d}",
+                "Arn": f"arn:aws:iam::123456789012:user/user-{index:06d}",
+                "CreateDate": SYNTHETIC_DATE,
+                "UserPolicyList": self._inline(rng, rng.randint(0, 2), encode=encode),
+                "GroupList": [
+                    f"group-{rng.randrange(self.counts['Group']):06d}"
+                    for _ in range(rng.randint(1, 3))
+                ],
+                "AttachedManagedPolicies": self._attached(rng, rng.randint(0, 3)),
+                "Tags": self._tags(rng),
+            }
+        if filter_name == "Group":
+            return "GroupDetailList", {
+                "Path": "/",
+                "GroupName": f"group-{index:06d}",
+                "GroupId": f"AGPA{index:016d}",
+                "Arn": f"arn:aws:iam::123456789012:group/group-{index:06d}",
+                "CreateDate": SYNTHETIC_DATE,
+                "GroupPolicyList": self._inline(rng, rng.randint(0, 2), encode=encode),
+                "AttachedManagedPolicies": self._attached(rng, rng.randint(0, 4)),
+            }
+        if filter_name == "Role":
+            role = {
+                "Path": "/",
+                "RoleName": f"role-{index:06d}",
+                "RoleId": f"AROA{index:016d}",
+                "Arn": f"arn:aws:iam::123456789012:role/role-{index:06d}",
+                "CreateDate": SYNTHETIC_DATE,
+            }
+            assume_role_policy_document = {
+                "Version": "2012-10-17",
+                "Statement": [{
+                    "Effect": "Allow",
+                    "Principal": {"Service": f"{rng.choice(SYNTHETIC_SERVICES)}.amazonaws.com"},
+                    "Action": "sts:AssumeRole",
+                }],
+            }
+            return "RoleDetailList", dict(
+                role,
+                AssumeRolePolicyDocument=urllib_parse.quote(json.dumps(assume_role_policy_document))
+                if encode else assume_role_policy_document,
+                InstanceProfileList=[
+                    {
+                        "Path": "/",
+                        "InstanceProfileName": f"profile-{index:06d}",
+                        "InstanceProfileId": f"AIPA{index:016d}",
+                        "Arn": f"arn:aws:iam::123456789012:instance-profile/profile-{index:06d}",
+                        "CreateDate": SYNTHETIC_DATE,
+                        "Roles": [role],
+                    }
+                ] if rng.random() < 0.2 else [],
+                RolePolicyList=self._inline(rng, rng.randint(0, 3), encode=encode),
+                AttachedManagedPolicies=self._attached(rng, rng.randint(0, 5)),
+                Tags=self._tags(rng),
+                RoleLastUsed={"LastUsedDate": SYNTHETIC_DATE, "Region": "us-east-1"},
+            )
+        return "Policies", self._policy(filter_name, index, encode=encode)
+
+    def entities(self, filter_name, encode=True):
+        """
+        Generate every entity of a filter.
+
+        :param filter_name: One of COLLECTION_FILTERS.
+        :param encode: URL encode the policy documents, as they are on the wire.
+        :return: A generator of (report list name, entity) tuples.
+        """
+        for index in range(self.counts[filter_name]):
+            yield self.entity(filter_name, index, encode=encode)
+
+    def authorization_details_page(self, filters, marker, max_items):
+        """
+        Generate a page of get_account_authorization_details.
+
+        :param filters: The requested filters, every filter when empty.
+        :param marker: The marker of the page, the offset of its first entity.
+        :param max_items: The maximum number of entities of the page.
+        :return: The parsed response.
+        """
+        segments = [
+            (filter_name, self.counts[filter_name])
+            for filter_name in report.COLLECTION_FILTERS
+            if not filters or filter_name in filters
+        ]
+        total = sum(count for _, count in segments)
+        start = int(marker or 0)
+        end = min(total, start + max_items)
+        page = {key: [] for key in report.ENTITY_KEYS}
+        offset = 0
+        for filter_name, count in segments:
+            for index in range(max(start, offset), min(end, offset + count)):
+                list_name, entity = self.entity(filter_name, index - offset)
+                page[list_name].append(entity)
+            offset += count
+        page["IsTruncated"] = end < total
+        if page["IsTruncated"]:
+            page["Marker"] = str(end)
+        return page
+
+
+class FakeIamEndpoint:
+    """
+    Serve a SyntheticAccount to a boto3 IAM client, without any network.
+
+    Like the botocore Stubber, the endpoint answers on the before-call event, so
+    botocore still validates the parameters, decodes the policy documents and emits
+    the after-call events. Unlike the Stubber, the response is picked from the
+    request parameters instead of a queue, so concurrent callers are served in any
+    order. Every call waits for the configured latency.
+    """
+
+    def __init__(self, account, latency=0.0):
+        """
+        Create the endpoint.
+
+        :param account: The SyntheticAccount to serve.
+        :param latency: The seconds every call waits, like a round trip to IAM.
+        """
+        self.account = account
+        self.latency = latency
+        self.calls = {}
+        self._lock = threading.Lock()
+
+    def attach(self, client):
+        """
+        Serve the IAM calls of a client.
+
+        :param client: A boto3 IAM client.
+        :return: The client.
+        """
+        client.meta.events.register("before-parameter-build.iam", self._before_parameter_build)
+        client.meta.events.register("before-call.iam", self._before_call)
+        return client
+
+    def _before_parameter_build(self, params, context, **kwargs):
+        # The before-call event only sees the serialized request, keep the API parameters.
+        context["benchmark_params"] = dict(params)
+
+    def _before_call(self, model, context, **kwargs):
+        params = context["benchmark_params"]
+        with self._lock:
+            self.calls[model.name] = self.calls.get(model.name, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+        max_items = params.get("MaxItems", 100)
+        if model.name == "GetAccountAuthorizationDetails":
+            parsed = self.account.authorization_details_page(
+                params.get("Filter", []), params.get("Marker"), max_items)
+        elif model.name == "ListPolicies":
+            policies = [
+                {key: value for key, value in entity.items() if key != "PolicyVersionList"}
+                for _, entity in self.account.entities("AWSManagedPolicy")
+                if entity["AttachmentCount"] > 0 or not params.get("OnlyAttached")
+            ]
+            start = int(params.get("Marker") or 0)
+            parsed = {
+                "Policies": policies[start:start + max_items],
+                "IsTruncated": start + max_items < len(policies),
+            }
+            if parsed["IsTruncated"]:
+                parsed["Marker"] = str(start + max_items)
+        elif model.name == "GetPolicyVersion":
+            index = int(params["PolicyArn"].rsplit("SyntheticAWSPolicy", 1)[1])
+            _, policy = self.account.entity("AWSManagedPolicy", index)
+            parsed = {"PolicyVersion": next(
+                version for version in policy["PolicyVersionList"]
+                if version["VersionId"] == params["VersionId"])}
+        else:
+            raise NotImplementedError(f"The fake IAM endpoint does not serve {model.name}")
+        parsed["ResponseMetadata"] = {"HTTPStatusCode": 200, "RetryAttempts": 0}
+        return AWSResponse(None, 200, {}, None), parsed
+
+
+def _environment():
+    """
+    Describe the environment the benchmark runs in.
+
+    :return: A dict of the platform, the library versions and the git commit.
+    """
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "Platform": platform.platform(),
+        "Python": sys.version,
+        "Boto3": boto3.__version__,
+        "Pandas": pd.__version__,
+        "Openpyxl": openpyxl.__version__,
+        "Commit": commit,
+    }
+
+
+def run_benchmark(size, roles, workdir, latency=0.0, legacy_flatten_sample=0, seed=0, **kwargs):
+    """
+    Run the report against a synthetic account and measure every stage.
+
+    :param size: The name of the benchmark size.
+    :param roles: The number of roles of the synthetic account.
+    :param workdir: The directory the reports are written to.
+    :param latency: The seconds every IAM call waits.
+    :param legacy_flatten_sample: Also time flatten_nested_json_df on this many users.
+    :param seed: The seed of the synthetic account.
+    :param kwargs: Passed through to get_account_authorization_details.
+    :return: The metrics document of the run.
+    """
+    account = SyntheticAccount(roles, seed=seed)
+    endpoint = FakeIamEndpoint(account, latency=latency)
+    iam_client = endpoint.attach(boto3.client("iam",
+                                              region_name="us-east-1",
+                                              aws_access_key_id="benchmark",
+                                              aws_secret_access_key="benchmark"))
+    metrics = report.RunMetrics()
+    metrics.rate_limiter = kwargs.get("rate_limiter")
+    # Keep the benchmark output readable, the report prints its progress.
+    with contextlib.redirect_stdout(io.StringIO()):
+        report.get_account_authorization_details(
+            profile="benchmark",
+            output=os.path.join(workdir, f"benchmark-{size}.json"),
+            region="us-east-1",
+            metrics=metrics,
+            iam_client=iam_client,
+            **kwargs)
+        if legacy_flatten_sample:
+            users = [
+                entity for _, entity in zip(range(legacy_flatten_sample),
+                                            account.entities("User", encode=False))
+            ]
+            with metrics.stage("legacy_flatten") as stage:
+                stage["rows"] = len(report.flatten_nested_json_df(pd.json_normalize(users)))
+    document = metrics.document()
+    document["Size"] = size
+    document["Entities"] = dict(account.counts)
+    document["EndpointCalls"] = dict(endpoint.calls)
+    return document
+
+
+def measure_startup(runs=5):
+    """
+    Measure the startup time of the report, from a fresh interpreter to the report imported.
+
+    :param runs: The number of interpreters started, the median is kept.
+    :return: A dict of the median and every startup time, and the heavy modules imported.
+    """
+    seconds = []
+    loaded = ""
+    for _ in range(runs):
+        started = time.perf_counter()
+        loaded = subprocess.check_output(
+            [sys.executable, "-c", STARTUP_SCRIPT],
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode('utf-8').strip()
+        seconds.append(time.perf_counter() - started)
+    return {
+        "seconds": sorted(seconds)[len(seconds) // 2],
+        "runs": seconds,
+        "heavy_modules": loaded.split(),
+    }
+
+
+def compare_results(results, baseline, max_regression):
+    """
+    Compare the stage timings of a benchmark with a baseline.
+
+    :param results: The benchmark results.
+    :param baseline: The baseline benchmark results.
+    :param max_regression: The slowdown ratio past which a stage is a regression, e.g. 0.2 for 20%.
+    :return: A list of the regressions, (size, stage, baseline seconds, seconds).
+    """
+    baseline_runs = {run["Size"]: run for run in baseline["Runs"]}
+    regressions = []
+    if "Startup" in results and "Startup" in baseline:
+        # The startup is compared like a stage of every size.
+        before = baseline["Startup"]["seconds"]
+        after = results["Startup"]["seconds"]
+        change = (after - before) / before if before else 0.0
+        print(f"{'':>6}  {'startup':<24} {before:10.3f}s {after:10.3f}s {change:+8.1%}")
+        if after - before > REGRESSION_NOISE_SECONDS and change > max_regression:
+            regressions.append(("", "startup", before, after))
+    for run in results["Runs"]:
+        baseline_run = baseline_runs.get(run["Size"])
+        if baseline_run is None:
+            continue
+        stages = dict(run["Stages"], total={"seconds": run["Seconds"]})
+        baseline_stages = dict(baseline_run["Stages"], total={"seconds": baseline_run["Seconds"]})
+        for name, stage in stages.items():
+            if name not in baseline_stages:
+                continue
+            before = baseline_stages[name]["seconds"]
+            after = stage["seconds"]
+            change = (after - before) / before if before else 0.0
+            print(f"{run['Size']:>6}  {name:<24} {before:10.3f}s {after:10.3f}s {change:+8.1%}")
+            if after - before > REGRESSION_NOISE_SECONDS and change > max_regression:
+                regressions.append((run["Size"], name, before, after))
+    return regressions
+
+
+def main():
+    """
+    Take in the arguments and benchmark the report.
+    """
+
+    # Configure logging.
+    logging.basicConfig(level=logging.ERROR,
+                        format='%(levelname)s: %(message)s')
+
+    # Add arguments to the parser.
+    parser = argparse.ArgumentParser(exit_on_error=False)
+
+    # The sizes argument
+    parser.add_argument('-s', '--sizes',
+                        help='The synthetic account sizes to benchmark, by number of roles.'
+                             'Default: 1k'
+                             'Example: --sizes 1k 10k',
+                        nargs='+',
+                        default=['1k'],
+                        choices=tuple(BENCHMARK_SIZES))
+
+    # The latency argument
+    parser.add_argument('--latency',
+                        help='The milliseconds every fake IAM call waits.'
+                             'Default: 0'
+                             'Example: --latency 50',
+                        default=0.0,
+                        type=float)
+
+    # The rate limit argument
+    parser.add_argument('--rate-limit',
+                        help='Pace the fake IAM calls with an adaptive rate limiter starting at this rate, '
+                             'in calls per second. 0 disables the limiter.'
+                             'Default: 0',
+                        default=0.0,
+                        type=float)
+
+    # The collection strategy argument
+    parser.add_argument('-c', '--collection-strategy',
+                        help='The collection strategy to benchmark.'
+                             'Default: concurrent',
+                        default='concurrent',
+                        choices=report.COLLECTION_STRATEGIES)
+
+    # The output format argument
+    parser.add_argument('--output-format',
+                        help='The report format to benchmark.'
+                             'Default: json',
+                        default='json',
+                        choices=report.OUTPUT_FORMATS)
+
+    # The flatten argument
+    parser.add_argument('-f', '--flatten',
+                        help='Benchmark the flattened Excel report.',
+                        action='store_true')
+
+    # The json-only argument
+    parser.add_argument('-j', '--json-only',
+                        help='Benchmark the JSON report only, without the Excel report.',
+                        action='store_true')
+
+    # The normalize workers argument
+    parser.add_argument('--normalize-workers',
+                        help='The number of worker processes the Excel tables are built in.'
+                             'Default: the number of CPUs',
+                        default=None,
+                        type=int)
+
+    # The normalize chunk size argument
+    parser.add_argument('--normalize-chunk-size',
+                        help='The number of entities a worker process normalizes at a time.'
+                             'Default: 5000',
+                        default=report.NORMALIZE_CHUNK_SIZE,
+                        type=int)
+
+    # The startup runs argument
+    parser.add_argument('--startup-runs',
+                        help='The number of fresh interpreters the startup time is measured on, 0 to skip.'
+                             'Default: 5',
+                        default=5,
+                        type=int)
+
+    # The permission index argument
+    parser.add_argument('--permission-index',
+                        help='Benchmark the effective-permission index stage too.',
+                        action='store_true')
+
+    # The include-non-default-policy-versions argument
+    parser.add_argument('-i', '--include-non-default-policy-versions',
+                        help='Benchmark with every AWS managed policy version.',
+                        action='store_true')
+
+    # The legacy flatten sample argument
+    parser.add_argument('--legacy-flatten-sample',
+                        help='Also time flatten_nested_json_df on this many users.'
+                             'Default: 0',
+                        default=0,
+                        type=int)
+
+    # The tracemalloc argument
+    parser.add_argument('--tracemalloc',
+                        help='Trace the Python allocations, the peak of every stage is added to the results.',
+                        action='store_true')
+
+    # The seed argument
+    parser.add_argument('--seed',
+                        help='The seed of the synthetic accounts.'
+                             'Default: 0',
+                        default=0,
+                        type=int)
+
+    # The results directory argument
+    parser.add_argument('-o', '--results-dir',
+                        help='The directory the benchmark results are saved to.'
+                             'Default: ./benchmarks',
+                        default='./benchmarks')
+
+    # The baseline argument
+    parser.add_argument('-b', '--baseline',
+                        help='A saved benchmark result to compare the stage timings with.'
+                             'Example: --baseline ./benchmarks/benchmark-20230101T000000Z.json',
+                        default=None)
+
+    # The max regression argument
+    parser.add_argument('--max-regression',
+                        help='The slowdown past which a stage fails the comparison with the baseline.'
+                             'Default: 0.2 (20%%)',
+                        default=0.2,
+                        type=float)
+
+    args = parser.parse_args()
+
+    print('-' * get_terminal_size()[0])
+    results = {
+        "GeneratedAt": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "Environment": _environment(),
+        "Parameters": vars(args),
+        "Runs": [],
+    }
+    if args.startup_runs:
+        results["Startup"] = measure_startup(args.startup_runs)
+        print(f"{'':>6}  {'startup':<24} {results['Startup']['seconds']:10.3f}s "
+              f"heavy_modules={results['Startup']['heavy_modules']}")
+    if args.tracemalloc:
+        tracemalloc.start()
+    with tempfile.TemporaryDirectory() as workdir:
+        for size in args.sizes:
+            print(emoji.emojize(":stopwatch:  Benchmarking {} roles.",
+                                language='alias').format(size))
+            if args.tracemalloc:
+                tracemalloc.reset_peak()
+            run = run_benchmark(
+                size,
+                BENCHMARK_SIZES[size],
+                workdir,
+                latency=args.latency / 1000,
+                legacy_flatten_sample=args.legacy_flatten_sample,
+                seed=args.seed,
+                collection_strategy=args.collection_strategy,
+                output_format=args.output_format,
+                flatten_json=args.flatten,
+                json_only=args.json_only,
+                normalize_workers=args.normalize_workers,
+                normalize_chunk_size=args.normalize_chunk_size,
+                permission_index=args.permission_index,
+                rate_limiter=report.AdaptiveRateLimiter(rate=args.rate_limit) if args.rate_limit > 0 else None,
+                include_non_default_policy_versions=args.include_non_default_policy_versions)
+            results["Runs"].append(run)
+            for name, stage in run["Stages"].items():
+                print(f"{size:>6}  {name:<24} {stage['seconds']:10.3f}s "
+                      f"rows={stage['rows']} peak_rss={stage['peak_rss_bytes']}")
+            print(f"{size:>6}  {'total':<24} {run['Seconds']:10.3f}s "
+                  f"api_calls={run['Api']['TotalCalls']}")
+    if args.tracemalloc:
+        tracemalloc.stop()
+
+    # Save the results, a later run can compare itself with them.
+    os.makedirs(args.results_dir, exist_ok=True)
+    results_path = os.path.join(
+        args.results_dir,
+        f"benchmark-{datetime.datetime.now(datetime.timezone.utc):%Y%m%dT%H%M%SZ}.json")
+    with open(results_path, 'w') as f:
+        json.dump(results, f, indent=4, default=str)
+    print(emoji.emojize(":white_check_mark:  Benchmark results written to {}.",
+                        language='alias').format(results_path))
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_results(results, baseline, args.max_regression)
+        if regressions:
+            for size, name, before, after in regressions:
+                print(emoji.emojize(
+                    f":cross_mark:  {size} {name} regressed from {before:.3f}s to {after:.3f}s.",
+                    language='alias'))
+            print('-' * get_terminal_size()[0])
+            sys.exit(1)
+        print(emoji.emojize(":check_mark_button:  No regression against {}.",
+                            language='alias').format(args.baseline))
+    print('-' * get_terminal_size()[0])
+
+
+# The main function.
+if __name__ == "__main__":
+    main()
+
+# End of script
@@ -1,284 +1,4758 @@
 import argparse as argparse
 import boto3 as boto3
+import collections.abc as collections_abc
 import configparser as configparser
+import contextlib as contextlib
+import cProfile as cProfile
+import dataclasses as dataclasses
 import datetime as datetime
 import emoji as emoji
+import fnmatch as fnmatch
+import functools as functools
+import gzip as gzip
+import hashlib as hashlib
+import http.server as http_server
+import itertools as itertools
 import json as json
 import logging as logging
-import openpyxl as openpyxl
-import pandas as pd
+import multiprocessing as multiprocessing
 import platform as platform
-import requests as requests
+import queue as queue
+import re as re
+import sqlite3 as sqlite3
 import subprocess as subprocess
 import sys as sys
+import threading as threading
 import os as os
+import time as time
+import tracemalloc as tracemalloc
+import typing as typing
+import urllib.parse as urllib_parse
 from botocore.config import Config
 from botocore.exceptions import ClientError
+from concurrent.futures import Future as Future
+from concurrent.futures import ProcessPoolExecutor as ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor as ThreadPoolExecutor
 from shutil import get_terminal_size as get_terminal_size
 from shutil import which as which
 
+# pandas and openpyxl take most of the startup time, they are imported by the Excel,
+# flatten and Parquet functions that use them so a --json-only run never loads them.
+
+try:
+    import resource as resource
+except ImportError:
+    # The resource module is not available on Windows, the peak RSS is then not reported.
+    resource = None
+
 logger = logging.getLogger(__name__)
 
+# The error codes of throttled AWS API calls.
+THROTTLING_ERROR_CODES = (
+    "Throttling",
+    "ThrottlingException",
+    "ThrottledException",
+    "RequestLimitExceeded",
+    "RequestThrottled",
+    "RequestThrottledException",
+    "TooManyRequestsException",
+)
+
+# The starting rate of the rate limiter of every account, in calls per second, and the
+# highest rate it raises the calls to. --rate-limit 0 turns the limiter off.
+DEFAULT_RATE_LIMIT = 10.0
+DEFAULT_MAX_RATE = 50.0
+
+# The filters accepted by get_account_authorization_details, in report order.
+COLLECTION_FILTERS = (
+    "User",
+    "Group",
+    "Role",
+    "LocalManagedPolicy",
+    "AWSManagedPolicy",
+)
+
+# The collection strategies accepted by collect_account_authorization_details.
+COLLECTION_STRATEGIES = ("concurrent", "single-pass")
+
+# The worker pools accepted by scan_accounts.
+ACCOUNT_POOLS = ("thread", "process")
+
+# The report formats. "json" accumulates the report in memory and dumps it at the end,
+# "jsonl" and "json-stream" write each entity to disk as its page arrives.
+OUTPUT_FORMATS = ("json", "jsonl", "json-stream")
+
+# The key column of the entities of each report list.
+ENTITY_KEYS = {
+    "UserDetailList": "UserId",
+    "GroupDetailList": "GroupId",
+    "RoleDetailList": "RoleId",
+    "Policies": "PolicyId",
+}
+
+# The known top-level fields of the entities of each report list.
+ENTITY_COLUMNS = {
+    "UserDetailList": (
+        "Path", "UserName", "UserId", "Arn", "CreateDate", "UserPolicyList",
+        "GroupList", "AttachedManagedPolicies", "PermissionsBoundary", "Tags",
+    ),
+    "GroupDetailList": (
+        "Path", "GroupName", "GroupId", "Arn", "CreateDate", "GroupPolicyList",
+        "AttachedManagedPolicies",
+    ),
+    "RoleDetailList": (
+        "Path", "RoleName", "RoleId", "Arn", "CreateDate", "AssumeRolePolicyDocument",
+        "InstanceProfileList", "RolePolicyList", "AttachedManagedPolicies",
+        "PermissionsBoundary", "Tags", "RoleLastUsed",
+    ),
+    "Policies": (
+        "PolicyName", "PolicyId", "Arn", "Path", "DefaultVersionId", "AttachmentCount",
+        "PermissionsBoundaryUsageCount", "IsAttachable", "Description", "CreateDate",
+        "UpdateDate", "PolicyVersionList",
+    ),
+}
+
+# The fields left out of the snapshot fingerprints, they change without any change in permissions.
+SNAPSHOT_IGNORED_FIELDS = ("RoleLastUsed",)
+
+# The short entity names that prefix the child sheets of a report list.
+SHEET_PREFIXES = {
+    "UserDetailList": "User",
+    "GroupDetailList": "Group",
+    "RoleDetailList": "Role",
+    "Policies": "Policy",
+}
+
+# The maximum number of rows of an Excel sheet, header included.
+EXCEL_MAX_ROWS = 1048576
+
+# The maximum number of characters of an Excel cell.
+EXCEL_MAX_CELL_LENGTH = 32767
+
+# The number of entities normalized by a worker process at a time.
+NORMALIZE_CHUNK_SIZE = 5000
+
+# Worker processes only normalize reports of more than this many chunks of entities,
+# smaller reports are normalized faster than the workers start.
+NORMALIZE_PARALLEL_CHUNKS = 2
+
+# The compressions of the streamed report formats, with their file extensions.
+OUTPUT_COMPRESSIONS = {
+    "none": "",
+    "gzip": ".gz",
+    "zstd": ".zst",
+}
+
+
+class RunMetrics:
+    """
+    Stage-level instrumentation of a run.
+
+    Every stage records its wall time, the number of times it ran, the rows it
+    produced and the peak RSS of the process when it ended (and the peak of the
+    traced Python allocations when tracemalloc is tracing). Instrumented IAM clients
+    add their API calls per operation and their retry and throttle counts, taken
+    from the botocore retries configured on the client. Stages may run in several
+    threads at the same time.
+    """
+
+    def __init__(self):
+        """
+        Start the metrics of a run.
+        """
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.api_calls = {}
+        self.retries = 0
+        self.throttles = 0
+        self.collection = {}
+        self.tracemalloc_top = None
+        self.rate_limiter = None
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Measure a stage.
+
+        :param name: The name of the stage, a stage that runs several times is accumulated.
+        :return: A context manager yielding a dict, set its "rows" to the rows the stage produced.
+        """
+        measured = {"rows": None}
+        started = time.perf_counter()
+        try:
+            yield measured
+        finally:
+            seconds = time.perf_counter() - started
+            traced_peak = tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else None
+            with self._lock:
+                stage = self.stages.setdefault(name, {
+                    "seconds": 0.0,
+                    "runs": 0,
+                    "rows": None,
+                    "peak_rss_bytes": None,
+                })
+                stage["seconds"] += seconds
+                stage["runs"] += 1
+                if measured["rows"] is not None:
+                    stage["rows"] = (stage["rows"] or 0) + measured["rows"]
+                stage["peak_rss_bytes"] = peak_rss_bytes()
+                if traced_peak is not None:
+                    stage["tracemalloc_peak_bytes"] = max(
+                        stage.get("tracemalloc_peak_bytes", 0), traced_peak)
+            logger.info("Stage %s: %.2fs", name, seconds)
+
+    def instrument_client(self, client):
+        """
+        Count the API calls, retries and throttles of a boto3 client.
+
+        :param client: A boto3 client.
+        :return: The client.
+        """
+        service = client.meta.service_model.service_name
+        client.meta.events.register(f"after-call.{service}", self._after_call)
+        client.meta.events.register(f"needs-retry.{service}", self._needs_retry)
+        return client
+
+    def _after_call(self, parsed=None, model=None, **kwargs):
+        # RetryAttempts holds the retries botocore made before this response.
+        retries = ((parsed or {}).get("ResponseMetadata") or {}).get("RetryAttempts", 0)
+        with self._lock:
+            operation = model.name if model is not None else "Unknown"
+            self.api_calls[operation] = self.api_calls.get(operation, 0) + 1
+            self.retries += retries
+
+    def _needs_retry(self, response=None, **kwargs):
+        # Every attempt goes through needs-retry, count the throttled ones.
+        if response is None:
+            return None
+        code = (response[1] or {}).get("Error", {}).get("Code")
+        if code in THROTTLING_ERROR_CODES:
+            with self._lock:
+                self.throttles += 1
+        return None
+
+    def add_collection(self, account, collection_stats):
+        """
+        Record the per-filter pagination statistics of an account.
+
+        :param account: The label of the account.
+        :param collection_stats: The statistics returned by collect_account_authorization_details.
+        """
+        with self._lock:
+            self.collection[account] = collection_stats
+
+    def add_tracemalloc_snapshot(self, snapshot, limit=10):
+        """
+        Record the top allocations of a tracemalloc snapshot.
+
+        :param snapshot: A tracemalloc snapshot.
+        :param limit: The number of allocation sites to keep.
+        """
+        with self._lock:
+            self.tracemalloc_top = [
+                {"Site": str(statistic.traceback), "Bytes": statistic.size, "Blocks": statistic.count}
+                for statistic in snapshot.statistics('lineno')[:limit]
+            ]
+
+    def document(self):
+        """
+        Build the metrics document.
+
+        :return: A JSON serializable dict.
+        """
+        with self._lock:
+            return {
+                "GeneratedAt": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                "Seconds": time.perf_counter() - self.started,
+                "PeakRssBytes": peak_rss_bytes(),
+                "Stages": {name: dict(stage) for name, stage in self.stages.items()},
+                "Api": {
+                    "Calls": dict(self.api_calls),
+                    "TotalCalls": sum(self.api_calls.values()),
+                    "Retries": self.retries,
+                    "Throttles": self.throttles,
+                },
+                "Collection": dict(self.collection),
+                "RateLimiter": self.rate_limiter.document() if self.rate_limiter is not None else None,
+                "TracemallocTop": self.tracemalloc_top,
+            }
+
+    def write(self, path):
+        """
+        Write the metrics document.
+
+        :param path: The path of the metrics document.
+        """
+        with open(path, 'w') as f:
+            json.dump(self.document(), f, indent=4, default=str)
+
+
+class AdaptiveRateLimiter:
+    """
+    A token bucket shared by every IAM client of an account, with an AIMD rate.
+
+    Every API call, and every retry botocore makes, waits for a token. The bucket
+    refills at the current rate and holds up to burst tokens. Each successful call
+    raises the rate additively, by about increase calls per second every second, up to
+    max_rate. A throttled call cuts it multiplicatively by decrease, at most once per
+    second so a burst of throttles counts once, down to min_rate. IAM limits are account
+    wide, so one limiter in front of every client of an account keeps its concurrent
+    paginators from retrying against each other. The accounts of a multi-account scan
+    each get their own limiter with for_account, the throttles of one account do not
+    slow down the others.
+    """
+
+    def __init__(self, rate=DEFAULT_RATE_LIMIT, min_rate=0.5, max_rate=DEFAULT_MAX_RATE, increase=1.0,
+                 decrease=0.5, burst=5):
+        """
+        Create the rate limiter.
+
+        :param rate: The starting rate, in calls per second.
+        :param min_rate: The lowest rate the throttles cut down to.
+        :param max_rate: The highest rate the successful calls raise to.
+        :param increase: The calls per second added to the rate every second without throttles.
+        :param decrease: The factor the rate is multiplied by on throttles.
+        :param burst: The number of calls allowed at once after an idle time.
+        """
+        self.rate = float(rate)
+        self.min_rate = float(min_rate)
+        self.max_rate = float(max_rate)
+        self.increase = float(increase)
+        self.decrease = float(decrease)
+        self.burst = burst
+        self.accounts = None
+        self._reset()
+
+    def for_account(self):
+        """
+        Create a limiter of its own for an account, with the settings of this one.
+
+        :return: An AdaptiveRateLimiter.
+        """
+        return AdaptiveRateLimiter(rate=self.rate, min_rate=self.min_rate, max_rate=self.max_rate,
+                                   increase=self.increase, decrease=self.decrease, burst=self.burst)
+
+    def record_accounts(self, documents, seconds):
+        """
+        Record the limiters of the accounts of a scan, document then sums them up.
+
+        :param documents: A dict of account label to the document of its limiter.
+        :param seconds: The time the scan took.
+        """
+        with self._lock:
+            self.accounts = {"Documents": dict(documents), "Seconds": seconds}
+
+    def _reset(self):
+        self.calls = 0
+        self.throttles = 0
+        self.waited = 0.0
+        self.lowest_rate = self.rate
+        self.highest_rate = self.rate
+        self._first_call = None
+        self._last_call = None
+        self._last_decrease = None
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Worker processes get a limiter of their own, with the same settings and rate.
+        return {key: getattr(self, key) for key in (
+            "rate", "min_rate", "max_rate", "increase", "decrease", "burst")}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.accounts = None
+        self._reset()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        """
+        Wait for a token.
+
+        :return: The seconds waited.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            # Reserve the token now, callers queue up behind each other.
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            self.calls += 1
+            self.waited += wait
+            if self._first_call is None:
+                self._first_call = now + wait
+            self._last_call = now + wait
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def on_success(self):
+        """
+        Raise the rate after a successful call.
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+            self.highest_rate = max(self.highest_rate, self.rate)
+
+    def on_throttle(self):
+        """
+        Cut the rate after a throttled call.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.throttles += 1
+            if self._last_decrease is not None and now - self._last_decrease < 1.0:
+                return
+            self._refill(now)
+            self._last_decrease = now
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self.lowest_rate = min(self.lowest_rate, self.rate)
+            # Drop the burst, the next calls wait for the lower rate.
+            self._tokens = min(self._tokens, 0.0)
+        logger.info("Throttled, the IAM call rate is cut to %.2f/s", self.rate)
+
+    def attach(self, client):
+        """
+        Put the limiter in front of every call of a boto3 client.
+
+        :param client: A boto3 client.
+        :return: The client.
+        """
+        service = client.meta.service_model.service_name
+        # First, so the limiter runs before any handler that answers the call itself.
+        client.meta.events.register_first(f"before-call.{service}", self._before_call)
+        client.meta.events.register(f"request-created.{service}", self._request_created)
+        client.meta.events.register(f"needs-retry.{service}", self._needs_retry)
+        client.meta.events.register(f"after-call.{service}", self._after_call)
+        return client
+
+    def _before_call(self, **kwargs):
+        self.acquire()
+        return None
+
+    def _request_created(self, request=None, **kwargs):
+        # The request of every retry is created again, only once botocore decided to retry.
+        context = getattr(request, "context", None) or {}
+        if context.get("retries", {}).get("attempt", 1) > 1:
+            self.acquire()
+
+    def _needs_retry(self, response=None, **kwargs):
+        # Every attempt goes through needs-retry, a throttle cuts the rate of the next calls.
+        if response is None:
+            return None
+        code = (response[1] or {}).get("Error", {}).get("Code")
+        if code in THROTTLING_ERROR_CODES:
+            self.on_throttle()
+        return None
+
+    def _after_call(self, http_response=None, **kwargs):
+        # Only successful calls raise the rate, not the errors nor the throttles.
+        if http_response is not None and 200 <= http_response.status_code < 300:
+            self.on_success()
+
+    def document(self):
+        """
+        Build the throughput document of the limiter.
+
+        :return: A JSON serializable dict. After record_accounts, the sums of the accounts
+          and the document of every account under Accounts.
+        """
+        with self._lock:
+            if self.accounts is not None:
+                documents = self.accounts["Documents"]
+                calls = sum(document["Calls"] for document in documents.values())
+                seconds = self.accounts["Seconds"]
+                return {
+                    "Calls": calls,
+                    "Throttles": sum(document["Throttles"] for document in documents.values()),
+                    "Seconds": seconds,
+                    "CallsPerSecond": calls / seconds if calls and seconds > 0 else None,
+                    "WaitedSeconds": sum(document["WaitedSeconds"] for document in documents.values()),
+                    "Rate": None,
+                    "LowestRate": min((document["LowestRate"] for document in documents.values()),
+                                      default=self.rate),
+                    "HighestRate": max((document["HighestRate"] for document in documents.values()),
+                                       default=self.rate),
+                    "Accounts": documents,
+                }
+            seconds = (self._last_call - self._first_call) if self.calls > 1 else 0.0
+            return {
+                "Calls": self.calls,
+                "Throttles": self.throttles,
+                "Seconds": seconds,
+                "CallsPerSecond": (self.calls - 1) / seconds if seconds > 0 else None,
+                "WaitedSeconds": self.waited,
+                "Rate": self.rate,
+                "LowestRate": self.lowest_rate,
+                "HighestRate": self.highest_rate,
+            }
+
+
+def peak_rss_bytes():
+    """
+    Get the peak resident set size of the process.
+
+    :return: The peak RSS in bytes, or None where the resource module is not available.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak if platform.system() == 'Darwin' else peak * 1024
+
+
+def _stage(metrics, name):
+    """
+    Measure a stage when the run is instrumented.
+
+    :param metrics: A RunMetrics, or None.
+    :param name: The name of the stage.
+    :return: A context manager yielding a dict, set its "rows" to the rows the stage produced.
+    """
+    if metrics is None:
+        return contextlib.nullcontext({"rows": None})
+    return metrics.stage(name)
+
+
+def flatten_nested_json_df(df):
+    """
+    Flatten a nested json dataframe.
+
+    Every list column is exploded into the same dataframe, so the rows grow as the
+    product of the list lengths. Superseded by flatten_to_tables.
+
+    :param df: A pandas dataframe with nested json fields.
+    :return: A flattened pandas dataframe.
+    """
+    import pandas as pd
+
+    # reset index to avoid problems with explode
+    df = df.reset_index()
+
+    # print the dataframe shape and columns
+    print(emoji.emojize(f":wrench:  Orignal shape {df.shape}.", language='alias'))
+    print(
+        emoji.emojize(
+            f":wrench:  Original columns: {df.columns}", language='alias'
+        )
+    )
+
+    # search for columns to explode/flatten
+    s = (df.applymap(type) == list).all()
+    # get the list of columns to explode
+    list_columns = s[s].index.tolist()
+    # search for columns to explode/flatten
+    s = (df.applymap(type) == dict).all()
+    dict_columns = s[s].index.tolist()
+
+    # print the columns to explode/flatten
+    print(f"lists: {list_columns}, dicts: {dict_columns}")
+
+    # loop until there are no more columns to explode/flatten
+    while len(list_columns) > 0 or len(dict_columns) > 0:
+        new_columns = []
+
+        for col in dict_columns:
+            # print the column being flattened
+            print(emoji.emojize(f":wrench:  Flattening: {col}.", language='alias'))
+            # explode dictionaries horizontally, adding new columns
+            horiz_exploded = pd.json_normalize(df[col]).add_prefix(f'{col}.')
+            # reset index to avoid problems with explode
+            horiz_exploded.index = df.index
+            # join the new columns to the original dataframe
+            df = pd.concat([df, horiz_exploded], axis=1).drop(columns=[col])
+            # add the new columns to the list of columns to explode/flatten
+            new_columns.extend(horiz_exploded.columns)  # inplace
+
+        # check if there are still a dict or list of fields to flatten
+        for col in list_columns:
+            print(emoji.emojize(f":wrench:  Exploding: {col}.", language='alias'))
+            # explode lists vertically, adding new columns
+            df = df.drop(columns=[col]).join(df[col].explode().to_frame())
+            # add the new columns to the list of columns to explode/flatten
+            new_columns.append(col)
+
+        # check if there are still dict o list fields to flatten
+        s = (df[new_columns].applymap(type) == list).all()
+        list_columns = s[s].index.tolist()
+
+        s = (df[new_columns].applymap(type) == dict).all()
+        dict_columns = s[s].index.tolist()
+
+        print(
+            emoji.emojize(
+                f":wrench:  Lists: {list_columns} Dictionaries {dict_columns}.",
+                language='alias',
+            )
+        )
+
+    # print the dataframe shape and columns
+    print(emoji.emojize(f":wrench:  Final shape {df.shape}.", language='alias'))
+    print(
+        emoji.emojize(
+            f":wrench:  Final columns: {df.columns}", language='alias'
+        )
+    )
+    return df
+
+
+def _is_list(value):
+    """
+    Check if a dataframe cell holds a list.
+
+    :param value: A dataframe cell.
+    :return: True for lists.
+    """
+    return isinstance(value, list)
+
+
+def _is_dict(value):
+    """
+    Check if a dataframe cell holds a dict.
+
+    :param value: A dataframe cell.
+    :return: True for dicts.
+    """
+    return isinstance(value, dict)
+
+
+def _flatten_frame(df, table_name, key_columns, tables, children=None):
+    """
+    Split the list columns of a dataframe into child tables, recursively.
+
+    :param df: A dataframe whose nested dicts are already flattened by json_normalize.
+    :param table_name: The name of the table built from the dataframe.
+    :param key_columns: The columns that identify a row of the dataframe.
+    :param tables: The dict of table name to dataframe to add the tables to.
+    :param children: A dict of table name to the names of its child tables, in column order,
+      updated in place when given.
+    """
+    import pandas as pd
+    df = df.reset_index(drop=True)
+    # Find the list columns once, json_normalize already flattened the nested dicts.
+    list_columns = [
+        col for col in df.columns
+        if col not in key_columns and df[col].map(_is_list).any()
+    ]
+    table = df.drop(columns=list_columns)
+    if table_name in tables:
+        # The same field can be nested under both a dict and a list, e.g. a Statement.
+        table = pd.concat([tables[table_name], table], ignore_index=True)
+    tables[table_name] = table
+    if children is not None:
+        names = children.setdefault(table_name, [])
+        names.extend(f"{table_name.split('.')[0]}.{col}" for col in list_columns
+                     if f"{table_name.split('.')[0]}.{col}" not in names)
+
+    for col in list_columns:
+        # One row per list element, keyed by the parent row and the element position.
+        exploded = df[key_columns + [col]].explode(col)
+        index_column = f"{col}Index"
+        exploded[index_column] = exploded.groupby(level=0).cumcount()
+        exploded = exploded[exploded[col].notna()].reset_index(drop=True)
+        child = exploded[key_columns + [index_column]]
+        if exploded[col].map(_is_dict).any():
+            # Flatten the dict elements horizontally, keeping stray scalars lossless.
+            elements = pd.json_normalize(
+                [value if _is_dict(value) else {"": value} for value in exploded[col]]
+            ).add_prefix(f"{col}.")
+            child = pd.concat([child, elements], axis=1)
+        elif not exploded.empty:
+            # Lists that are all empty add no column, whatever chunk of the report they are in.
+            child = child.assign(**{col: exploded[col]})
+        # Child tables are named after the entity list and the dotted field path.
+        _flatten_frame(child,
+                       f"{table_name.split('.')[0]}.{col}",
+                       key_columns + [index_column],
+                       tables,
+                       children)
+
+
+def flatten_to_tables(entities, table_name, key_column=None, start=0, children=None):
+    """
+    Flatten report entities into a parent table and one child table per list field.
+
+    Nested dicts become dotted columns. Every list field becomes its own child table
+    with one row per element, keyed back to its parent row by the parent key columns
+    and the element position, so the rows grow linearly with the input instead of
+    as the product of the list lengths.
+
+    :param entities: A list of report entities, e.g. the UserDetailList.
+    :param table_name: The name of the parent table, child tables are named <table_name>.<field>.
+    :param key_column: The column that identifies an entity, defaults to ENTITY_KEYS[table_name].
+    :param start: The position of the first entity in its report list, when flattening a chunk of it.
+    :param children: A dict of table name to the names of its child tables, in column order,
+      updated in place when given.
+    :return: A dict of table name to dataframe, parent table first.
+    """
+    import pandas as pd
+    key_column = key_column or ENTITY_KEYS.get(table_name, "Index")
+    df = pd.json_normalize(entities) if entities else pd.DataFrame()
+    if key_column not in df.columns:
+        # Fall back to the entity position when the entities have no key.
+        df.insert(0, key_column, range(start, start + len(df)))
+    tables = {}
+    _flatten_frame(df, table_name, [key_column], tables, children)
+    for name, table in tables.items():
+        logger.info("Table %s: %d row(s), %d column(s)", name, *table.shape)
+    return tables
+
+
+def _sheet_name(table_name, used, part=1):
+    """
+    Build a unique Excel sheet name from a table name.
+
+    :param table_name: The name of the table.
+    :param used: The set of sheet names already in the workbook, updated in place.
+    :param part: The part of a table rolled over to several sheets, named "<sheet> (<part>)".
+    :return: A sheet name of at most 31 characters.
+    """
+    part_suffix = f" ({part})" if part > 1 else ""
+    length = 31 - len(part_suffix)
+    parts = table_name.split('.')
+    if len(parts) == 1:
+        name = table_name[:length]
+    else:
+        # Keep the entity and the most specific fields of the path that fit.
+        prefix = SHEET_PREFIXES.get(parts[0], parts[0])
+        fields = parts[1:]
+        while len(fields) > 1 and len('.'.join([prefix] + fields)) > length:
+            fields = fields[1:]
+        name = '.'.join([prefix] + fields)[:length]
+    name += part_suffix
+    suffix = 1
+    base = name
+    while name in used:
+        suffix += 1
+        name = f"{base[:31 - len(str(suffix)) - 1]}~{suffix}"
+    used.add(name)
+    return name
+
+
+def _default_policy_version_entry(policy):
+    """
+    Trim a managed policy down to its default policy version.
+
+    :param policy: A policy dict as returned in the Policies list.
+    :return: A new policy dict that only holds the default policy version.
+    """
+    policy_version_list = []
+    for policy_version in policy.get("PolicyVersionList"):
+        if policy_version.get("VersionId") == policy.get("DefaultVersionId"):
+            policy_version_list.append(policy_version)
+            break
+    # Create a new entry with only the default policy version
+    return {
+        "PolicyName": policy.get("PolicyName"),
+        "PolicyId": policy.get("PolicyId"),
+        "Arn": policy.get("Arn"),
+        "Path": policy.get("Path"),
+        "DefaultVersionId": policy.get("DefaultVersionId"),
+        "AttachmentCount": policy.get("AttachmentCount"),
+        "PermissionsBoundaryUsageCount": policy.get(
+            "PermissionsBoundaryUsageCount"
+        ),
+        "IsAttachable": policy.get("IsAttachable"),
+        "CreateDate": policy.get("CreateDate"),
+        "UpdateDate": policy.get("UpdateDate"),
+        "PolicyVersionList": policy_version_list,
+    }
+
+
+def _is_aws_managed_policy(policy):
+    """
+    Check if a policy is owned by AWS rather than by the account.
+
+    :param policy: A policy dict as returned in the Policies list.
+    :return: True for AWS managed policies, False for customer managed ones.
+    """
+    # AWS managed policies live under arn:<partition>:iam::aws:policy/
+    return ":iam::aws:policy/" in policy.get("Arn", "")
+
+
+def _route_page(
+    filter_name,
+    page,
+    include_non_default_policy_versions=False,
+    include_unattached=False,
+    policy_cache=None
+):
+    """
+    Route the entities of a single page into the report lists.
+
+    :param filter_name: The filter the page was requested with, or None for an unfiltered page.
+    :param page: A page returned by the get_account_authorization_details paginator.
+    :param include_non_default_policy_versions: Keep every version of AWS managed policies.
+    :param include_unattached: Keep managed policies that are not attached to any principal.
+    :param policy_cache: A PolicyDocumentCache to store the AWS managed policy documents in.
+    :return: A dict of report list name to the entities taken from the page.
+    """
+    routed = {
+        "UserDetailList": [],
+        "GroupDetailList": [],
+        "RoleDetailList": [],
+        "Policies": [],
+    }
+    if filter_name in (None, "User"):
+        # Always add inline user policies
+        routed["UserDetailList"].extend(page.get("UserDetailList", []))
+    if filter_name in (None, "Group"):
+        routed["GroupDetailList"].extend(page.get("GroupDetailList", []))
+    if filter_name in (None, "Role"):
+        routed["RoleDetailList"].extend(page.get("RoleDetailList", []))
+    if filter_name == "Role":
+        for policy in page.get("Policies", []):
+            # Ignore Service Linked Roles which cannot be modified and will create messy results.
+            routed["RoleDetailList"].append(policy)
+        return routed
+    for policy in page.get("Policies", []):
+        aws_managed = _is_aws_managed_policy(policy)
+        if filter_name == "LocalManagedPolicy" and aws_managed:
+            continue
+        if filter_name == "AWSManagedPolicy" and not aws_managed:
+            continue
+        # Add managed policies if they are attached to IAM principals or if `--include-unattached` is specified
+        if policy["AttachmentCount"] > 0 or include_unattached:
+            if aws_managed and not include_non_default_policy_versions:
+                policy = _default_policy_version_entry(policy)
+            if aws_managed and policy_cache is not None:
+                # Reference the documents shared by every account by hash.
+                policy = policy_cache.reference_documents(policy)
+            routed["Policies"].append(policy)
+    return routed
+
+
+class CollectionCheckpoint:
+    """
+    Save the progress of a collection, so an interrupted run resumes where it stopped.
+
+    The checkpoint is a JSON lines file. Its first line holds the collection options
+    and every next line a completed page: {"Filter": ..., "Marker": ..., "Page": ...},
+    where Marker is the marker of the next page, null once the filter is complete, and
+    Page the routed entities of the page. A resumed filter replays its saved pages and
+    continues from the last marker. A checkpoint written with other options, or a
+    partially written last line, is discarded. Pages may be saved from several threads.
+    """
+
+    def __init__(self, path, options):
+        """
+        Open the checkpoint, loading the pages of a previous run.
+
+        :param path: The path of the checkpoint.
+        :param options: The collection options, a checkpoint saved with other options is discarded.
+        """
+        self.path = path
+        self.options = json.loads(json.dumps(options, default=str))
+        self.resumed = False
+        self._pages = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        # Keep the complete lines of a previous checkpoint written with the same options.
+        valid_offset = 0
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                for number, line in enumerate(f):
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    if number == 0:
+                        if record.get("Checkpoint") != self.options:
+                            logger.warning("Discarding the checkpoint %s, it was saved with other options",
+                                           self.path)
+                            break
+                    else:
+                        self._pages.setdefault(record["Filter"], []).append(
+                            (record["Page"], record["Marker"]))
+                    valid_offset = f.tell()
+        if valid_offset:
+            # Drop a line torn by the interruption, the page is collected again.
+            with open(self.path, 'r+b') as f:
+                f.truncate(valid_offset)
+            self.resumed = bool(self._pages)
+            return
+        with open(self.path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({"Checkpoint": self.options}) + '\n')
+        self._pages = {}
+
+    def resume(self, filter_name):
+        """
+        Get the saved progress of a filter.
+
+        :param filter_name: The filter, or "All" for the single-pass collection.
+        :return: A tuple of the saved routed pages, the marker to continue from, and
+          whether the filter is complete.
+        """
+        pages = self._pages.get(filter_name, [])
+        if not pages:
+            return [], None, False
+        marker = pages[-1][1]
+        return [page for page, _ in pages], marker, marker is None
+
+    def save_page(self, filter_name, routed, marker):
+        """
+        Save a completed page.
+
+        :param filter_name: The filter, or "All" for the single-pass collection.
+        :param routed: The routed entities of the page.
+        :param marker: The marker of the next page, None when the filter is complete.
+        """
+        line = json.dumps({"Filter": filter_name, "Marker": marker, "Page": routed}, default=str) + '\n'
+        with self._lock, open(self.path, 'a', encoding='utf-8') as f:
+            f.write(line)
+            # The page must be on disk before the next one is requested.
+            f.flush()
+            os.fsync(f.fileno())
+
+    def discard(self):
+        """
+        Remove the checkpoint once the report is written.
+        """
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def _resume_pagination(checkpoint, filter_name, paginate_kwargs, handle_page):
+    """
+    Replay the saved pages of a filter and point the pagination at the next page.
+
+    :param checkpoint: A CollectionCheckpoint, or None.
+    :param filter_name: The filter, or "All" for the single-pass collection.
+    :param paginate_kwargs: The paginate arguments, the marker of the next page is added to them.
+    :param handle_page: Called with the routed entities of every saved page.
+    :return: The number of replayed pages, and whether the filter is complete.
+    """
+    if checkpoint is None:
+        return 0, False
+    pages, marker, done = checkpoint.resume(filter_name)
+    for routed_page in pages:
+        handle_page(routed_page)
+    if marker is not None:
+        # Pass the marker to the first request rather than as a StartingToken, which
+        # botocore resumes by emptying every result key but the first of the page.
+        paginate_kwargs["Marker"] = marker
+    if pages:
+        logger.info("Filter %s: resumed %d page(s) from %s", filter_name, len(pages), checkpoint.path)
+    return len(pages), done
+
+
+def _next_marker(page):
+    """
+    Get the marker of the page after a page.
+
+    :param page: A page returned by an IAM paginator.
+    :return: The marker, or None on the last page.
+    """
+    return page.get("Marker") if page.get("IsTruncated") else None
+
+
+def _paginate_filter(
+    iam_client,
+    filter_name,
+    include_non_default_policy_versions=False,
+    include_unattached=False,
+    on_page=None,
+    policy_cache=None,
+    checkpoint=None
+):
+    """
+    Walk every page of a single get_account_authorization_details filter.
+
+    :param iam_client: A boto3 IAM client.
+    :param filter_name: The filter to paginate, or None for an unfiltered pass.
+    :param include_non_default_policy_versions: Keep every version of AWS managed policies.
+    :param include_unattached: Keep managed policies that are not attached to any principal.
+    :param on_page: Called with the routed entities of each page instead of accumulating them.
+    :param policy_cache: A PolicyDocumentCache to store the AWS managed policy documents in.
+    :param checkpoint: A CollectionCheckpoint to save every page in and resume from.
+    :return: A tuple of the routed entities and the pagination statistics.
+    """
+    started = time.perf_counter()
+    routed = {
+        "UserDetailList": [],
+        "GroupDetailList": [],
+        "RoleDetailList": [],
+        "Policies": [],
+    }
+    pages = 0
+    records = 0
+
+    def handle_page(routed_page):
+        nonlocal pages, records
+        pages += 1
+        records += sum(len(entities) for entities in routed_page.values())
+        if on_page is not None:
+            # Hand the page over instead of holding it in memory.
+            on_page(routed_page)
+            return
+        for key, entities in routed_page.items():
+            routed[key].extend(entities)
+
+    paginator = iam_client.get_paginator("get_account_authorization_details")
+    paginate_kwargs = {} if filter_name is None else {"Filter": [filter_name]}
+    resumed_pages, done = _resume_pagination(checkpoint, filter_name or "All", paginate_kwargs, handle_page)
+    for page in ([] if done else paginator.paginate(**paginate_kwargs)):
+        routed_page = _route_page(
+            filter_name,
+            page,
+            include_non_default_policy_versions=include_non_default_policy_versions,
+            include_unattached=include_unattached,
+            policy_cache=policy_cache)
+        if checkpoint is not None:
+            checkpoint.save_page(filter_name or "All", routed_page, _next_marker(page))
+        handle_page(routed_page)
+    stats = {
+        "pages": pages,
+        "records": records,
+        "seconds": time.perf_counter() - started,
+    }
+    if resumed_pages:
+        stats["resumed_pages"] = resumed_pages
+    logger.info("Filter %s: %d page(s) in %.2fs",
+                filter_name or "All", pages, stats["seconds"])
+    return routed, stats
+
+
+class PolicyDocumentCache:
+    """
+    An on-disk, content-addressed cache of AWS managed policy documents.
+
+    Documents are stored once under documents/<hash[:2]>/<hash>.json, where the hash is
+    the SHA-256 of the canonical JSON document, so identical documents of several
+    accounts share a single file. Policy versions are looked up by ARN and version id
+    in versions/, one small file per version. Every file is written atomically, so
+    several threads or processes can share the same cache directory. The least
+    recently used documents are evicted once the cache grows past max_bytes.
+    """
+
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024):
+        """
+        Open the cache, creating its directory when missing.
+
+        :param directory: The directory of the cache.
+        :param max_bytes: The size of the documents past which the cache is evicted.
+        """
+        self.directory = os.path.expanduser(directory)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(self.directory, "documents"), exist_ok=True)
+        os.makedirs(os.path.join(self.directory, "versions"), exist_ok=True)
+
+    def _document_path(self, document_hash):
+        return os.path.join(self.directory, "documents", document_hash[:2], f"{document_hash}.json")
+
+    def _version_path(self, arn, version_id):
+        key = hashlib.sha256(f"{arn}|{version_id}".encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, "versions", f"{key}.json")
+
+    def _write(self, path, content):
+        # Write to a temporary file and rename it, readers never see a partial file.
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary_path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(temporary_path, path)
+
+    def lookup(self, arn, version_id):
+        """
+        Look up a cached policy version.
+
+        :param arn: The ARN of the policy.
+        :param version_id: The id of the policy version.
+        :return: The cached version, {"Hash": ..., "CreateDate": ...}, or None when it is not cached.
+        """
+        try:
+            with open(self._version_path(arn, version_id), encoding='utf-8') as f:
+                version = json.load(f)
+            # Mark the document as recently used, it may have been evicted.
+            os.utime(self._document_path(version["Hash"]))
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return version
+
+    def put(self, arn, version_id, document, create_date=None):
+        """
+        Store a policy version and its document.
+
+        :param arn: The ARN of the policy.
+        :param version_id: The id of the policy version.
+        :param document: The policy document.
+        :param create_date: The creation date of the policy version.
+        :return: The hash of the document.
+        """
+        content = json.dumps(document, sort_keys=True, default=str)
+        document_hash = hashlib.sha256(content.encode('utf-8')).hexdigest()
+        document_path = self._document_path(document_hash)
+        if not os.path.exists(document_path):
+            self._write(document_path, content)
+        self._write(self._version_path(arn, version_id), json.dumps({
+            "Arn": arn,
+            "VersionId": version_id,
+            "Hash": document_hash,
+            "CreateDate": create_date,
+        }, default=str))
+        return document_hash
+
+    def get(self, document_hash):
+        """
+        Read a cached document.
+
+        :param document_hash: The hash of the document.
+        :return: The policy document.
+        """
+        with open(self._document_path(document_hash), encoding='utf-8') as f:
+            return json.load(f)
+
+    def resolve(self, arn, version):
+        """
+        Read the document a policy version of a report references by DocumentHash.
+
+        :param arn: The ARN of the policy, for the log.
+        :param version: A version of the PolicyVersionList of the policy.
+        :return: The policy document, None when the version references none or the
+          document is no longer cached.
+        """
+        if "DocumentHash" not in version:
+            return None
+        try:
+            return self.get(version["DocumentHash"])
+        except (OSError, ValueError) as e:
+            # The cache may have evicted a document a saved report still references.
+            logger.info("Cannot read the cached document of %s: %s", arn, e)
+            return None
+
+    def reference_documents(self, policy):
+        """
+        Store the documents of a policy and reference them by hash.
+
+        :param policy: A policy dict with its PolicyVersionList.
+        :return: A copy of the policy whose versions hold a DocumentHash instead of a Document.
+        """
+        policy_version_list = []
+        for policy_version in policy.get("PolicyVersionList") or []:
+            policy_version = dict(policy_version)
+            if "Document" in policy_version:
+                policy_version["DocumentHash"] = self.put(
+                    policy.get("Arn"),
+                    policy_version.get("VersionId"),
+                    policy_version.pop("Document"),
+                    policy_version.get("CreateDate"))
+            policy_version_list.append(policy_version)
+        return dict(policy, PolicyVersionList=policy_version_list)
+
+    def evict(self):
+        """
+        Evict the least recently used documents until the cache fits in max_bytes.
+
+        :return: The number of evicted documents.
+        """
+        documents = []
+        total = 0
+        for root, _, files in os.walk(os.path.join(self.directory, "documents")):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                documents.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+        evicted = 0
+        # Versions of evicted documents turn into misses and are fetched again.
+        for _, size, path in sorted(documents):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            evicted += 1
+        if evicted:
+            logger.info("Evicted %d document(s) from %s", evicted, self.directory)
+        return evicted
+
+
+def _paginate_cached_aws_managed_policies(
+    iam_client,
+    policy_cache,
+    include_unattached=False,
+    on_page=None,
+    checkpoint=None
+):
+    """
+    Collect the default versions of the AWS managed policies through the document cache.
+
+    The policies are listed without their documents, and only the default versions
+    missing from the cache are downloaded, one get_policy_version call each.
+
+    :param iam_client: A boto3 IAM client.
+    :param policy_cache: A PolicyDocumentCache.
+    :param include_unattached: Keep managed policies that are not attached to any principal.
+    :param on_page: Called with the routed entities of each page instead of accumulating them.
+    :param checkpoint: A CollectionCheckpoint to save every page in and resume from.
+    :return: A tuple of the routed entities and the pagination statistics.
+    """
+    started = time.perf_counter()
+    hits = policy_cache.hits
+    routed = {key: [] for key in ENTITY_KEYS}
+    pages = 0
+    records = 0
+
+    def handle_page(routed_page):
+        nonlocal pages, records
+        pages += 1
+        records += len(routed_page["Policies"])
+        if on_page is not None:
+            on_page(routed_page)
+            return
+        routed["Policies"].extend(routed_page["Policies"])
+
+    paginator = iam_client.get_paginator("list_policies")
+    paginate_kwargs = {"Scope": "AWS", "OnlyAttached": not include_unattached}
+    resumed_pages, done = _resume_pagination(checkpoint, "AWSManagedPolicy", paginate_kwargs, handle_page)
+    for page in ([] if done else paginator.paginate(**paginate_kwargs)):
+        routed_page = {key: [] for key in ENTITY_KEYS}
+        for policy in page.get("Policies", []):
+            # Add AWS managed policies if they are attached to IAM principals or if `--include-unattached` is specified
+            if not (policy["AttachmentCount"] > 0 or include_unattached):
+                continue
+            arn = policy.get("Arn")
+            default_version_id = policy.get("DefaultVersionId")
+            version = policy_cache.lookup(arn, default_version_id)
+            if version is None:
+                policy_version = iam_client.get_policy_version(
+                    PolicyArn=arn, VersionId=default_version_id)["PolicyVersion"]
+                version = {
+                    "Hash": policy_cache.put(arn,
+                                             default_version_id,
+                                             policy_version.get("Document"),
+                                             policy_version.get("CreateDate")),
+                    "CreateDate": policy_version.get("CreateDate"),
+                }
+            entry = _default_policy_version_entry(dict(policy, PolicyVersionList=[]))
+            entry["PolicyVersionList"] = [{
+                "VersionId": default_version_id,
+                "IsDefaultVersion": True,
+                "CreateDate": version["CreateDate"],
+                "DocumentHash": version["Hash"],
+            }]
+            routed_page["Policies"].append(entry)
+        if checkpoint is not None:
+            checkpoint.save_page("AWSManagedPolicy", routed_page, _next_marker(page))
+        handle_page(routed_page)
+    stats = {
+        "pages": pages,
+        "records": records,
+        "seconds": time.perf_counter() - started,
+        "cache_hits": policy_cache.hits - hits,
+    }
+    if resumed_pages:
+        stats["resumed_pages"] = resumed_pages
+    logger.info("Filter AWSManagedPolicy: %d page(s), %d cache hit(s) in %.2fs",
+                pages, stats["cache_hits"], stats["seconds"])
+    return routed, stats
+
+
+def collect_account_authorization_details(
+    iam_client,
+    include_non_default_policy_versions=False,
+    include_unattached=False,
+    strategy="concurrent",
+    max_workers=len(COLLECTION_FILTERS),
+    on_page=None,
+    policy_cache=None,
+    checkpoint=None
+):
+    """
+    Collect the account authorization details with one of the collection strategies.
+
+    The "concurrent" strategy paginates every filter at the same time on a bounded
+    thread pool. The "single-pass" strategy walks a single unfiltered pagination
+    and routes each page by entity type, which makes the fewest API calls.
+    Either way the results are merged in COLLECTION_FILTERS order, so the report
+    is the same as the one built by the sequential per-filter passes.
+
+    When on_page is given, the routed entities of each page are handed to it as the
+    page arrives, possibly from several threads, and the returned lists stay empty.
+
+    When policy_cache is given, the AWS managed policy documents are stored in it and
+    referenced by DocumentHash in the report. The "concurrent" strategy then lists the
+    AWS managed policies without their documents and only downloads the default
+    versions missing from the cache.
+
+    When checkpoint is given, every page is saved to it as it completes, and the pages
+    saved by an interrupted run are replayed before the pagination continues after them.
+
+    :param iam_client: A boto3 IAM client.
+    :param include_non_default_policy_versions: Keep every version of AWS managed policies.
+    :param include_unattached: Keep managed policies that are not attached to any principal.
+    :param strategy: One of COLLECTION_STRATEGIES.
+    :param max_workers: The maximum number of filters paginated at the same time.
+    :param on_page: Called with the routed entities of each page instead of accumulating them.
+    :param policy_cache: A PolicyDocumentCache for the AWS managed policy documents.
+    :param checkpoint: A CollectionCheckpoint to save every page in and resume from.
+    :return: A tuple of the results dict and the per-filter statistics.
+    """
+    if strategy not in COLLECTION_STRATEGIES:
+        raise ValueError(f"Unknown collection strategy: {strategy}")
+
+    results = {
+        "UserDetailList": [],
+        "GroupDetailList": [],
+        "RoleDetailList": [],
+        "Policies": [],
+    }
+    collection_stats = {}
+
+    if strategy == "single-pass":
+        routed, stats = _paginate_filter(
+            iam_client,
+            None,
+            include_non_default_policy_versions=include_non_default_policy_versions,
+            include_unattached=include_unattached,
+            on_page=on_page,
+            policy_cache=policy_cache,
+            checkpoint=checkpoint)
+        # Customer managed policies come before AWS managed policies in the report.
+        routed["Policies"].sort(key=_is_aws_managed_policy)
+        collection_stats["All"] = stats
+        for key, entities in routed.items():
+            results[key].extend(entities)
+        return results, collection_stats
+
+    # Paginate every filter at the same time; boto3 clients are thread safe.
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = {}
+        for filter_name in COLLECTION_FILTERS:
+            if (filter_name == "AWSManagedPolicy" and policy_cache is not None
+                    and not include_non_default_policy_versions):
+                # Only the default versions missing from the cache are downloaded.
+                futures[filter_name] = executor.submit(
+                    _paginate_cached_aws_managed_policies,
+                    iam_client,
+                    policy_cache,
+                    include_unattached=include_unattached,
+                    on_page=on_page,
+                    checkpoint=checkpoint)
+                continue
+            futures[filter_name] = executor.submit(
+                _paginate_filter,
+                iam_client,
+                filter_name,
+                include_non_default_policy_versions=include_non_default_policy_versions,
+                include_unattached=include_unattached,
+                on_page=on_page,
+                policy_cache=policy_cache,
+                checkpoint=checkpoint)
+        # Merge in filter order so the report is deterministic.
+        for filter_name in COLLECTION_FILTERS:
+            routed, stats = futures[filter_name].result()
+            collection_stats[filter_name] = stats
+            for key, entities in routed.items():
+                results[key].extend(entities)
+    return results, collection_stats
+
+
+def _open_report(path, mode, compression="none"):
+    """
+    Open a report file, compressing or decompressing it on the fly.
+
+    :param path: The path of the report file.
+    :param mode: The text mode to open the file with, "rt" or "wt".
+    :param compression: One of OUTPUT_COMPRESSIONS.
+    :return: A text file object.
+    """
+    if compression == "gzip":
+        return gzip.open(path, mode, encoding='utf-8')
+    if compression == "zstd":
+        # zstandard is only needed for zstd compressed reports.
+        try:
+            import zstandard as zstandard
+        except ImportError:
+            raise ValueError("zstd compression requires the zstandard package")
+        return zstandard.open(path, mode, encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+def _report_compression(path):
+    """
+    Guess the compression of a report file from its extension.
+
+    :param path: The path of the report file.
+    :return: One of OUTPUT_COMPRESSIONS.
+    """
+    for compression, extension in OUTPUT_COMPRESSIONS.items():
+        if extension and path.endswith(extension):
+            return compression
+    return "none"
+
+
+def stream_output_path(output, output_format, compression="none"):
+    """
+    Build the path of a streamed report from the path of the JSON report.
+
+    :param output: The path of the JSON report.
+    :param output_format: One of OUTPUT_FORMATS.
+    :param compression: One of OUTPUT_COMPRESSIONS.
+    :return: The path of the streamed report.
+    """
+    if output_format == "jsonl" and output.endswith('.json'):
+        output = output[:-len('.json')] + '.jsonl'
+    return output + OUTPUT_COMPRESSIONS[compression]
+
+
+class StreamingReportWriter:
+    """
+    Write report entities to disk as their pages arrive.
+
+    Every entity is written as {"List": <report list name>, "Entity": <entity>}, either
+    one per line ("jsonl") or as the elements of a JSON array with one element per
+    line ("json-stream"). Pages may be written from several threads.
+    """
+
+    def __init__(self, path, output_format="jsonl", compression="none"):
+        """
+        Open the streamed report.
+
+        :param path: The path of the streamed report.
+        :param output_format: "jsonl" or "json-stream".
+        :param compression: One of OUTPUT_COMPRESSIONS.
+        """
+        if output_format not in OUTPUT_FORMATS[1:]:
+            raise ValueError(f"Unknown streaming format: {output_format}")
+        self.path = path
+        self.output_format = output_format
+        self.counts = {
+            "UserDetailList": 0,
+            "GroupDetailList": 0,
+            "RoleDetailList": 0,
+            "Policies": 0,
+        }
+        self._lock = threading.Lock()
+        self._first = True
+        self._f = _open_report(path, 'wt', compression)
+        if output_format == "json-stream":
+            self._f.write('[\n')
+
+    def write_page(self, routed):
+        """
+        Write the routed entities of a page.
+
+        :param routed: A dict of report list name to entities.
+        """
+        lines = []
+        for key, entities in routed.items():
+            for entity in entities:
+                lines.append(json.dumps({"List": key, "Entity": entity}, default=str))
+        if not lines:
+            return
+        with self._lock:
+            for key, entities in routed.items():
+                self.counts[key] += len(entities)
+            if self.output_format == "jsonl":
+                self._f.write('\n'.join(lines) + '\n')
+            else:
+                # Separate the array elements, one element per line.
+                if not self._first:
+                    self._f.write(',\n')
+                self._f.write(',\n'.join(lines))
+            self._first = False
+
+    def close(self):
+        """
+        Terminate and close the streamed report.
+        """
+        if self.output_format == "json-stream":
+            self._f.write('\n]\n' if not self._first else ']\n')
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def iter_report_entities(path, list_name=None):
+    """
+    Read the entities of a report one by one.
+
+    Streamed reports ("jsonl" and "json-stream") are read line by line, so only
+    one entity is held in memory at a time. Plain JSON reports are loaded whole.
+
+    :param path: The path of the report, optionally gzip or zstd compressed.
+    :param list_name: Only yield the entities of this report list.
+    :return: A generator of (report list name, entity) tuples.
+    """
+    with _open_report(path, 'rt', _report_compression(path)) as f:
+        first_line = f.readline()
+        if first_line.strip() not in ('[', '') and not first_line.startswith('{"List"'):
+            # A report written by json.dump in the accumulate-then-dump format.
+            data = json.loads(first_line + f.read())
+            for key, entities in data.items():
+                if list_name is None or key == list_name:
+                    for entity in entities:
+                        yield key, entity
+            return
+        line = first_line
+        while line:
+            line = line.strip().rstrip(',')
+            if line not in ('[', ']', ''):
+                record = json.loads(line)
+                if list_name is None or record["List"] == list_name:
+                    yield record["List"], record["Entity"]
+            line = f.readline()
+
+
+def load_report(path, compact=False):
+    """
+    Load a report in any of the OUTPUT_FORMATS into the results dict.
+
+    :param path: The path of the report, optionally gzip or zstd compressed.
+    :param compact: Load the entities into a CompactReport instead of lists of dicts.
+    :return: A dict with the UserDetailList, GroupDetailList, RoleDetailList and Policies lists,
+      or a CompactReport with the same lists.
+    """
+    if compact:
+        results = CompactReport()
+        for key, entity in iter_report_entities(path):
+            results.add(key, entity)
+        results.finish()
+        return results
+    results = {
+        "UserDetailList": [],
+        "GroupDetailList": [],
+        "RoleDetailList": [],
+        "Policies": [],
+    }
+    for key, entity in iter_report_entities(path):
+        results[key].append(entity)
+    return results
+
+
+# The fields holding policy documents, they are stored once per CompactReport.
+DOCUMENT_FIELDS = ("PolicyDocument", "Document", "AssumeRolePolicyDocument")
+
+
+class CompactEntity:
+    """
+    A dict of a CompactReport, stored as the shared tuple of its keys and the tuple of its values.
+
+    Nested dicts are CompactEntity too, lists are tuples and policy documents are _DocumentRef.
+    """
+
+    __slots__ = ("shape", "values")
+
+    def __init__(self, shape, values):
+        """
+        :param shape: The keys of the dict, the same tuple object for every dict with those keys.
+        :param values: The compacted values of the dict, in the order of the keys.
+        """
+        self.shape = shape
+        self.values = values
+
+    def get(self, key, default=None):
+        """
+        Return the compacted value of a key.
+
+        :param key: A key of the dict.
+        :param default: Returned when the dict does not have the key.
+        :return: The value, still compacted.
+        """
+        try:
+            return self.values[self.shape.index(key)]
+        except ValueError:
+            return default
+
+
+class _DocumentRef:
+    """
+    A reference to a policy document of a CompactReport, one per distinct document.
+    """
+
+    __slots__ = ("id",)
+
+    def __init__(self, document_id):
+        self.id = document_id
+
+
+class CompactEntityList(collections_abc.Sequence):
+    """
+    A read-only view of one list of a CompactReport, every entity is rebuilt as a dict when accessed.
+    """
+
+    def __init__(self, report, list_name):
+        self._report = report
+        self._entities = report._entities[list_name]
+
+    def __len__(self):
+        return len(self._entities)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._report._expand(entity) for entity in self._entities[index]]
+        return self._report._expand(self._entities[index])
+
+    def field(self, key):
+        """
+        Read a string or number field of every entity, without rebuilding the dicts.
+
+        :param key: A top-level key of the entities, e.g. "Arn".
+        :return: A list of the values, None for the entities without the key.
+        """
+        return [entity.get(key) for entity in self._entities]
+
+
+class CompactReport(collections_abc.Mapping):
+    """
+    Hold the report lists with a fraction of the memory of lists of dicts.
+
+    The entities repeat the same keys, ARNs, names, paths, dates and policy documents
+    over and over. Every dict is stored as a slotted CompactEntity sharing its tuple of
+    keys with the dicts of the same shape, the strings and dates are interned in the
+    report so that equal values are a single object, and every distinct policy document
+    is stored once as compact JSON and referenced by ID.
+
+    The report is a read-only mapping of list name to a sequence of entity dicts, so it
+    can be passed anywhere the results dict is accepted, and to_results converts it back
+    to that dict losslessly. Pages may be added from several threads.
+    """
+
+    def __init__(self):
+        self._entities = {key: [] for key in ENTITY_KEYS}
+        self._shapes = {}
+        self._strings = {}
+        self._dates = {}
+        self._documents = []
+        self._document_refs = {}
+        self._lock = threading.Lock()
+
+    def add(self, list_name, entity):
+        """
+        Add an entity to one of the report lists.
+
+        :param list_name: A key of ENTITY_KEYS.
+        :param entity: The entity dict.
+        """
+        with self._lock:
+            self._entities[list_name].append(self._compact(entity))
+
+    def add_page(self, routed):
+        """
+        Add the routed entities of a page, usable as the on_page of collect_account_authorization_details.
+
+        :param routed: A dict of report list name to entities.
+        """
+        with self._lock:
+            for key, entities in routed.items():
+                self._entities[key].extend(self._compact(entity) for entity in entities)
+
+    def finish(self):
+        """
+        Put the customer managed policies before the AWS managed ones, as in the report.
+
+        The policies of concurrent filters are added as their pages arrive. The sort is
+        stable, so each group keeps the order it was added in.
+        """
+        with self._lock:
+            self._entities["Policies"].sort(
+                key=lambda policy: ":iam::aws:policy/" in (policy.get("Arn") or ""))
+
+    def _intern(self, value):
+        # A per-report table rather than sys.intern, the strings are freed with the report.
+        if type(value) is str:
+            return self._strings.setdefault(value, value)
+        if isinstance(value, datetime.datetime):
+            # Aware dates of different offsets compare equal, the key keeps the offset.
+            return self._dates.setdefault(value.isoformat(), value)
+        return value
+
+    def _document_ref(self, document):
+        text = json.dumps(document, separators=(',', ':'))
+        ref = self._document_refs.get(text)
+        if ref is None:
+            ref = _DocumentRef(len(self._documents))
+            self._documents.append(text)
+            self._document_refs[text] = ref
+        return ref
+
+    def _compact(self, value, key=None):
+        if isinstance(value, dict):
+            if key in DOCUMENT_FIELDS:
+                return self._document_ref(value)
+            shape = tuple(value)
+            shape = self._shapes.setdefault(shape, shape)
+            return CompactEntity(shape, tuple(self._compact(item, name) for name, item in value.items()))
+        if isinstance(value, list):
+            return tuple(self._compact(item) for item in value)
+        return self._intern(value)
+
+    def _expand(self, value):
+        if isinstance(value, CompactEntity):
+            return {key: self._expand(item) for key, item in zip(value.shape, value.values)}
+        if isinstance(value, tuple):
+            return [self._expand(item) for item in value]
+        if isinstance(value, _DocumentRef):
+            # Every access gets its own copy of the shared document.
+            return json.loads(self._documents[value.id])
+        return value
+
+    def __getitem__(self, list_name):
+        if list_name not in self._entities:
+            raise KeyError(list_name)
+        return CompactEntityList(self, list_name)
+
+    def __iter__(self):
+        return iter(self._entities)
+
+    def __len__(self):
+        return len(self._entities)
+
+    def to_results(self):
+        """
+        Convert the report back to the results dict.
+
+        :return: A dict with the UserDetailList, GroupDetailList, RoleDetailList and Policies lists.
+        """
+        return {key: list(entities) for key, entities in self.items()}
+
+    def stats(self):
+        """
+        Count what the report shares between its entities.
+
+        :return: A dict with the number of entities, shapes, distinct strings, dates and documents.
+        """
+        return {
+            "entities": sum(len(entities) for entities in self._entities.values()),
+            "shapes": len(self._shapes),
+            "strings": len(self._strings),
+            "dates": len(self._dates),
+            "documents": len(self._documents),
+        }
+
+
+def write_json_report(results, path):
+    """
+    Write the results in the pretty-printed JSON report format.
+
+    The output is the same as json.dump(results, f, indent=4, default=str), but every
+    entity is encoded on its own, so a CompactReport is only expanded one entity at a time.
+
+    :param results: The results dict or a CompactReport.
+    :param path: The path of the JSON report.
+    """
+    with open(path, 'w') as f:
+        f.write('{')
+        for n, (list_name, entities) in enumerate(results.items()):
+            f.write((',' if n else '') + '\n    ' + json.dumps(list_name) + ': [')
+            for i, entity in enumerate(entities):
+                text = json.dumps(entity, indent=4, default=str)
+                f.write((',' if i else '') + '\n        ' + text.replace('\n', '\n        '))
+            f.write('\n    ]' if len(entities) else ']')
+        f.write('\n}')
+
+
+def _entity_key(list_name, entity):
+    """
+    Build the snapshot key of an entity.
+
+    :param list_name: The name of the report list.
+    :param entity: The entity.
+    :return: The report list name and the entity id, or its ARN when it has no id.
+    """
+    return list_name, entity.get(ENTITY_KEYS[list_name]) or entity.get("Arn")
+
+
+def entity_fingerprint(list_name, entity):
+    """
+    Fingerprint an entity to detect changes between two snapshots.
+
+    Policies change with their default version and update date (and their usage
+    counts), so their documents are not hashed. Principals have no update date
+    and are hashed whole, except the fields in SNAPSHOT_IGNORED_FIELDS.
+
+    :param list_name: The name of the report list.
+    :param entity: The entity.
+    :return: The fingerprint.
+    """
+    if list_name == "Policies":
+        return '|'.join(str(entity.get(field)) for field in (
+            "DefaultVersionId",
+            "UpdateDate",
+            "AttachmentCount",
+            "PermissionsBoundaryUsageCount",
+        ))
+    content = {
+        key: value for key, value in entity.items()
+        if key not in SNAPSHOT_IGNORED_FIELDS
+    }
+    return hashlib.sha256(
+        json.dumps(content, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def snapshot_output_path(output):
+    """
+    Build the path of the snapshot of a report.
+
+    :param output: The path of the report, in any of the OUTPUT_FORMATS.
+    :return: The path of the snapshot.
+    """
+    return excel_output_path(output)[:-len('.xlsx')] + '.snapshot.jsonl'
+
+
+def checkpoint_output_path(output):
+    """
+    Build the path of the collection checkpoint of a report.
+
+    :param output: The path of the report, in any of the OUTPUT_FORMATS.
+    :return: The path of the checkpoint.
+    """
+    return excel_output_path(output)[:-len('.xlsx')] + '.checkpoint.jsonl'
+
+
+def delta_output_path(output):
+    """
+    Build the path of the delta of a report.
+
+    :param output: The path of the report, in any of the OUTPUT_FORMATS.
+    :return: The path of the delta.
+    """
+    return excel_output_path(output)[:-len('.xlsx')] + '.delta.jsonl'
+
+
+def _snapshot_line(list_name, entity):
+    """
+    Serialize the snapshot entry of an entity.
+
+    :param list_name: The name of the report list.
+    :param entity: The entity.
+    :return: A JSON line.
+    """
+    return json.dumps({
+        "List": list_name,
+        "Id": _entity_key(list_name, entity)[1],
+        "Arn": entity.get("Arn"),
+        "Fingerprint": entity_fingerprint(list_name, entity),
+    }) + '\n'
+
+
+def write_snapshot(entities, snapshot_path):
+    """
+    Write the snapshot of a report, one JSON line per entity.
+
+    :param entities: An iterable of (report list name, entity) tuples.
+    :param snapshot_path: The path of the snapshot.
+    :return: The number of entities in the snapshot.
+    """
+    count = 0
+    with open(snapshot_path, 'w', encoding='utf-8') as f:
+        for list_name, entity in entities:
+            f.write(_snapshot_line(list_name, entity))
+            count += 1
+    return count
+
+
+def load_snapshot_index(since):
+    """
+    Load the compact index of a previous snapshot.
+
+    The snapshot next to the previous report is read line by line. When there is
+    none, the previous report itself is streamed and fingerprinted, so only the
+    keys and fingerprints are held in memory either way.
+
+    :param since: The path of a previous report or of its snapshot.
+    :return: A dict of (report list name, entity id) to (fingerprint, ARN).
+    """
+    index = {}
+    snapshot_path = since if since.endswith('.snapshot.jsonl') else snapshot_output_path(since)
+    if os.path.exists(snapshot_path):
+        with open(snapshot_path, encoding='utf-8') as f:
+            for line in f:
+                entry = json.loads(line)
+                index[(entry["List"], entry["Id"])] = (entry["Fingerprint"], entry["Arn"])
+    elif os.path.exists(since):
+        for list_name, entity in iter_report_entities(since):
+            index[_entity_key(list_name, entity)] = (
+                entity_fingerprint(list_name, entity), entity.get("Arn"))
+    else:
+        logger.warning("No previous snapshot at %s, every entity is added", since)
+    return index
+
+
+class SnapshotDiffWriter:
+    """
+    Diff the entities against a previous snapshot as their pages arrive.
+
+    Added and changed entities are written to the delta as
+    {"Change": "added" | "changed", "List": <report list name>, "Entity": <entity>}
+    and removed entities as {"Change": "removed", "List": ..., "Entity": {"Id": ..., "Arn": ...}}.
+    The snapshot of the new run is written next to the delta, so the next run can diff
+    against it. Both are written to temporary files and only replace the previous ones
+    once the collection completes: an interrupted run keeps the previous snapshot, and
+    a resumed run diffs against it again. Pages may be written from several threads.
+    """
+
+    def __init__(self, since, delta_path, snapshot_path):
+        """
+        Load the previous snapshot and open the delta and the new snapshot.
+
+        :param since: The path of a previous report or of its snapshot.
+        :param delta_path: The path of the delta.
+        :param snapshot_path: The path of the new snapshot.
+        """
+        # Load the previous index before the new snapshot may overwrite it.
+        self._previous = load_snapshot_index(since)
+        self.delta_path = delta_path
+        self.snapshot_path = snapshot_path
+        self.changes = {"added": 0, "changed": 0, "removed": 0, "unchanged": 0}
+        self.counts = {key: 0 for key in ENTITY_KEYS}
+        self._lock = threading.Lock()
+        self._temporary_paths = {
+            path: f"{path}.{os.getpid()}.tmp" for path in (delta_path, snapshot_path)
+        }
+        self._delta = open(self._temporary_paths[delta_path], 'w', encoding='utf-8')
+        self._snapshot = open(self._temporary_paths[snapshot_path], 'w', encoding='utf-8')
+
+    def write_page(self, routed):
+        """
+        Diff the routed entities of a page.
+
+        :param routed: A dict of report list name to entities.
+        """
+        with self._lock:
+            for list_name, entities in routed.items():
+                self.counts[list_name] += len(entities)
+                for entity in entities:
+                    key = _entity_key(list_name, entity)
+                    fingerprint = entity_fingerprint(list_name, entity)
+                    previous = self._previous.pop(key, None)
+                    if previous is None:
+                        change = "added"
+                    elif previous[0] != fingerprint:
+                        change = "changed"
+                    else:
+                        change = "unchanged"
+                    self.changes[change] += 1
+                    if change != "unchanged":
+                        self._delta.write(json.dumps(
+                            {"Change": change, "List": list_name, "Entity": entity},
+                            default=str) + '\n')
+                    self._snapshot.write(_snapshot_line(list_name, entity))
+
+    def close(self):
+        """
+        Write the removed entities, and replace the delta and the snapshot with the new ones.
+        """
+        # Whatever is left of the previous snapshot was not seen in this run.
+        for (list_name, entity_id), (_, arn) in self._previous.items():
+            self.changes["removed"] += 1
+            self._delta.write(json.dumps(
+                {"Change": "removed", "List": list_name, "Entity": {"Id": entity_id, "Arn": arn}}) + '\n')
+        self._previous = {}
+        self._delta.close()
+        self._snapshot.close()
+        for path, temporary_path in self._temporary_paths.items():
+            os.replace(temporary_path, path)
+
+    def discard(self):
+        """
+        Drop the delta and the snapshot of an incomplete run, the previous ones are kept.
+        """
+        self._delta.close()
+        self._snapshot.close()
+        for temporary_path in self._temporary_paths.values():
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # The entities a failed collection did not reach are not removed.
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+def _create_session(profile, region, role_arn=None):
+    """
+    Create a boto3 session, optionally for an assumed role.
+
+    :param profile: Name of the profile in the AWS Credentials file.
+    :param region: The AWS region to execute in.
+    :param role_arn: The ARN of a role to assume with the profile.
+    :return: A boto3 session.
+    """
+    session = boto3.Session(profile_name=profile,
+                            region_name=region)
+    if role_arn is None:
+        return session
+
+    # Assume the role with the credentials of the profile.
+    sts_client = session.client("sts",
+                                config=Config(connect_timeout=5,
+                                              retries={"max_attempts": 10}))
+    credentials = sts_client.assume_role(
+        RoleArn=role_arn,
+        RoleSessionName="AccountAuthorizationDetailReport")["Credentials"]
+    return boto3.Session(aws_access_key_id=credentials["AccessKeyId"],
+                         aws_secret_access_key=credentials["SecretAccessKey"],
+                         aws_session_token=credentials["SessionToken"],
+                         region_name=region)
+
+
+def _create_iam_client(profile, region, role_arn=None):
+    """
+    Create the IAM client of a report.
+
+    :param profile: Name of the profile in the AWS Credentials file.
+    :param region: The AWS region to execute in.
+    :param role_arn: The ARN of a role to assume with the profile.
+    :return: A boto3 IAM client.
+    """
+    config = Config(connect_timeout=5,
+                    retries={"max_attempts": 10})
+    # Create a boto3 session
+    session = _create_session(profile, region, role_arn=role_arn)
+    # Create an IAM client
+    return session.client("iam",
+                          config=config,
+                          use_ssl=True,
+                          verify=True
+                          )
+
+
+@dataclasses.dataclass(frozen=True)
+class EntityRecord:
+    """
+    An entity of the report, as yielded by iter_account_authorization_details.
+
+    The entity is the dict returned by get_account_authorization_details, the other
+    fields are taken from it so consumers do not need to know the report lists.
+    """
+
+    list_name: str
+    entity_type: str
+    id: str
+    name: str
+    arn: str
+    entity: dict
+    account: typing.Optional[str] = None
+
+    @classmethod
+    def from_entity(cls, list_name, entity, account=None):
+        """
+        Build the record of an entity.
+
+        :param list_name: The name of the report list.
+        :param entity: The entity.
+        :param account: The label of the account of the entity.
+        :return: An EntityRecord.
+        """
+        entity_type = SHEET_PREFIXES[list_name]
+        return cls(list_name=list_name,
+                   entity_type=entity_type,
+                   id=entity.get(ENTITY_KEYS[list_name]),
+                   name=entity.get(f"{entity_type}Name"),
+                   arn=entity.get("Arn"),
+                   entity=entity,
+                   account=account)
+
+
+class _StreamClosed(Exception):
+    """
+    Raised in the collection threads once the consumer of a _PageStream is gone.
+    """
+
+
+class _PageStream:
+    """
+    Run a collection on a background thread and hand its routed pages over one by one.
+
+    The pages go through a bounded queue, so a slow consumer slows the collection down
+    instead of letting the pages pile up in memory. Closing the stream stops the
+    collection at its next page. Once the last page is handed over, stats holds the
+    per-filter statistics of the collection.
+    """
+
+    def __init__(self, iam_client, max_pages=8, **collect_kwargs):
+        """
+        Start the collection.
+
+        :param iam_client: A boto3 IAM client.
+        :param max_pages: The number of pages collected ahead of the consumer.
+        :param collect_kwargs: Passed through to collect_account_authorization_details.
+        """
+        self._pages = queue.Queue(maxsize=max(1, max_pages))
+        self.stats = None
+        self._closed = threading.Event()
+        self._done = object()
+        self._thread = threading.Thread(target=self._collect,
+                                        args=(iam_client, collect_kwargs),
+                                        name="iam-collection",
+                                        daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._closed.is_set():
+            try:
+                self._pages.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+        raise _StreamClosed()
+
+    def _collect(self, iam_client, collect_kwargs):
+        try:
+            _, self.stats = collect_account_authorization_details(
+                iam_client, on_page=self._put, **collect_kwargs)
+            item = self._done
+        except _StreamClosed:
+            return
+        except Exception as e:
+            # Hand the failure over to the consumer, like a page.
+            item = e
+        try:
+            self._put(item)
+        except _StreamClosed:
+            pass
+
+    def next_page(self):
+        """
+        Wait for the next page. Safe to call from any thread.
+
+        :return: The routed entities of the page, or None once the collection is complete or the stream closed.
+        """
+        while not self._closed.is_set():
+            try:
+                item = self._pages.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is self._done:
+                return None
+            if isinstance(item, Exception):
+                raise item
+            return item
+        return None
+
+    def close(self):
+        """
+        Stop the collection. Safe to call from any thread.
+        """
+        self._closed.set()
+
+
+def _page_records(routed, account=None):
+    """
+    Turn the routed entities of a page into records.
+
+    :param routed: A dict of report list name to entities.
+    :param account: The label of the account of the entities.
+    :return: A generator of EntityRecord.
+    """
+    for list_name, entities in routed.items():
+        for entity in entities:
+            yield EntityRecord.from_entity(list_name, entity, account)
+
+
+def _stream_records(stream, account=None):
+    """
+    Hand the pages of a _PageStream over as records, closing the stream once they stop.
+
+    :param stream: A _PageStream.
+    :param account: The label of the account of the entities.
+    :return: A generator of EntityRecord.
+    """
+    try:
+        routed = stream.next_page()
+        while routed is not None:
+            yield from _page_records(routed, account)
+            routed = stream.next_page()
+    finally:
+        stream.close()
+
+
+def _open_page_stream(iam_client, profile, region, role_arn, policy_cache, rate_limiter, max_pages, collect_kwargs):
+    """
+    Create the client of a library stream when needed and start its collection.
+
+    :param iam_client: A boto3 IAM client, created from the profile, region and role_arn when None.
+    :param profile: Name of the profile in the AWS Credentials file.
+    :param region: The AWS region to execute in.
+    :param role_arn: The ARN of a role to assume with the profile.
+    :param policy_cache: A PolicyDocumentCache, or the path of its directory.
+    :param rate_limiter: An AdaptiveRateLimiter to pace the IAM calls with.
+    :param max_pages: The number of pages collected ahead of the consumer.
+    :param collect_kwargs: Passed through to collect_account_authorization_details.
+    :return: A tuple of the _PageStream and the account label of its records.
+    """
+    if iam_client is None:
+        iam_client = _create_iam_client(profile, region, role_arn=role_arn)
+    if rate_limiter is not None:
+        rate_limiter.attach(iam_client)
+    if isinstance(policy_cache, str):
+        policy_cache = PolicyDocumentCache(policy_cache)
+    account = _account_label(profile, role_arn) if profile is not None or role_arn is not None else None
+    stream = _PageStream(iam_client, max_pages=max_pages, policy_cache=policy_cache, **collect_kwargs)
+    return stream, account
+
+
+def iter_account_authorization_details(
+    iam_client=None,
+    profile=None,
+    region=None,
+    role_arn=None,
+    include_non_default_policy_versions=False,
+    include_unattached=False,
+    collection_strategy="concurrent",
+    max_workers=len(COLLECTION_FILTERS),
+    policy_cache=None,
+    rate_limiter=None,
+    checkpoint=None,
+    max_pages=8
+):
+    """
+    Yield the entities of the account authorization details as their pages arrive.
+
+    Nothing is printed nor written: the records are handed over as the collection
+    runs on a background thread, at most max_pages ahead of the consumer. Stopping
+    the iteration stops the collection. The records come in page order, the pages of
+    the concurrent filters interleaved, instead of the report order.
+
+    :param iam_client: A boto3 IAM client, created from the profile, region and role_arn when None.
+    :param profile: Name of the profile in the AWS Credentials file.
+    :param region: The AWS region to execute in.
+    :param role_arn: The ARN of a role to assume with the profile.
+    :param include_non_default_policy_versions: Keep every version of AWS managed policies.
+    :param include_unattached: Keep managed policies that are not attached to any principal.
+    :param collection_strategy: One of COLLECTION_STRATEGIES.
+    :param max_workers: The maximum number of filters paginated at the same time.
+    :param policy_cache: A PolicyDocumentCache, or the path of its directory.
+    :param rate_limiter: An AdaptiveRateLimiter to pace the IAM calls with.
+    :param checkpoint: A CollectionCheckpoint to save every page in and resume from.
+    :param max_pages: The number of pages collected ahead of the consumer.
+    :return: A generator of EntityRecord.
+    """
+    stream, account = _open_page_stream(
+        iam_client, profile, region, role_arn, policy_cache, rate_limiter, max_pages, {
+            "include_non_default_policy_versions": include_non_default_policy_versions,
+            "include_unattached": include_unattached,
+            "strategy": collection_strategy,
+            "max_workers": max_workers,
+            "checkpoint": checkpoint,
+        })
+    yield from _stream_records(stream, account)
+
+
+async def aiter_account_authorization_details(
+    iam_client=None,
+    profile=None,
+    region=None,
+    role_arn=None,
+    include_non_default_policy_versions=False,
+    include_unattached=False,
+    collection_strategy="concurrent",
+    max_workers=len(COLLECTION_FILTERS),
+    policy_cache=None,
+    rate_limiter=None,
+    checkpoint=None,
+    max_pages=8
+):
+    """
+    Yield the entities of the account authorization details as their pages arrive, asynchronously.
+
+    The collection runs on a background thread like iter_account_authorization_details,
+    the event loop only waits for whole pages, on its default executor.
+
+    :param iam_client: A boto3 IAM client, created from the profile, region and role_arn when None.
+    :param profile: Name of the profile in the AWS Credentials file.
+    :param region: The AWS region to execute in.
+    :param role_arn: The ARN of a role to assume with the profile.
+    :param include_non_default_policy_versions: Keep every version of AWS managed policies.
+    :param include_unattached: Keep managed policies that are not attached to any principal.
+    :param collection_strategy: One of COLLECTION_STRATEGIES.
+    :param max_workers: The maximum number of filters paginated at the same time.
+    :param policy_cache: A PolicyDocumentCache, or the path of its directory.
+    :param rate_limiter: An AdaptiveRateLimiter to pace the IAM calls with.
+    :param checkpoint: A CollectionCheckpoint to save every page in and resume from.
+    :param max_pages: The number of pages collected ahead of the consumer.
+    :return: An async generator of EntityRecord.
+    """
+    import asyncio as asyncio
+    loop = asyncio.get_running_loop()
+    # Creating the client may assume a role, keep it off the event loop too.
+    stream, account = await loop.run_in_executor(None, functools.partial(
+        _open_page_stream, iam_client, profile, region, role_arn, policy_cache, rate_limiter, max_pages, {
+            "include_non_default_policy_versions": include_non_default_policy_versions,
+            "include_unattached": include_unattached,
+            "strategy": collection_strategy,
+            "max_workers": max_workers,
+            "checkpoint": checkpoint,
+        }))
+    try:
+        routed = await loop.run_in_executor(None, stream.next_page)
+        while routed is not None:
+            for record in _page_records(routed, account):
+                yield record
+            routed = await loop.run_in_executor(None, stream.next_page)
+    finally:
+        stream.close()
+
+
+def print_progress(records, every=1000):
+    """
+    Print the progress of a record stream while passing its records through.
+
+    :param records: An iterable of EntityRecord.
+    :param every: Print a line every this many records.
+    :return: A generator of the same records.
+    """
+    counts = {}
+    for number, record in enumerate(records, start=1):
+        counts[record.entity_type] = counts.get(record.entity_type, 0) + 1
+        if number % every == 0:
+            print(emoji.emojize(f":stopwatch:  {number} record(s) collected.", language='alias'))
+        yield record
+    print(
+        emoji.emojize(
+            ":white_check_mark:  Collected " + ', '.join(
+                f"{count} {entity_type.lower()}(s)" for entity_type, count in counts.items()) + ".",
+            language='alias',
+        )
+    )
+
+
+def write_records(records, path, output_format="jsonl", compression="none"):
+    """
+    Write a record stream to a streamed report.
+
+    :param records: An iterable of EntityRecord.
+    :param path: The path of the streamed report.
+    :param output_format: "jsonl" or "json-stream".
+    :param compression: One of OUTPUT_COMPRESSIONS.
+    :return: A dict of report list name to the number of entities written.
+    """
+    with StreamingReportWriter(path, output_format=output_format, compression=compression) as writer:
+        for record in records:
+            writer.write_page({record.list_name: [record.entity]})
+    return writer.counts
+
+
+def results_from_records(records, compact=False):
+    """
+    Gather a record stream into the results dict of the report.
+
+    :param records: An iterable of EntityRecord.
+    :param compact: Gather the records into a CompactReport instead of lists of dicts.
+    :return: A dict with the UserDetailList, GroupDetailList, RoleDetailList and Policies lists,
+      as accepted by export_excel_report, export_backends and build_permission_index. The
+      customer managed policies come before the AWS managed ones either way.
+    """
+    if compact:
+        results = CompactReport()
+        for record in records:
+            results.add(record.list_name, record.entity)
+        results.finish()
+        return results
+    results = {key: [] for key in ENTITY_KEYS}
+    for record in records:
+        results[record.list_name].append(record.entity)
+    # As CompactReport.finish, the customer managed policies before the AWS managed ones.
+    results["Policies"].sort(key=_is_aws_managed_policy)
+    return results
+
+
+def get_account_authorization_details(
+    profile,
+    output,
+    region,
+    include_non_default_policy_versions=False,
+    include_unattached=False,
+    open_in_excel=False,
+    flatten_json=False,
+    json_only=False,
+    collection_strategy="concurrent",
+    max_workers=len(COLLECTION_FILTERS),
+    role_arn=None,
+    output_format="json",
+    compression="none",
+    backends=(),
+    dataset=None,
+    since=None,
+    policy_cache=None,
+    policy_cache_max_bytes=256 * 1024 * 1024,
+    metrics=None,
+    iam_client=None,
+    checkpoint=False,
+    rate_limiter=None,
+    permission_index=False,
+    expand_actions=False,
+    action_catalog=None,
+    compact=False,
+    normalize_workers=None,
+    normalize_chunk_size=NORMALIZE_CHUNK_SIZE
+):
+    """
+    Run aws iam get-account-authorization-details and store locally.
+    :param profile: Name of the profile in the AWS Credentials file
+    :param output: The path of a directory to store the results.
+    :param include_non_default_policy_versions: When downloading AWS managed policy documents,
+      also include the non-default policy versions. Note that this will dramatically increase 
+      the size of the downloaded file.
+    :param json_only: Skip the Excel report, so pandas and openpyxl are never imported.
+    :param collection_strategy: One of COLLECTION_STRATEGIES, see collect_account_authorization_details.
+    :param max_workers: The maximum number of filters paginated at the same time.
+    :param role_arn: The ARN of a role to assume with the profile before collecting.
+    :param output_format: One of OUTPUT_FORMATS. The streamed formats write each entity as its page arrives.
+    :param compression: One of OUTPUT_COMPRESSIONS, only used by the streamed formats.
+    :param backends: Names of OUTPUT_BACKENDS to run next to the JSON and Excel reports.
+    :param dataset: The path of the backend datasets without extension, defaults to the output without .json.
+    :param since: The path of a previous report or snapshot. Only the added, removed and changed
+      entities are written, to a delta next to the output, instead of the full report.
+    :param policy_cache: The directory of a PolicyDocumentCache. The AWS managed policy documents
+      are stored in it and referenced by DocumentHash in the report.
+    :param policy_cache_max_bytes: The size past which the policy document cache is evicted.
+    :param metrics: A RunMetrics to record the stages and the API calls of the report in.
+    :param iam_client: An IAM client to use instead of creating one from the profile.
+    :param checkpoint: Save the progress of the collection next to the output after every page,
+      and resume from the checkpoint of an interrupted run. It is removed once the report is written.
+    :param rate_limiter: An AdaptiveRateLimiter to pace the IAM calls of the account with.
+    :param permission_index: Build the effective-permission index of the report next to the output.
+    :param expand_actions: Write the expanded, deduplicated action sets of every policy next to the output.
+    :param action_catalog: The path of the service-action catalog the actions are expanded against.
+    :param compact: Hold the report in memory as a CompactReport instead of lists of dicts.
+    :param normalize_workers: The number of worker processes the Excel tables are built in, see normalize_tables.
+    :param normalize_chunk_size: The number of entities normalized by a worker at a time.
+    :return: A summary of the report with the output path and the number of records per list.
+    """
+    print()
+    print(emoji.emojize(
+        ":heavy_exclamation_mark:  Starting report generation.",
+        language='alias'))
+
+    if iam_client is None:
+        iam_client = _create_iam_client(profile, region, role_arn=role_arn)
+    if metrics is not None:
+        metrics.instrument_client(iam_client)
+    if rate_limiter is not None:
+        rate_limiter.attach(iam_client)
+
+    collect_kwargs = {
+        "include_non_default_policy_versions": include_non_default_policy_versions,
+        "include_unattached": include_unattached,
+        "strategy": collection_strategy,
+        "max_workers": max_workers,
+    }
+    if policy_cache is not None:
+        collect_kwargs["policy_cache"] = PolicyDocumentCache(policy_cache,
+                                                             max_bytes=policy_cache_max_bytes)
+    if checkpoint:
+        # A checkpoint of other collection options cannot be resumed.
+        collect_kwargs["checkpoint"] = CollectionCheckpoint(
+            checkpoint_output_path(output),
+            {
+                "include_non_default_policy_versions": include_non_default_policy_versions,
+                "include_unattached": include_unattached,
+                "strategy": collection_strategy,
+                "policy_cache": policy_cache,
+                "output_format": output_format,
+                "since": since,
+            })
+        if collect_kwargs["checkpoint"].resumed:
+            print(emoji.emojize(
+                f":repeat:  Resuming the collection from {collect_kwargs['checkpoint'].path}.",
+                language='alias'))
+
+    with _stage(metrics, "collect") as stage:
+        # Every output consumes the record stream of the collection, as the library does.
+        stream = _PageStream(iam_client, **collect_kwargs)
+        entity_records = print_progress(_stream_records(stream, _account_label(profile, role_arn)))
+        if since is not None:
+            # Diff the records against the previous snapshot as they arrive, without a full report.
+            with SnapshotDiffWriter(since,
+                                    delta_output_path(output),
+                                    snapshot_output_path(output)) as diff:
+                for record in entity_records:
+                    diff.write_page({record.list_name: [record.entity]})
+            records = diff.counts
+            report_path = diff.delta_path
+        elif output_format == "json":
+            # Gather the records into the report, compacted as they arrive with compact.
+            results = results_from_records(entity_records, compact=compact)
+            records = {key: len(entities) for key, entities in results.items()}
+            report_path = output
+        else:
+            # Stream the account authorization details report to disk as the records arrive.
+            report_path = stream_output_path(output, output_format, compression)
+            records = write_records(entity_records, report_path,
+                                    output_format=output_format,
+                                    compression=compression)
+        collection_stats = stream.stats
+        stage["rows"] = sum(records.values())
+    if metrics is not None:
+        metrics.add_collection(_account_label(profile, role_arn), collection_stats)
+
+    # Display the per-filter page counts and timings.
+    for filter_name, stats in collection_stats.items():
+        print(
+            emoji.emojize(
+                f":stopwatch:  {filter_name}: {stats['pages']} page(s), "
+                f"{stats['records']} record(s) in {stats['seconds']:.2f}s.",
+                language='alias',
+            )
+        )
+    if policy_cache is not None:
+        # Keep the shared policy document cache within its size.
+        cache = collect_kwargs["policy_cache"]
+        cache.evict()
+        print(
+            emoji.emojize(
+                f":package:  Policy document cache: {cache.hits} hit(s), {cache.misses} miss(es).",
+                language='alias',
+            )
+        )
+
+    if since is not None:
+        if checkpoint:
+            collect_kwargs["checkpoint"].discard()
+        # Let the user know what changed since the previous snapshot.
+        print(
+            emoji.emojize(
+                f":white_check_mark:  Delta written to {diff.delta_path}: "
+                f"{diff.changes['added']} added, {diff.changes['changed']} changed, "
+                f"{diff.changes['removed']} removed since {since}.",
+                language='alias',
+            )
+        )
+        return {
+            "output": report_path,
+            "snapshot": diff.snapshot_path,
+            "changes": diff.changes,
+            "records": records,
+            "collection": collection_stats,
+        }
+
+    # Let the user know that the report is complete.
+    print(emoji.emojize(":white_check_mark:  JSON Report generation complete.",
+                        language='alias'))
+
+    if output_format == "json":
+        # Write the results to a file.
+        with _stage(metrics, "write_json"):
+            write_json_report(results, output)
+    print(
+        emoji.emojize(
+            f":white_check_mark:  Report written to {report_path}.",
+            language='alias',
+        )
+    )
+    if checkpoint:
+        # The report holds every page now, the next run starts over.
+        collect_kwargs["checkpoint"].discard()
+
+    needs_results = backends or permission_index or expand_actions
+    if output_format != "json" and not needs_results:
+        # Nothing needs the whole report in memory, the Excel export and the snapshot
+        # stream it back.
+        results = None
+    elif output_format != "json":
+        # read the entities back from the streamed report
+        with _stage(metrics, "load_report") as stage:
+            results = load_report(report_path, compact=compact)
+            stage["rows"] = sum(len(entities) for entities in results.values())
+    if compact and results is not None:
+        _print_compact_report(results)
+
+    # Convert the report to Excel without reading it back when it is still in memory.
+    excel_output = excel_output_path(output)
+    if not json_only:
+        export_excel_report(results, excel_output,
+                            flatten_json=flatten_json,
+                            max_workers=normalize_workers,
+                            chunk_size=normalize_chunk_size,
+                            metrics=metrics,
+                            report_path=report_path if results is None else None)
+
+    # Keep a snapshot next to the report, so a later --since run can diff against it.
+    with _stage(metrics, "snapshot") as stage:
+        if results is None:
+            entities = iter_report_entities(report_path)
+        else:
+            entities = ((list_name, entity)
+                        for list_name, entities in results.items() for entity in entities)
+        stage["rows"] = write_snapshot(entities, snapshot_output_path(output))
+
+    # Run the extra output backends, several accounts may share the same dataset.
+    if dataset is None:
+        dataset = output[:-len('.json')] if output.endswith('.json') else output
+    destinations = export_backends(results, backends, dataset,
+                                   _account_label(profile, role_arn), metrics=metrics,
+                                   policy_cache=collect_kwargs.get("policy_cache"))
+
+    # Resolve the permissions of every principal, so the query subcommand never reads the report.
+    if permission_index:
+        with _stage(metrics, "permission_index") as stage:
+            stage["rows"] = build_permission_index(results,
+                                                   permission_index_path(output),
+                                                   collect_kwargs.get("policy_cache"))["grants"]
+
+    # Expand the action patterns of every policy against the service-action catalog.
+    if expand_actions:
+        with _stage(metrics, "expand_actions") as stage:
+            stage["rows"] = export_expanded_actions(results,
+                                                    expanded_actions_path(output),
+                                                    ActionExpander(load_action_catalog(action_catalog)),
+                                                    collect_kwargs.get("policy_cache"))["policies"]
+
+    # open the excel file
+    if open_in_excel and not json_only:
+        open_in_spreadsheet(excel_output)
+
+    return {
+        "output": report_path,
+        "backends": destinations,
+        "records": records,
+        "collection": collection_stats,
+    }
+
+
+def excel_output_path(output):
+    """
+    Build the path of the Excel report from the path of the JSON report.
+
+    :param output: The path of the JSON report, in any of the OUTPUT_FORMATS.
+    :return: The path of the Excel report.
+    """
+    compression = _report_compression(output)
+    if compression != "none":
+        output = output[:-len(OUTPUT_COMPRESSIONS[compression])]
+    for extension in ('.jsonl', '.json'):
+        if output.endswith(extension):
+            return output[:-len(extension)] + '.xlsx'
+    return output + '.xlsx'
+
+
+def _excel_value(value):
+    """
+    Convert a dataframe cell to a value that Excel accepts.
+
+    :param value: A dataframe cell.
+    :return: The cell value, nested fields as JSON and dates as in the JSON report.
+    """
+    if value is None:
+        return None
+    if isinstance(value, (float, datetime.datetime)) and value != value:
+        # NaN and pandas NaT, the only values that differ from themselves.
+        return None
+    if isinstance(value, (list, dict)):
+        value = json.dumps(value, default=str)
+    elif isinstance(value, (datetime.datetime, datetime.date)):
+        # Excel does not support time zones, write the dates as the JSON report does.
+        return str(value)
+    if isinstance(value, str) and len(value) > EXCEL_MAX_CELL_LENGTH:
+        # Excel rejects longer cells, the JSON report keeps the full value.
+        return value[:EXCEL_MAX_CELL_LENGTH]
+    return value
+
+
+def _normalize_chunk(list_name, entities, flatten_json=False, start=0):
+    """
+    Normalize a chunk of a report list into tables, in a worker process of normalize_tables.
+
+    :param list_name: The name of the report list.
+    :param entities: The entities of the chunk.
+    :param flatten_json: Split the list fields into child tables.
+    :param start: The position of the first entity of the chunk in the report list.
+    :return: A tuple of the dict of table name to dataframe and the dict of table name
+      to the names of its child tables.
+    """
+    import pandas as pd
+    if flatten_json:
+        children = {}
+        return flatten_to_tables(entities, list_name, start=start, children=children), children
+    return {list_name: pd.json_normalize(entities) if entities else pd.DataFrame()}, {}
+
+
+def _report_chunks(results, chunk_size, report_path=None):
+    """
+    Split the report lists into chunks of entities for normalize_tables.
+
+    The entities are sliced out of results, or read from a saved report in a single
+    pass when report_path is given, so at most one unfinished chunk of every report
+    list is held in memory. The chunks of a report list come in report order.
+
+    :param results: A dict of report list name to entities, or a CompactReport.
+    :param chunk_size: The number of entities in a chunk.
+    :param report_path: The path of a saved report to read the entities from instead.
+    :return: A generator of (report list name, start index, entities) tuples. An empty
+      report list still gets an empty chunk, so its table exists.
+    """
+    if report_path is None:
+        for list_name in ENTITY_KEYS:
+            entities = results.get(list_name, [])
+            for start in range(0, max(len(entities), 1), chunk_size):
+                yield list_name, start, list(entities[start:start + chunk_size])
+        return
+    chunks = {list_name: [] for list_name in ENTITY_KEYS}
+    starts = dict.fromkeys(ENTITY_KEYS, 0)
+    for list_name, entity in iter_report_entities(report_path):
+        chunk = chunks[list_name]
+        chunk.append(entity)
+        if len(chunk) == chunk_size:
+            yield list_name, starts[list_name], chunk
+            starts[list_name] += chunk_size
+            chunks[list_name] = []
+    for list_name in ENTITY_KEYS:
+        if chunks[list_name] or not starts[list_name]:
+            yield list_name, starts[list_name], chunks[list_name]
+
+
+def normalize_tables(
+    results,
+    flatten_json=False,
+    max_workers=None,
+    chunk_size=NORMALIZE_CHUNK_SIZE,
+    metrics=None,
+    report_path=None
+):
+    """
+    Normalize the report lists into tables in parallel worker processes.
+
+    Every report list is split into chunks of chunk_size entities, and the chunks are
+    normalized by a pool of worker processes, at most twice as many chunks in flight as
+    workers so only those are expanded in memory. A report of at most
+    NORMALIZE_PARALLEL_CHUNKS chunks of entities is normalized in this process. The
+    workers are started with forkserver, or spawn where it is missing, never forked from
+    a process whose other threads may hold locks. The chunk tables are not concatenated:
+    every table is the list of its chunk parts in report order, which the Excel export
+    streams one after the other. combine_tables concatenates them when needed.
+
+    :param results: A dict of report list name to entities, or a CompactReport.
+      None when report_path is given.
+    :param flatten_json: Split the list fields into child tables keyed back to their parent rows.
+    :param max_workers: The number of worker processes, the number of CPUs by default.
+      0 or 1 normalizes in this process.
+    :param chunk_size: The number of entities normalized by a worker at a time.
+    :param metrics: A RunMetrics to record the excel.flatten or excel.json_normalize stage in.
+    :param report_path: Read the entities from this saved report a chunk at a time
+      instead of from results, see _report_chunks.
+    :return: A dict of table name to list of dataframes.
+    """
+    chunk_size = max(1, chunk_size)
+    chunks = _report_chunks(results, chunk_size, report_path=report_path)
+    chunk_count = 0
+
+    parts = {}
+    children = {}
+
+    def add(normalized):
+        tables, chunk_children = normalized
+        for table_name, table in tables.items():
+            parts.setdefault(table_name, []).append(table)
+        for table_name, names in chunk_children.items():
+            merged = children.setdefault(table_name, [])
+            merged.extend(name for name in names if name not in merged)
+
+    workers = (os.cpu_count() or 1) if max_workers is None else max_workers
+    if workers > 1:
+        # Look ahead, a small report does not start the worker processes.
+        buffered = []
+        entity_count = 0
+        for chunk in chunks:
+            buffered.append(chunk)
+            entity_count += len(chunk[2])
+            if entity_count > NORMALIZE_PARALLEL_CHUNKS * chunk_size:
+                break
+        else:
+            workers = 1
+        chunks = itertools.chain(buffered, chunks)
+    with _stage(metrics, "excel.flatten" if flatten_json else "excel.json_normalize") as stage:
+        if workers <= 1:
+            for list_name, start, entities in chunks:
+                chunk_count += 1
+                add(_normalize_chunk(list_name, entities, flatten_json, start))
+        else:
+            start_methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context(
+                "forkserver" if "forkserver" in start_methods else "spawn")
+            with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+                pending = []
+                for list_name, start, entities in chunks:
+                    chunk_count += 1
+                    pending.append(executor.submit(
+                        _normalize_chunk, list_name, entities, flatten_json, start))
+                    if len(pending) >= 2 * workers:
+                        # Take the chunks in order, the tables keep the report order.
+                        add(pending.pop(0).result())
+                for future in pending:
+                    add(future.result())
+        stage["rows"] = sum(len(table) for tables in parts.values() for table in tables)
+    logger.info("Normalized %d chunk(s) with %d worker(s)",
+                chunk_count, max(1, min(workers, chunk_count)))
+
+    # A later chunk can find child tables the first one had no rows for: order the tables
+    # as a single chunk does, every table followed by its child tables, depth first.
+    ordered = {}
+
+    def visit(table_name):
+        if table_name in parts and table_name not in ordered:
+            ordered[table_name] = parts[table_name]
+        for child in children.get(table_name, []):
+            visit(child)
+
+    for list_name in ENTITY_KEYS:
+        visit(list_name)
+    return ordered
+
+
+def combine_tables(parts):
+    """
+    Concatenate the chunk parts of the tables built by normalize_tables.
+
+    :param parts: A dict of table name to list of dataframes.
+    :return: A dict of table name to dataframe.
+    """
+    import pandas as pd
+    return {
+        table_name: tables[0] if len(tables) == 1 else pd.concat(tables, ignore_index=True)
+        for table_name, tables in parts.items()
+    }
+
+
+def _write_sheets(workbook, table_name, parts, used, max_rows_per_sheet=EXCEL_MAX_ROWS):
+    """
+    Write a table to one or more sheets of a write-only workbook.
+
+    :param workbook: A write-only openpyxl workbook.
+    :param table_name: The name of the table.
+    :param parts: The dataframes of the table, written one after the other under the union of their columns.
+    :param used: The set of sheet names already in the workbook, updated in place.
+    :param max_rows_per_sheet: Roll over to a new sheet past this number of rows, header included.
+    :return: The number of sheets written.
+    """
+    columns = list(dict.fromkeys(column for part in parts for column in part.columns))
+    header = [str(column) for column in columns]
+    rows = (
+        row
+        for part in parts
+        # Only a part missing some of the columns is copied, to add them empty.
+        for row in (part if list(part.columns) == columns else part.reindex(columns=columns))
+        .itertuples(index=False, name=None)
+    )
+    rows_per_sheet = max(1, max_rows_per_sheet - 1)
+    sheets = 0
+    sheet = None
+    for row_number, row in enumerate(rows):
+        if row_number % rows_per_sheet == 0:
+            # Roll over to a new sheet, "<sheet> (2)", "<sheet> (3)", ...
+            sheets += 1
+            sheet = workbook.create_sheet(_sheet_name(table_name, used, part=sheets))
+            sheet.append(header)
+        sheet.append([_excel_value(value) for value in row])
+    if sheet is None:
+        # Keep an empty sheet with the header for empty tables.
+        sheets = 1
+        workbook.create_sheet(_sheet_name(table_name, used)).append(header)
+    return sheets
+
+
+def export_excel_report(
+    results,
+    excel_output,
+    flatten_json=False,
+    max_workers=None,
+    max_rows_per_sheet=EXCEL_MAX_ROWS,
+    metrics=None,
+    chunk_size=NORMALIZE_CHUNK_SIZE,
+    report_path=None
+):
+    """
+    Convert the report lists to an Excel workbook.
+
+    Every report list gets its own sheet, and with flatten_json every list field gets
+    its own child sheet. The tables of the report lists are built in parallel worker
+    processes by normalize_tables and streamed to a write-only workbook, which rolls a
+    sheet over past the Excel row limit.
+
+    :param results: A dict of report list name to entities, None when report_path is given.
+    :param excel_output: The path of the Excel report.
+    :param flatten_json: Flatten the list fields into child sheets keyed back to their parent rows.
+    :param max_workers: The number of worker processes the tables are built in, see normalize_tables.
+    :param max_rows_per_sheet: Roll over to a new sheet past this number of rows, header included.
+    :param metrics: A RunMetrics to record the table building and excel.write_sheets stages in.
+    :param chunk_size: The number of entities normalized by a worker at a time.
+    :param report_path: Read the entities from this saved report a chunk at a time
+      instead of from results.
+    :return: A dict of table name to number of rows.
+    """
+    import openpyxl as openpyxl
+    # use pandas to convert the report to an excel file
+    print(emoji.emojize(
+        ":white_check_mark:  Converting JSON to Excel.", language='alias'))
+    rows = {}
+    used = set()
+    # The write-only workbook streams the rows out instead of holding every cell.
+    workbook = openpyxl.Workbook(write_only=True)
+    tables = normalize_tables(results,
+                              flatten_json=flatten_json,
+                              max_workers=max_workers,
+                              chunk_size=chunk_size,
+                              metrics=metrics,
+                              report_path=report_path)
+    # Write the sheets in report order, each table chunk after chunk.
+    for table_name, parts in tables.items():
+        with _stage(metrics, "excel.write_sheets") as stage:
+            sheets = _write_sheets(workbook, table_name, parts, used,
+                                   max_rows_per_sheet=max_rows_per_sheet)
+            stage["rows"] = sum(len(part) for part in parts)
+        rows[table_name] = stage["rows"]
+        logger.info("Sheet %s: %d row(s) in %d sheet(s)",
+                    table_name, rows[table_name], sheets)
+    with _stage(metrics, "excel.save"):
+        workbook.save(excel_output)
+    # Let the user know that the report has been written to an excel file
+    print(
+        emoji.emojize(
+            f":white_check_mark:  Excel report written to {excel_output}.",
+            language='alias',
+        )
+    )
+    return rows
+
+
+def open_in_spreadsheet(excel_output):
+    """
+    Open the Excel report in Excel (Windows, Mac) or LibreOffice (Linux).
+
+    :param excel_output: The path of the Excel report.
+    """
+    # determine if platform is Windows, Linux or Mac
+    if platform.system() == 'Windows':
+        # check if Excel is installed
+        # if which('excel.exe') is None:
+        #     print(emoji.emojize(
+        #         'Excel is not installed :cross_mark:',
+        #         language='alias'))
+        #     raise Exception("Excel is not installed")
+        # else:
+        print(emoji.emojize(
+            ":open_file_folder: Opening {} in Excel in Windows").format(excel_output))
+        # nosec B605: start is used to open a file with excel.exe
+        os.system(f"start excel.exe {excel_output}")
+    elif platform.system() == 'Linux':
+        # check if LibreOffice is installed
+        # if which('libreoffice') is None:
+        #     print(emoji.emojize(
+        #         'LibreOffice is not installed :cross_mark:',
+        #         language='alias'))
+        #     raise Exception("LibreOffice is not installed")
+        # else:
+        print(emoji.emojize(
+            ":open_file_folder: Opening {} in LibreOffice in Linux").format(excel_output))
+        # nosec B605: libreoffice is used to open a file with LibreOffice
+        os.system(f"libreoffice {excel_output}")
+    elif platform.system() == 'Darwin':
+        # Check if Excel is installed in Mac
+        # if which('Microsoft Excel.app') is None:
+        #     print(emoji.emojize(
+        #         'Excel is not installed :cross_mark:',
+        #         language='alias'))
+        #     raise Exception("Excel is not installed")
+        # else:
+        print(emoji.emojize(
+            ":open_file_folder: Opening {} in Excel in Mac").format(excel_output))
+        # nosec B605: open is used to open a file with Microsoft Excel
+        os.system(f"""open -a "Microsoft Excel" {excel_output}""")
+
+
+def convert_saved_report(
+    report_path,
+    flatten_json=False,
+    open_in_excel=False,
+    backends=(),
+    dataset=None,
+    metrics=None,
+    json_only=False,
+    permission_index=False,
+    policy_cache=None,
+    expand_actions=False,
+    action_catalog=None,
+    compact=False,
+    normalize_workers=None,
+    normalize_chunk_size=NORMALIZE_CHUNK_SIZE
+):
+    """
+    Convert a saved report to Excel without calling the AWS API.
+
+    :param report_path: The path of a report in any of the OUTPUT_FORMATS.
+    :param flatten_json: Flatten the nested fields before writing the workbook.
+    :param open_in_excel: Open the Excel report once it is written.
+    :param backends: Names of OUTPUT_BACKENDS to run next to the Excel report.
+    :param dataset: The path of the backend datasets without extension, defaults to the report without extension.
+    :param metrics: A RunMetrics to record the stages of the conversion in.
+    :param json_only: Skip the Excel report and only run the backends.
+    :param permission_index: Build the effective-permission index of the report next to it.
+    :param policy_cache: The directory of the PolicyDocumentCache the report references documents in.
+    :param expand_actions: Write the expanded, deduplicated action sets of every policy next to the report.
+    :param action_catalog: The path of the service-action catalog the actions are expanded against.
+    :param compact: Load the report as a CompactReport instead of lists of dicts.
+    :param normalize_workers: The number of worker processes the Excel tables are built in, see normalize_tables.
+    :param normalize_chunk_size: The number of entities normalized by a worker at a time.
+    :return: The path of the Excel report.
+    """
+    print(emoji.emojize(
+        f":white_check_mark:  Loading saved report {report_path}.", language='alias'))
+    with _stage(metrics, "load_report") as stage:
+        results = load_report(report_path, compact=compact)
+        stage["rows"] = sum(len(entities) for entities in results.values())
+    if compact:
+        _print_compact_report(results)
+    excel_output = excel_output_path(report_path)
+    if not json_only:
+        export_excel_report(results, excel_output,
+                            flatten_json=flatten_json,
+                            max_workers=normalize_workers,
+                            chunk_size=normalize_chunk_size,
+                            metrics=metrics)
+    base = excel_output[:-len('.xlsx')]
+    if policy_cache is not None:
+        policy_cache = PolicyDocumentCache(policy_cache)
+    export_backends(results, backends, dataset or base,
+                    _account_label(os.path.basename(base)), metrics=metrics,
+                    policy_cache=policy_cache)
+    if permission_index:
+        with _stage(metrics, "permission_index") as stage:
+            stage["rows"] = build_permission_index(results,
+                                                   permission_index_path(report_path),
+                                                   policy_cache)["grants"]
+    if expand_actions:
+        with _stage(metrics, "expand_actions") as stage:
+            stage["rows"] = export_expanded_actions(results,
+                                                    expanded_actions_path(report_path),
+                                                    ActionExpander(load_action_catalog(action_catalog)),
+                                                    policy_cache)["policies"]
+    if open_in_excel and not json_only:
+        open_in_spreadsheet(excel_output)
+    return excel_output
+
+
+def _principal_type(list_name):
+    """
+    Map a report list to the type of its entities.
+
+    :param list_name: The name of the report list.
+    :return: "User", "Group", "Role" or "Policy".
+    """
+    return SHEET_PREFIXES[list_name]
+
+
+def _parquet_schema(list_name, extra_columns=()):
+    """
+    Build the Parquet schema of a report list.
+
+    ARN, name, path and id columns are dictionary encoded, dates are UTC timestamps
+    and nested fields are JSON strings, so every account appends the same schema.
+
+    :param list_name: The name of the report list.
+    :param extra_columns: Columns found in the entities but not in ENTITY_COLUMNS.
+    :return: A pyarrow schema.
+    """
+    import pyarrow as pa
+    fields = [pa.field("Account", pa.dictionary(pa.int32(), pa.string()))]
+    for column in list(ENTITY_COLUMNS[list_name]) + list(extra_columns):
+        if column.endswith(("Arn", "Name", "Path", "Id")):
+            field_type = pa.dictionary(pa.int32(), pa.string())
+        elif column.endswith("Date"):
+            field_type = pa.timestamp("us", tz="UTC")
+        elif column.endswith("Count"):
+            field_type = pa.int64()
+        elif column.startswith("Is"):
+            field_type = pa.bool_()
+        else:
+            field_type = pa.string()
+        fields.append(pa.field(column, field_type))
+    return pa.schema(fields)
+
+
+def _parquet_value(value, field_type):
+    """
+    Convert an entity field to a value of its Parquet column.
+
+    :param value: The entity field.
+    :param field_type: The pyarrow type of the column.
+    :return: The column value.
+    """
+    import pandas as pd
+    import pyarrow as pa
+    if value is None:
+        return None
+    if pa.types.is_timestamp(field_type):
+        # Dates are datetimes when collected and strings when loaded from a report.
+        timestamp = pd.Timestamp(value)
+        if timestamp.tzinfo is None:
+            return timestamp.tz_localize("UTC")
+        return timestamp.tz_convert("UTC")
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, default=str)
+    if pa.types.is_string(field_type) or pa.types.is_dictionary(field_type):
+        return str(value)
+    return value
+
+
+def export_parquet_dataset(results, destination, account, policy_cache=None):
+    """
+    Write the report lists to a Parquet dataset, one file per report list and account.
+
+    The files are written to <destination>/<report list>/<account>.parquet, so several
+    accounts append to the same dataset and each report list can be read on its own,
+    e.g. pandas.read_parquet("<destination>/RoleDetailList").
+
+    :param results: A dict of report list name to entities.
+    :param destination: The directory of the Parquet dataset.
+    :param account: The label of the account, stored in the Account column.
+    :param policy_cache: Unused, the PolicyVersionList column keeps the DocumentHash references.
+    :return: A dict of report list name to the path of the written file.
+    """
+    # pyarrow is only needed for the Parquet backend.
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ValueError("The parquet backend requires the pyarrow package")
+
+    written = {}
+    for list_name in ENTITY_KEYS:
+        entities = results.get(list_name, [])
+        extra_columns = sorted({
+            key for entity in entities for key in entity
+        } - set(ENTITY_COLUMNS[list_name]))
+        schema = _parquet_schema(list_name, extra_columns)
+        columns = {"Account": [account] * len(entities)}
+        for field in schema:
+            if field.name == "Account":
+                continue
+            value_type = field.type.value_type if pa.types.is_dictionary(field.type) else field.type
+            columns[field.name] = [
+                _parquet_value(entity.get(field.name), value_type) for entity in entities
+            ]
+        table = pa.Table.from_pydict(columns, schema=schema)
+        directory = os.path.join(destination, list_name)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{account}.parquet")
+        pq.write_table(table, path)
+        written[list_name] = path
+    print(
+        emoji.emojize(
+            f":white_check_mark:  Parquet dataset written to {destination}.",
+            language='alias',
+        )
+    )
+    return written
+
+
+# The schema of the SQLite backend. Every table is keyed by the account, so several
+# accounts append to the same database and a re-scan replaces the rows of its account.
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS principals (
+    account TEXT NOT NULL,
+    type TEXT NOT NULL,
+    id TEXT,
+    name TEXT,
+    arn TEXT NOT NULL,
+    path TEXT,
+    create_date TEXT,
+    permissions_boundary_arn TEXT,
+    tags TEXT,
+    assume_role_policy_document TEXT,
+    PRIMARY KEY (account, arn)
+);
+CREATE INDEX IF NOT EXISTS principals_name ON principals (name);
+CREATE INDEX IF NOT EXISTS principals_arn ON principals (arn);
+CREATE TABLE IF NOT EXISTS policies (
+    account TEXT NOT NULL,
+    id TEXT,
+    name TEXT,
+    arn TEXT NOT NULL,
+    path TEXT,
+    default_version_id TEXT,
+    attachment_count INTEGER,
+    permissions_boundary_usage_count INTEGER,
+    is_attachable INTEGER,
+    aws_managed INTEGER,
+    create_date TEXT,
+    update_date TEXT,
+    PRIMARY KEY (account, arn)
+);
+CREATE INDEX IF NOT EXISTS policies_name ON policies (name);
+CREATE INDEX IF NOT EXISTS policies_arn ON policies (arn);
+CREATE TABLE IF NOT EXISTS policy_versions (
+    account TEXT NOT NULL,
+    policy_arn TEXT NOT NULL,
+    version_id TEXT NOT NULL,
+    is_default_version INTEGER,
+    create_date TEXT,
+    document TEXT,
+    document_hash TEXT,
+    PRIMARY KEY (account, policy_arn, version_id)
+);
+CREATE TABLE IF NOT EXISTS attachments (
+    account TEXT NOT NULL,
+    principal_arn TEXT NOT NULL,
+    principal_type TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    policy_name TEXT,
+    policy_arn TEXT,
+    document TEXT
+);
+CREATE INDEX IF NOT EXISTS attachments_principal_arn ON attachments (principal_arn);
+CREATE INDEX IF NOT EXISTS attachments_policy_arn ON attachments (policy_arn);
+CREATE TABLE IF NOT EXISTS group_memberships (
+    account TEXT NOT NULL,
+    user_arn TEXT NOT NULL,
+    group_name TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS group_memberships_user_arn ON group_memberships (user_arn);
+CREATE INDEX IF NOT EXISTS group_memberships_group_name ON group_memberships (group_name);
+"""
+
+# The inline policy list of each principal report list.
+INLINE_POLICY_LISTS = {
+    "UserDetailList": "UserPolicyList",
+    "GroupDetailList": "GroupPolicyList",
+    "RoleDetailList": "RolePolicyList",
+}
+
+
+def _json_column(value):
+    """
+    Serialize a nested field for a SQLite TEXT column.
+
+    :param value: The nested field.
+    :return: The field as JSON, or None when it is missing.
+    """
+    return None if value is None else json.dumps(value, default=str)
+
+
+def _str_column(value):
+    """
+    Serialize a scalar field, dates included, for a SQLite TEXT column.
+
+    :param value: The scalar field.
+    :return: The field as a string, or None when it is missing.
+    """
+    return None if value is None else str(value)
+
+
+def export_sqlite_database(results, destination, account, policy_cache=None):
+    """
+    Write the report lists to an indexed SQLite database.
+
+    The principals, policies, policy_versions, attachments and group_memberships
+    tables are created when missing and the rows of the account are replaced in a
+    single transaction, so several accounts, even from several processes, can append
+    to the same database.
+
+    :param results: A dict of report list name to entities.
+    :param destination: The path of the SQLite database.
+    :param account: The label of the account, stored in the account column.
+    :param policy_cache: A PolicyDocumentCache to resolve the DocumentHash references of
+      the policy versions with. The hash is stored in the document_hash column either way.
+    :return: A dict of table name to the number of rows written.
+    """
+    principals = []
+    attachments = []
+    memberships = []
+    for list_name, inline_list in INLINE_POLICY_LISTS.items():
+        principal_type = _principal_type(list_name)
+        for entity in results.get(list_name, []):
+            arn = entity.get("Arn")
+            principals.append((
+                account,
+                principal_type,
+                entity.get(ENTITY_KEYS[list_name]),
+                entity.get(f"{principal_type}Name"),
+                arn,
+                entity.get("Path"),
+                _str_column(entity.get("CreateDate")),
+                (entity.get("PermissionsBoundary") or {}).get("PermissionsBoundaryArn"),
+                _json_column(entity.get("Tags")),
+                _json_column(entity.get("AssumeRolePolicyDocument")),
+            ))
+            for policy in entity.get("AttachedManagedPolicies", []):
+                attachments.append((account, arn, principal_type, "managed",
+                                    policy.get("PolicyName"), policy.get("PolicyArn"), None))
+            for policy in entity.get(inline_list, []):
+                attachments.append((account, arn, principal_type, "inline",
+                                    policy.get("PolicyName"), None,
+                                    _json_column(policy.get("PolicyDocument"))))
+            for group_name in entity.get("GroupList", []):
+                memberships.append((account, arn, group_name))
+
+    policies = []
+    policy_versions = []
+    for policy in results.get("Policies", []):
+        policies.append((
+            account,
+            policy.get("PolicyId"),
+            policy.get("PolicyName"),
+            policy.get("Arn"),
+            policy.get("Path"),
+            policy.get("DefaultVersionId"),
+            policy.get("AttachmentCount"),
+            policy.get("PermissionsBoundaryUsageCount"),
+            policy.get("IsAttachable"),
+            _is_aws_managed_policy(policy),
+            _str_column(policy.get("CreateDate")),
+            _str_column(policy.get("UpdateDate")),
+        ))
+        for version in policy.get("PolicyVersionList", []):
+            document = version.get("Document")
+            if document is None and policy_cache is not None:
+                document = policy_cache.resolve(policy.get("Arn"), version)
+            policy_versions.append((
+                account,
+                policy.get("Arn"),
+                version.get("VersionId"),
+                version.get("IsDefaultVersion"),
+                _str_column(version.get("CreateDate")),
+                _json_column(document),
+                version.get("DocumentHash"),
+            ))
+
+    rows = {
+        "principals": principals,
+        "policies": policies,
+        "policy_versions": policy_versions,
+        "attachments": attachments,
+        "group_memberships": memberships,
+    }
+    # Wait for the other accounts writing to the same database.
+    connection = sqlite3.connect(destination, timeout=300)
+    try:
+        connection.executescript(SQLITE_SCHEMA)
+        columns = [row[1] for row in connection.execute("PRAGMA table_info(policy_versions)")]
+        if "document_hash" not in columns:
+            # A database written before the policy versions kept their document hash.
+            connection.execute("ALTER TABLE policy_versions ADD COLUMN document_hash TEXT")
+        with connection:
+            for table, table_rows in rows.items():
+                connection.execute(f"DELETE FROM {table} WHERE account = ?", (account,))
+                if table_rows:
+                    placeholders = ', '.join('?' * len(table_rows[0]))
+                    connection.executemany(
+                        f"INSERT OR REPLACE INTO {table} VALUES ({placeholders})", table_rows)
+    finally:
+        connection.close()
+    print(
+        emoji.emojize(
+            f":white_check_mark:  SQLite database written to {destination}.",
+            language='alias',
+        )
+    )
+    return {table: len(table_rows) for table, table_rows in rows.items()}
+
+
+# The output backends that can run next to the JSON and Excel reports,
+# name to the export function and the extension of its default destination.
+OUTPUT_BACKENDS = {
+    "parquet": (export_parquet_dataset, ".parquet"),
+    "sqlite": (export_sqlite_database, ".sqlite"),
+}
+
+
+def export_backends(results, backends, dataset, account, metrics=None, policy_cache=None):
+    """
+    Run the output backends on the report lists.
+
+    :param results: A dict of report list name to entities.
+    :param backends: Names of OUTPUT_BACKENDS.
+    :param dataset: The path of the datasets without extension, each backend adds its own.
+    :param account: The label of the account the report lists belong to.
+    :param metrics: A RunMetrics to record a stage per backend in.
+    :param policy_cache: A PolicyDocumentCache to resolve the DocumentHash references with.
+    :return: A dict of backend name to its destination.
+    """
+    destinations = {}
+    for backend in backends:
+        export, extension = OUTPUT_BACKENDS[backend]
+        destinations[backend] = dataset + extension
+        with _stage(metrics, f"backend.{backend}"):
+            export(results, destinations[backend], account, policy_cache=policy_cache)
+    return destinations
+
+
+# The schema of the effective-permission index. Every statement of every policy a
+# principal gets, directly or through a group, becomes one grant row per action
+# pattern (or a single row holding the NotAction patterns). Actions are stored lower
+# case with their service, so a query only scans the grants of its service and the
+# "*" wildcards, and matches the patterns with GLOB.
+PERMISSION_INDEX_SCHEMA = """
+CREATE TABLE metadata (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE principals (
+    principal_id INTEGER PRIMARY KEY,
+    type TEXT NOT NULL,
+    name TEXT,
+    arn TEXT NOT NULL,
+    id TEXT
+);
+CREATE INDEX principals_name ON principals (name);
+CREATE INDEX principals_arn ON principals (arn);
+CREATE TABLE grants (
+    principal_id INTEGER NOT NULL,
+    effect TEXT NOT NULL,
+    service TEXT NOT NULL,
+    action TEXT,
+    not_action TEXT,
+    resource TEXT,
+    not_resource INTEGER NOT NULL,
+    conditional INTEGER NOT NULL,
+    policy TEXT,
+    policy_type TEXT NOT NULL,
+    via TEXT
+);
+CREATE INDEX grants_service_action ON grants (service, action);
+CREATE INDEX grants_principal_id ON grants (principal_id);
+"""
+
+
+def permission_index_path(output):
+    """
+    Build the path of the effective-permission index of a report.
+
+    :param output: The path of the report, in any of the OUTPUT_FORMATS.
+    :return: The path of the index.
+    """
+    return excel_output_path(output)[:-len('.xlsx')] + '.permissions.sqlite'
+
+
+def _as_list(value):
+    """
+    Wrap a policy element that may be a single value in a list.
+
+    :param value: A string, a list or None.
+    :return: A list.
+    """
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def _action_service(pattern):
+    """
+    Get the service of a lower case action pattern.
+
+    :param pattern: An action pattern, e.g. "s3:get*".
+    :return: The service prefix, or "*" when the pattern may match any service.
+    """
+    service, separator, _ = pattern.partition(':')
+    if not separator or '*' in service or '?' in service:
+        return "*"
+    return service
+
+
+def _policy_document(document):
+    """
+    Decode a policy document, which botocore decodes but a saved report may not.
+
+    :param document: A policy document as a dict, or as a (URL encoded) JSON string.
+    :return: The policy document as a dict.
+    """
+    if isinstance(document, str):
+        document = json.loads(urllib_parse.unquote(document))
+    return document or {}
+
+
+def _managed_policy_documents(results, policy_cache=None):
+    """
+    Map the managed policies of a report to their default version document.
+
+    :param results: A dict of report list name to entities.
+    :param policy_cache: A PolicyDocumentCache to resolve the DocumentHash references with.
+    :return: A dict of policy ARN to policy document, None when the referenced document
+      is no longer in the cache.
+    """
+    documents = {}
+    for policy in results.get("Policies", []):
+        for version in policy.get("PolicyVersionList") or []:
+            if version.get("VersionId") != policy.get("DefaultVersionId"):
+                continue
+            if "Document" in version:
+                documents[policy.get("Arn")] = _policy_document(version["Document"])
+            elif "DocumentHash" in version and policy_cache is not None:
+                documents[policy.get("Arn")] = policy_cache.resolve(policy.get("Arn"), version)
+    return documents
+
+
+def iter_principal_policies(results, policy_cache=None):
+    """
+    Resolve the policies every principal of a report gets.
+
+    Users get their inline and attached policies and those of their groups, groups
+    and roles their inline and attached policies. Permissions boundaries, service
+    control policies and resource policies are not taken into account.
+
+    :param results: A dict of report list name to entities.
+    :param policy_cache: A PolicyDocumentCache to resolve the DocumentHash references with.
+    :return: A generator of (report list name, principal, policy name or ARN, policy type,
+      group name or None, policy document) tuples. The document is None for managed
+      policies missing from the report or from the policy cache.
+    """
+    managed = _managed_policy_documents(results, policy_cache)
+    groups = {group.get("GroupName"): group for group in results.get("GroupDetailList", [])}
+
+    def policies_of(list_name, entity):
+        for policy in entity.get(INLINE_POLICY_LISTS[list_name]) or []:
+            yield policy.get("PolicyName"), "inline", _policy_document(policy.get("PolicyDocument"))
+        for policy in entity.get("AttachedManagedPolicies") or []:
+            yield policy.get("PolicyArn"), "managed", managed.get(policy.get("PolicyArn"))
+
+    for list_name in INLINE_POLICY_LISTS:
+        for entity in results.get(list_name, []):
+            for name, policy_type, document in policies_of(list_name, entity):
+                yield list_name, entity, name, policy_type, None, document
+            for group_name in entity.get("GroupList") or []:
+                group = groups.get(group_name)
+                if group is None:
+                    continue
+                for name, policy_type, document in policies_of("GroupDetailList", group):
+                    yield list_name, entity, name, policy_type, group_name, document
+
+
+def build_permission_index(results, index_path, policy_cache=None):
+    """
+    Build the effective-permission index of a report.
+
+    The index is a SQLite database of the principals and of their grants, the
+    statements of every policy they get, indexed by service and action pattern and
+    by principal. It is rebuilt from scratch, and written next to the destination
+    before it replaces it, so a query never sees a partial index.
+
+    :param results: A dict of report list name to entities.
+    :param index_path: The path of the index.
+    :param policy_cache: A PolicyDocumentCache to resolve the DocumentHash references with.
+    :return: A dict of the number of principals, grants and unresolved managed policies.
+    """
+    # Every principal is indexed, with or without policies, so a query can tell it apart
+    # from a principal missing from the report.
+    principals = {}
+    for list_name in INLINE_POLICY_LISTS:
+        principal_type = _principal_type(list_name)
+        for entity in results.get(list_name, []):
+            arn = entity.get("Arn")
+            if arn not in principals:
+                principals[arn] = (len(principals) + 1, principal_type,
+                                   entity.get(f"{principal_type}Name"), arn,
+                                   entity.get(ENTITY_KEYS[list_name]))
+    grants = []
+    unresolved = set()
+    for list_name, entity, name, policy_type, via, document in iter_principal_policies(results, policy_cache):
+        arn = entity.get("Arn")
+        if document is None:
+            unresolved.add(name)
+            continue
+        principal_id = principals[arn][0]
+        for statement in _as_list(document.get("Statement")):
+            not_resource = "NotResource" in statement
+            resource = json.dumps(_as_list(statement.get("NotResource" if not_resource else "Resource")))
+            row = (principal_id, statement.get("Effect", "Allow"))
+            tail = (resource, not_resource, "Condition" in statement, name, policy_type, via)
+            if "NotAction" in statement:
+                # NotAction grants every action but the listed ones, of any service.
+                not_action = json.dumps([action.lower() for action in _as_list(statement["NotAction"])])
+                grants.append(row + ("*", None, not_action) + tail)
+                continue
+            for action in _as_list(statement.get("Action")):
+                action = action.lower()
+                grants.append(row + (_action_service(action), action, None) + tail)
+    if unresolved:
+        logger.warning("%d managed policies are not in the report or the policy cache and are not indexed",
+                       len(unresolved))
+
+    temporary_path = f"{index_path}.{os.getpid()}.tmp"
+    if os.path.exists(temporary_path):
+        os.remove(temporary_path)
+    connection = sqlite3.connect(temporary_path)
+    try:
+        connection.executescript(PERMISSION_INDEX_SCHEMA)
+        with connection:
+            connection.executemany("INSERT INTO principals VALUES (?, ?, ?, ?, ?)", principals.values())
+            connection.executemany("INSERT INTO grants VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", grants)
+            connection.executemany("INSERT INTO metadata VALUES (?, ?)", [
+                ("GeneratedAt", datetime.datetime.now(datetime.timezone.utc).isoformat()),
+                ("Principals", str(len(principals))),
+                ("Grants", str(len(grants))),
+            ])
+    finally:
+        connection.close()
+    os.replace(temporary_path, index_path)
+    print(
+        emoji.emojize(
+            f":white_check_mark:  Permission index of {len(principals)} principal(s) "
+            f"and {len(grants)} grant(s) written to {index_path}.",
+            language='alias',
+        )
+    )
+    return {"principals": len(principals), "grants": len(grants), "unresolved": len(unresolved)}
+
+
+def _grant_matches_resource(grant, resource):
+    """
+    Check if a grant applies to a resource.
+
+    :param grant: A grant row, as a dict.
+    :param resource: A resource ARN, or None for any resource.
+    :return: True when the grant applies to the resource.
+    """
+    if resource is None:
+        return True
+    patterns = json.loads(grant["resource"])
+    matched = any(fnmatch.fnmatchcase(resource, pattern) for pattern in patterns)
+    return not matched if grant["not_resource"] else matched
+
+
+def _grant_entry(grant):
+    """
+    Convert a grant row to the dict returned by the queries.
+
+    :param grant: A grant row.
+    :return: A dict of the policy, the action patterns and the resources of the grant.
+    """
+    return {
+        "Policy": grant["policy"],
+        "PolicyType": grant["policy_type"],
+        "Via": grant["via"],
+        "Action": grant["action"],
+        "NotAction": json.loads(grant["not_action"]) if grant["not_action"] else None,
+        "Resource": json.loads(grant["resource"]),
+        "NotResource": bool(grant["not_resource"]),
+        "Conditional": bool(grant["conditional"]),
+    }
+
+
+def _open_permission_index(index_path):
+    """
+    Open an effective-permission index for queries.
+
+    :param index_path: The path of the index.
+    :return: A read-only SQLite connection returning rows as sqlite3.Row.
+    """
+    if not os.path.exists(index_path):
+        raise ValueError(f"No permission index at {index_path}, build it with --permission-index")
+    connection = sqlite3.connect(f"file:{urllib_parse.quote(os.path.abspath(index_path))}?mode=ro", uri=True)
+    connection.row_factory = sqlite3.Row
+    return connection
+
+
+def query_action(index_path, action, resource=None):
+    """
+    Find the principals that can perform an action.
+
+    A principal can perform the action when one of its Allow grants matches the action
+    and the resource, and no unconditional Deny grant does. Conditional grants are
+    reported as such, their conditions are not evaluated.
+
+    :param index_path: The path of the effective-permission index.
+    :param action: The action, e.g. "s3:DeleteBucket".
+    :param resource: Only consider the grants that apply to this resource ARN.
+    :return: A dict with the "allowed" and "denied" principals, each a list of dicts of the
+      principal and of the grants that allow or deny the action.
+    """
+    action = action.lower()
+    connection = _open_permission_index(index_path)
+    try:
+        rows = connection.execute(
+            "SELECT principals.type, principals.name, principals.arn, grants.* FROM grants "
+            "JOIN principals USING (principal_id) "
+            "WHERE grants.service IN (?, '*') AND (grants.action IS NULL OR ? GLOB grants.action)",
+            (_action_service(action), action)).fetchall()
+    finally:
+        connection.close()
+
+    matches = {}
+    for row in rows:
+        grant = dict(row)
+        if grant["not_action"] is not None and any(
+                fnmatch.fnmatchcase(action, pattern) for pattern in json.loads(grant["not_action"])):
+            continue
+        if not _grant_matches_resource(grant, resource):
+            continue
+        principal = matches.setdefault(grant["arn"], {
+            "Type": grant["type"],
+            "Name": grant["name"],
+            "Arn": grant["arn"],
+            "Allow": [],
+            "Deny": [],
+        })
+        principal[grant["effect"]].append(_grant_entry(grant))
+
+    allowed = []
+    denied = []
+    for principal in matches.values():
+        # Without a resource, only a Deny of every resource denies the action outright.
+        if any(not grant["Conditional"]
+               and (resource is not None or (grant["Resource"] == ["*"] and not grant["NotResource"]))
+               for grant in principal["Deny"]):
+            denied.append(principal)
+        elif principal["Allow"]:
+            allowed.append(principal)
+    return {"allowed": allowed, "denied": denied}
+
+
+def query_principal(index_path, principal):
+    """
+    List the grants of a principal.
+
+    :param index_path: The path of the effective-permission index.
+    :param principal: The name or ARN of a user, group or role.
+    :return: A list of dicts of the matching principals and their Allow and Deny grants.
+    """
+    connection = _open_permission_index(index_path)
+    try:
+        principals = connection.execute(
+            "SELECT * FROM principals WHERE arn = ? OR name = ?", (principal, principal)).fetchall()
+        found = []
+        for row in principals:
+            grants = connection.execute(
+                "SELECT * FROM grants WHERE principal_id = ? ORDER BY effect, service, action",
+                (row["principal_id"],)).fetchall()
+            entry = {"Type": row["type"], "Name": row["name"], "Arn": row["arn"], "Allow": [], "Deny": []}
+            for grant in grants:
+                entry[grant["effect"]].append(_grant_entry(grant))
+            found.append(entry)
+    finally:
+        connection.close()
+    return found
+
+
+# The IAM action prefix of the botocore services whose signing name is not their IAM prefix,
+# e.g. CloudWatch is signed as "monitoring" and IoT as "execute-api".
+IAM_SERVICE_PREFIXES = {
+    "cloudcontrol": "cloudformation",
+    "cloudwatch": "cloudwatch",
+    "iot": "iot",
+    "iot-data": "iot",
+    "iot-jobs-data": "iotjobsdata",
+    "iotevents-data": "iotevents",
+    "iotsecuretunneling": "iot",
+    "mobile": "mobilehub",
+    "mturk": "mechanicalturk",
+    "pinpoint-email": "ses",
+    "ses": "ses",
+    "sesv2": "ses",
+    "sso": "sso",
+    "sso-oidc": "sso-oauth",
+}
+
+# Bumped when the catalogs built from the same botocore change, so they are rebuilt.
+ACTION_CATALOG_REVISION = 2
+
+
+def _action_catalog_version():
+    """
+    :return: The version of the catalogs built from the installed botocore.
+    """
+    import botocore as botocore
+    return f"botocore-{botocore.__version__}-r{ACTION_CATALOG_REVISION}"
+
+
+def build_action_catalog():
+    """
+    Build a service-action catalog from the API operations of the botocore service models.
+
+    The IAM service prefix of each model is its signing name, corrected by
+    IAM_SERVICE_PREFIXES. IAM actions without an API operation of the same name, such as
+    s3:ListBucket or iam:PassRole, are not in it, ActionExpander adds the actions the
+    policies spell out to the catalog.
+
+    :return: A catalog, {"Version": ..., "Source": "botocore", "Services": {prefix: [actions]}}.
+    """
+    import botocore.session as botocore_session
+    session = botocore_session.get_session()
+    loader = session.get_component('data_loader')
+    services = {}
+    for service_name in session.get_available_services():
+        model = loader.load_service_model(service_name, 'service-2')
+        metadata = model.get('metadata', {})
+        prefix = (IAM_SERVICE_PREFIXES.get(service_name) or metadata.get('signingName')
+                  or metadata.get('endpointPrefix') or service_name)
+        services.setdefault(prefix, set()).update(model.get('operations', {}))
+    return {
+        "Version": _action_catalog_version(),
+        "Source": "botocore",
+        "Services": {prefix: sorted(actions) for prefix, actions in sorted(services.items())},
+    }
+
+
+def load_action_catalog(path=None):
+    """
+    Load the service-action catalog, building it from botocore when needed.
+
+    A catalog built from botocore is rebuilt when botocore is upgraded or the way it
+    is built changes. Any other
+    catalog at the path, e.g. one exported from the AWS service authorization reference
+    in the same format, is used as it is.
+
+    :param path: The path of the catalog, or None to build it in memory.
+    :return: The catalog.
+    """
+    if path is not None:
+        path = os.path.expanduser(path)
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                catalog = json.load(f)
+            if catalog.get("Source") != "botocore" or catalog.get("Version") == _action_catalog_version():
+                return catalog
+            logger.info("Rebuilding the action catalog %s as %s", path, _action_catalog_version())
+    catalog = build_action_catalog()
+    if path is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        with open(temporary_path, 'w', encoding='utf-8') as f:
+            json.dump(catalog, f)
+        os.replace(temporary_path, path)
+    return catalog
+
+
+class ActionExpander:
+    """
+    Expand the action patterns of policy statements against a service-action catalog.
+
+    Actions are compared lower case, as IAM does. Each distinct pattern is compiled
+    and expanded once, and the expansion is memoized in a bounded LRU cache, so the
+    thousands of policies of a report mostly hit the cache. A pattern without wildcard
+    expands to itself and is added to the catalog, so the actions the catalog misses
+    are still matched by the wildcards of the other statements.
+    """
+
+    def __init__(self, catalog, cache_size=4096):
+        """
+        Load the catalog.
+
+        :param catalog: A catalog, see load_action_catalog.
+        :param cache_size: The number of patterns whose expansion is memoized.
+        """
+        self.version = catalog.get("Version")
+        self._services = {}
+        for service, actions in catalog.get("Services", {}).items():
+            service = service.lower()
+            self._services.setdefault(service, set()).update(
+                f"{service}:{action.lower()}" for action in actions)
+        self._every_action = None
+        self._expand_pattern = functools.lru_cache(maxsize=cache_size)(self._expand_uncached)
+
+    def add_actions(self, actions):
+        """
+        Add actions to the catalog.
+
+        :param actions: Lower case actions without wildcard.
+        :return: The number of actions the catalog did not have.
+        """
+        added = 0
+        for action in actions:
+            service, separator, _ = action.partition(':')
+            if not separator:
+                continue
+            known = self._services.setdefault(service, set())
+            if action not in known:
+                known.add(action)
+                added += 1
+        if added:
+            # The memoized expansions miss the new actions.
+            self._expand_pattern.cache_clear()
+            self._every_action = None
+        return added
+
+    def every_action(self):
+        """
+        Get every action of the catalog.
+
+        :return: A frozenset of lower case actions.
+        """
+        if self._every_action is None:
+            self._every_action = frozenset().union(*self._services.values())
+        return self._every_action
+
+    def _expand_uncached(self, pattern):
+        if '*' not in pattern and '?' not in pattern:
+            return frozenset((pattern,))
+        service = _action_service(pattern)
+        candidates = self.every_action() if service == "*" else self._services.get(service, ())
+        # IAM wildcards only, brackets and dots are literal.
+        regex = re.compile(re.escape(pattern).replace(r'\*', '.*').replace(r'\?', '.'))
+        return frozenset(action for action in candidates if regex.fullmatch(action))
+
+    def expand(self, pattern):
+        """
+        Expand an action pattern.
+
+        :param pattern: An action pattern, e.g. "s3:Get*".
+        :return: A frozenset of the lower case actions it matches.
+        """
+        return self._expand_pattern(pattern.lower())
+
+    def cache_info(self):
+        """
+        Get the statistics of the pattern cache.
+
+        :return: A dict of the cache hits, misses and size.
+        """
+        info = self._expand_pattern.cache_info()
+        return {"Hits": info.hits, "Misses": info.misses, "Size": info.currsize, "MaxSize": info.maxsize}
+
+    def expand_documents(self, documents):
+        """
+        Expand the actions of a batch of policy documents.
+
+        The Action and NotAction elements, a string or a list, are normalized to lower
+        case patterns for the whole batch first, and the actions the batch spells out
+        are added to the catalog before any wildcard is expanded.
+
+        :param documents: An iterable of policy documents.
+        :return: A list of {"Allow": frozenset, "Deny": frozenset}, one per document.
+        """
+        normalized = []
+        literals = set()
+        for document in documents:
+            statements = []
+            for statement in _as_list((document or {}).get("Statement")):
+                not_action = "NotAction" in statement
+                patterns = tuple(pattern.lower() for pattern in
+                                 _as_list(statement.get("NotAction" if not_action else "Action")))
+                literals.update(pattern for pattern in patterns if '*' not in pattern and '?' not in pattern)
+                statements.append((statement.get("Effect", "Allow"), not_action, patterns))
+            normalized.append(statements)
+        self.add_actions(literals)
+
+        # Policies repeat the same statements, each distinct one is expanded once per batch.
+        statement_actions = {}
+        expanded = []
+        for statements in normalized:
+            actions = {"Allow": set(), "Deny": set()}
+            for effect, not_action, patterns in statements:
+                key = (not_action, patterns)
+                if key not in statement_actions:
+                    matched = frozenset().union(*(self._expand_pattern(pattern) for pattern in patterns))
+                    statement_actions[key] = self.every_action() - matched if not_action else matched
+                actions.setdefault(effect, set()).update(statement_actions[key])
+            expanded.append({effect: frozenset(effect_actions) for effect, effect_actions in actions.items()})
+        return expanded
+
+
+def expanded_actions_path(output):
+    """
+    Build the path of the expanded action sets of a report.
+
+    :param output: The path of the report, in any of the OUTPUT_FORMATS.
+    :return: The path of the expanded action sets.
+    """
+    return excel_output_path(output)[:-len('.xlsx')] + '.actions.json'
+
+
+def export_expanded_actions(results, destination, expander, policy_cache=None):
+    """
+    Write the expanded, deduplicated action sets of every policy of a report.
+
+    The managed policies (default version) and the inline policies of the users,
+    groups and roles are expanded in a single batch. Each distinct action set is
+    written once under ActionSets, keyed by its hash, and the policies reference
+    their Allow and Deny sets by key, since many policies grant the same actions.
+
+    :param results: A dict of report list name to entities.
+    :param destination: The path of the expanded action sets.
+    :param expander: An ActionExpander.
+    :param policy_cache: A PolicyDocumentCache to resolve the DocumentHash references with.
+    :return: A dict of the number of policies, of distinct action sets and of managed
+      policies whose document could not be resolved.
+    """
+    policies = []
+    documents = []
+    unresolved = 0
+    for arn, document in _managed_policy_documents(results, policy_cache).items():
+        policy = {"Type": "managed", "PolicyArn": arn}
+        if document is None:
+            # The document left the policy cache, its actions are unknown rather than none.
+            policy["Unresolved"] = True
+            unresolved += 1
+        policies.append(policy)
+        documents.append(document)
+    for list_name, inline_list in INLINE_POLICY_LISTS.items():
+        for entity in results.get(list_name, []):
+            for policy in entity.get(inline_list) or []:
+                policies.append({
+                    "Type": "inline",
+                    "PrincipalArn": entity.get("Arn"),
+                    "PolicyName": policy.get("PolicyName"),
+                })
+                documents.append(_policy_document(policy.get("PolicyDocument")))
+
+    action_sets = {}
+
+    def action_set_key(actions):
+        content = '\n'.join(sorted(actions))
+        key = hashlib.sha256(content.encode('utf-8')).hexdigest()[:16]
+        if key not in action_sets:
+            action_sets[key] = sorted(actions)
+        return key
+
+    for policy, actions in zip(policies, expander.expand_documents(documents)):
+        if policy.get("Unresolved"):
+            continue
+        for effect, effect_actions in actions.items():
+            policy[effect] = action_set_key(effect_actions)
+            policy[f"{effect}Count"] = len(effect_actions)
+
+    temporary_path = f"{destination}.{os.getpid()}.tmp"
+    with open(temporary_path, 'w', encoding='utf-8') as f:
+        # json.dumps encodes in C, json.dump to a file does not.
+        f.write(json.dumps({
+            "CatalogVersion": expander.version,
+            "Cache": expander.cache_info(),
+            "Policies": policies,
+            "ActionSets": action_sets,
+        }))
+    os.replace(temporary_path, destination)
+    print(
+        emoji.emojize(
+            f":white_check_mark:  Expanded actions of {len(policies)} policies "
+            f"({len(action_sets)} distinct set(s)) written to {destination}.",
+            language='alias',
+        )
+    )
+    if unresolved:
+        logger.warning("%d managed policies are not in the policy cache and are not expanded", unresolved)
+    return {"policies": len(policies), "action_sets": len(action_sets), "unresolved": unresolved}
+
+
+def _account_label(profile, role_arn=None):
+    """
+    Build a file name safe label for an account scan target.
+
+    :param profile: Name of the profile in the AWS Credentials file.
+    :param role_arn: The ARN of the role assumed for the scan, if any.
+    :return: The account id and role name for role targets, the profile name otherwise.
+    """
+    if role_arn is not None:
+        # arn:aws:iam::123456789012:role/path/RoleName
+        account_id = role_arn.split(':')[4]
+        label = f"{account_id}-{role_arn.split('/')[-1]}"
+    else:
+        label = profile
+    return ''.join(c if c.isalnum() or c in '-_' else '_' for c in label)
+
+
+def _scan_account(target, output, region, **kwargs):
+    """
+    Generate the report of a single account and capture any failure.
+
+    :param target: A dict with the profile and the optional role_arn of the account.
+    :param output: The path of the JSON report of the account.
+    :param region: The AWS region to execute in.
+    :param kwargs: Passed through to get_account_authorization_details. A rate_limiter gives
+      the settings of the limiter of the account, IAM throttles every account on its own.
+    :return: The index entry of the account.
+    """
+    started = time.perf_counter()
+    entry = {
+        "profile": target["profile"],
+        "role_arn": target.get("role_arn"),
+        "output": output,
+    }
+    rate_limiter = kwargs.pop("rate_limiter", None)
+    if rate_limiter is not None:
+        rate_limiter = rate_limiter.for_account()
+    try:
+        summary = get_account_authorization_details(
+            profile=target["profile"],
+            output=output,
+            region=region,
+            role_arn=target.get("role_arn"),
+            rate_limiter=rate_limiter,
+            **kwargs)
+        entry["status"] = "succeeded"
+        entry["output"] = summary["output"]
+        entry["records"] = summary["records"]
+        if "changes" in summary:
+            entry["changes"] = summary["changes"]
+    except Exception as e:
+        # One bad account must not stop the batch.
+        logger.exception("Scan of %s failed", _account_label(
+            target["profile"], target.get("role_arn")))
+        entry["status"] = "failed"
+        entry["error"] = f"{type(e).__name__}: {e}"
+    if rate_limiter is not None:
+        # Sent back from the worker processes too, the run sums up the accounts.
+        entry["rate_limiter"] = rate_limiter.document()
+    entry["seconds"] = time.perf_counter() - started
+    return entry
+
+
+def scan_accounts(
+    targets,
+    output,
+    region,
+    account_workers=4,
+    account_pool="thread",
+    **kwargs
+):
+    """
+    Generate one report per account on a worker pool and write a combined index.
+
+    :param targets: A list of dicts with the profile and the optional role_arn of each account.
+    :param output: The path of the JSON report, each account report is written next to it.
+    :param region: The AWS region to execute in.
+    :param account_workers: The maximum number of accounts scanned at the same time.
+    :param account_pool: One of ACCOUNT_POOLS.
+    :param kwargs: Passed through to get_account_authorization_details. A since argument is the
+      output of the previous multi-account run, each account is diffed against its own report.
+      A rate_limiter gives the settings of the limiter of every account, and sums them up once
+      the accounts are scanned. The Excel tables are normalized in the account workers unless
+      normalize_workers is given.
+    :return: The combined index.
+    """
+    if account_pool not in ACCOUNT_POOLS:
+        raise ValueError(f"Unknown account pool: {account_pool}")
+
+    # Never open a spreadsheet per account.
+    kwargs["open_in_excel"] = False
+    base = output[:-len('.json')] if output.endswith('.json') else output
+    # Every account appends to the same backend datasets.
+    kwargs["dataset"] = kwargs.get("dataset") or base
+    if kwargs.get("normalize_workers") is None:
+        # The accounts are already scanned in parallel, each normalizes its tables in its own worker.
+        kwargs["normalize_workers"] = 0
+    if account_pool == "process" and kwargs.get("metrics") is not None:
+        # The metrics cannot be shared with worker processes.
+        logger.warning("Stage metrics are not collected with the process account pool")
+        kwargs["metrics"] = None
+    executor_class = ThreadPoolExecutor if account_pool == "thread" else ProcessPoolExecutor
+    # Diff every account against its report of the previous run with the same --output.
+    since = kwargs.pop("since", None)
+    since_base = None
+    if since is not None:
+        since_base = since[:-len('.json')] if since.endswith('.json') else since
+
+    started = time.perf_counter()
+    with executor_class(max_workers=max(1, account_workers)) as executor:
+        futures = [
+            executor.submit(
+                _scan_account,
+                target,
+                f"{base}-{_account_label(target['profile'], target.get('role_arn'))}.json",
+                region,
+                since=since_base and f"{since_base}-{_account_label(target['profile'], target.get('role_arn'))}.json",
+                **kwargs)
+            for target in targets
+        ]
+        # Keep the index in the order the targets were given.
+        accounts = [future.result() for future in futures]
+
+    index = {
+        "GeneratedAt": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "Region": region,
+        "Seconds": time.perf_counter() - started,
+        "Succeeded": sum(1 for entry in accounts if entry["status"] == "succeeded"),
+        "Failed": sum(1 for entry in accounts if entry["status"] == "failed"),
+        "Accounts": accounts,
+    }
+    if kwargs.get("rate_limiter") is not None:
+        kwargs["rate_limiter"].record_accounts(
+            {_account_label(entry["profile"], entry["role_arn"]): entry["rate_limiter"] for entry in accounts},
+            index["Seconds"])
+        index["RateLimiter"] = kwargs["rate_limiter"].document()
+    index_output = f"{base}-index.json"
+    with open(index_output, 'w') as f:
+        json.dump(index, f, indent=4, default=str)
+    print(
+        emoji.emojize(
+            f":white_check_mark:  Index of {len(accounts)} account(s) written to {index_output}.",
+            language='alias',
+        )
+    )
+    for entry in accounts:
+        if entry["status"] == "failed":
+            print(
+                emoji.emojize(
+                    f":cross_mark:  {_account_label(entry['profile'], entry['role_arn'])}: {entry['error']}",
+                    language='alias',
+                )
+            )
+    return index
+
+
+def query_main(argv):
+    """
+    Take in the arguments of the query subcommand and answer it from the permission index.
+
+    :param argv: The command-line arguments after "query".
+    :return: The answer of the query.
+    """
+    parser = argparse.ArgumentParser(prog=f"{os.path.basename(sys.argv[0])} query",
+                                     exit_on_error=False)
 
-def flatten_nested_json_df(df):
+    # The output argument
+    parser.add_argument('-o', '--output',
+                        help='The report whose permission index is queried.'
+                             'Default: ./accountAuthorizationDetailsReport.json',
+                        default='./accountAuthorizationDetailsReport.json')
+
+    # The index argument
+    parser.add_argument('--index',
+                        help='The path of the permission index, instead of the one next to the --output report.'
+                             'Example: --index ./accountAuthorizationDetailsReport.permissions.sqlite',
+                        default=None)
+
+    # The question arguments
+    question = parser.add_mutually_exclusive_group(required=True)
+    question.add_argument('-a', '--action',
+                          help='Find the principals that can perform an action.'
+                               'Example: --action s3:DeleteBucket')
+    question.add_argument('-p', '--principal',
+                          help='List the grants of a user, group or role, by name or ARN.'
+                               'Example: --principal my-role')
+
+    # The resource argument
+    parser.add_argument('--resource',
+                        help='Only consider the grants that apply to this resource ARN, with --action.'
+                             'Example: --resource arn:aws:s3:::my-bucket',
+                        default=None)
+
+    # The json argument
+    parser.add_argument('--json',
+                        help='Print the answer as JSON.',
+                        action='store_true')
+
+    args = parser.parse_args(argv)
+    index_path = args.index or permission_index_path(args.output)
+
+    started = time.perf_counter()
+    try:
+        if args.action is not None:
+            answer = query_action(index_path, args.action, resource=args.resource)
+        else:
+            answer = query_principal(index_path, args.principal)
+    except ValueError as e:
+        parser.error(str(e))
+    seconds = time.perf_counter() - started
+
+    if args.json:
+        print(json.dumps(answer, indent=4))
+        return answer
+
+    def describe(grant):
+        source = grant["Policy"] if grant["Via"] is None else f"{grant['Policy']} via group {grant['Via']}"
+        action = grant["Action"] or f"NotAction {', '.join(grant['NotAction'])}"
+        resources = ', '.join(grant["Resource"])
+        resources = f"NotResource {resources}" if grant["NotResource"] else resources
+        conditional = " (conditional)" if grant["Conditional"] else ""
+        return f"{action} on {resources} from {grant['PolicyType']} {source}{conditional}"
+
+    if args.action is not None:
+        for principal in answer["allowed"]:
+            print(f"{principal['Type']}\t{principal['Arn']}")
+            for grant in principal["Allow"]:
+                print(f"    Allow {describe(grant)}")
+        for principal in answer["denied"]:
+            print(f"{principal['Type']}\t{principal['Arn']}\tdenied")
+            for grant in principal["Deny"]:
+                print(f"    Deny {describe(grant)}")
+        print(f"{len(answer['allowed'])} principal(s) can and {len(answer['denied'])} "
+              f"cannot {args.action}, answered in {seconds * 1000:.1f} ms.")
+    else:
+        for principal in answer:
+            print(f"{principal['Type']}\t{principal['Arn']}")
+            for effect in ("Allow", "Deny"):
+                for grant in principal[effect]:
+                    print(f"    {effect} {describe(grant)}")
+        print(f"{len(answer)} principal(s) named {args.principal}, answered in {seconds * 1000:.1f} ms.")
+    return answer
+
+
+# The entity types served by the snapshot service, with their report lists.
+SERVICE_ENTITY_TYPES = {
+    "users": "UserDetailList",
+    "groups": "GroupDetailList",
+    "roles": "RoleDetailList",
+    "policies": "Policies",
+}
+
+# The encoded responses kept with a snapshot of the snapshot service, in bytes. Larger
+# responses are encoded again on every request that is not answered with a 304.
+SNAPSHOT_RESPONSE_CACHE_BYTES = 16 * 1024 * 1024
+
+
+class AccountSnapshot:
     """
-    Flatten a nested json dataframe.
+    The report of an account held in memory by the SnapshotService.
 
-    :param df: A pandas dataframe with nested json fields.
-    :return: A flattened pandas dataframe.
+    The ETag of a resource is the hash of its encoded body, so a refresh that finds no
+    change keeps the ETags the clients already have. The ETags are kept with the
+    snapshot, a request whose If-None-Match matches is answered without encoding the
+    resource again. The encoded bodies are kept too, up to max_response_bytes, so the
+    snapshot does not hold a second, encoded copy of a large account.
     """
 
-    # reset index to avoid problems with explode
-    df = df.reset_index()
+    def __init__(self, results, seconds, max_response_bytes=SNAPSHOT_RESPONSE_CACHE_BYTES):
+        """
+        :param results: The report lists of the account, a CompactReport.
+        :param seconds: The time the collection took.
+        :param max_response_bytes: The encoded response bodies kept with the snapshot, in bytes.
+        """
+        self.results = results
+        self.seconds = seconds
+        self.max_response_bytes = max_response_bytes
+        self.collected_at = time.time()
+        # The ARNs are read from the compact entities, the entities are only rebuilt when served.
+        self._arns = {}
+        for list_name, entities in results.items():
+            for index, arn in enumerate(entities.field("Arn")):
+                self._arns[arn] = (list_name, index)
+        self._etags = {}
+        self._bodies = {}
+        self._body_bytes = 0
+        self._lock = threading.Lock()
 
-    # print the dataframe shape and columns
-    print(emoji.emojize(f":wrench:  Orignal shape {df.shape}.", language='alias'))
-    print(
-        emoji.emojize(
-            f":wrench:  Original columns: {df.columns}", language='alias'
-        )
-    )
+    def age(self):
+        """
+        :return: The seconds since the snapshot was collected.
+        """
+        return time.time() - self.collected_at
 
-    # search for columns to explode/flatten
-    s = (df.applymap(type) == list).all()
-    # get the list of columns to explode
-    list_columns = s[s].index.tolist()
-    # search for columns to explode/flatten
-    s = (df.applymap(type) == dict).all()
-    dict_columns = s[s].index.tolist()
+    def entity(self, list_name, arn):
+        """
+        Find an entity of the snapshot by ARN.
 
-    # print the columns to explode/flatten
-    print(f"lists: {list_columns}, dicts: {dict_columns}")
+        :param list_name: The report list the entity must be in.
+        :param arn: The ARN of the entity.
+        :return: The entity dict, or None when the list has no entity with this ARN.
+        """
+        found = self._arns.get(arn)
+        if found is None or found[0] != list_name:
+            return None
+        return self.results[list_name][found[1]]
 
-    # loop until there are no more columns to explode/flatten
-    while len(list_columns) > 0 or len(dict_columns) > 0:
-        new_columns = []
+    def response(self, key, build, not_modified=None):
+        """
+        Return the encoded response of a resource of the snapshot.
 
-        for col in dict_columns:
-            # print the column being flattened
-            print(emoji.emojize(f":wrench:  Flattening: {col}.", language='alias'))
-            # explode dictionaries horizontally, adding new columns
-            horiz_exploded = pd.json_normalize(df[col]).add_prefix(f'{col}.')
-            # reset index to avoid problems with explode
-            horiz_exploded.index = df.index
-            # join the new columns to the original dataframe
-            df = pd.concat([df, horiz_exploded], axis=1).drop(columns=[col])
-            # add the new columns to the list of columns to explode/flatten
-            new_columns.extend(horiz_exploded.columns)  # inplace
+        :param key: The key of the resource, e.g. (list_name, arn).
+        :param build: Called without arguments to build the JSON value of the resource.
+        :param not_modified: Called with the ETag of the resource, True when the client has it.
+        :return: A tuple of the ETag and the encoded body, None when not_modified.
+        """
+        with self._lock:
+            etag = self._etags.get(key)
+            body = self._bodies.get(key)
+        if etag is not None and not_modified is not None and not_modified(etag):
+            return etag, None
+        if body is None:
+            body = json.dumps(build(), default=str).encode('utf-8')
+            etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+            with self._lock:
+                self._etags[key] = etag
+                if key not in self._bodies and self._body_bytes + len(body) <= self.max_response_bytes:
+                    self._bodies[key] = body
+                    self._body_bytes += len(body)
+        if not_modified is not None and not_modified(etag):
+            return etag, None
+        return etag, body
 
-        # check if there are still a dict or list of fields to flatten
-        for col in list_columns:
-            print(emoji.emojize(f":wrench:  Exploding: {col}.", language='alias'))
-            # explode lists vertically, adding new columns
-            df = df.drop(columns=[col]).join(df[col].explode().to_frame())
-            # add the new columns to the list of columns to explode/flatten
-            new_columns.append(col)
 
-        # check if there are still dict o list fields to flatten
-        s = (df[new_columns].applymap(type) == list).all()
-        list_columns = s[s].index.tolist()
+class SnapshotService:
+    """
+    Keep the latest report of every account in memory and refresh it when it is older than the TTL.
 
-        s = (df[new_columns].applymap(type) == dict).all()
-        dict_columns = s[s].index.tolist()
+    The snapshots are collected with iter_account_authorization_details into a CompactReport,
+    without any file. Concurrent requests for the same account wait on a single in-flight
+    refresh instead of each calling IAM, and a failed refresh keeps serving the previous
+    snapshot until the next request retries it. The policy document cache is evicted
+    after every refresh, so it stays within its size however long the service runs.
+    """
 
-        print(
-            emoji.emojize(
-                f":wrench:  Lists: {list_columns} Dictionaries {dict_columns}.",
-                language='alias',
-            )
-        )
+    def __init__(
+        self,
+        targets,
+        region,
+        ttl=300,
+        policy_cache=None,
+        rate_limiter=None,
+        policy_cache_max_bytes=256 * 1024 * 1024,
+        max_response_bytes=SNAPSHOT_RESPONSE_CACHE_BYTES,
+        **collect_kwargs
+    ):
+        """
+        :param targets: A list of dicts with a "profile" and an optional "role_arn", one per account.
+        :param region: The AWS region to execute in.
+        :param ttl: The seconds a snapshot is served before it is refreshed.
+        :param policy_cache: The directory of a PolicyDocumentCache shared by the accounts.
+        :param rate_limiter: The settings of the AdaptiveRateLimiter of every account, kept across its refreshes.
+        :param policy_cache_max_bytes: The size past which the policy document cache is evicted.
+        :param max_response_bytes: The encoded response bodies kept with every snapshot, in bytes.
+        :param collect_kwargs: Passed through to iter_account_authorization_details.
+        """
+        self.targets = {
+            _account_label(target["profile"], target.get("role_arn")): target for target in targets
+        }
+        self.region = region
+        self.ttl = ttl
+        self.rate_limiter = rate_limiter
+        self.collect_kwargs = collect_kwargs
+        self._rate_limiters = {}
+        self.max_response_bytes = max_response_bytes
+        self.policy_cache = None
+        if policy_cache is not None:
+            self.policy_cache = PolicyDocumentCache(policy_cache, max_bytes=policy_cache_max_bytes)
+        self.refreshes = 0
+        self._snapshots = {}
+        self._in_flight = {}
+        self._lock = threading.Lock()
 
-    # print the dataframe shape and columns
-    print(emoji.emojize(f":wrench:  Final shape {df.shape}.", language='alias'))
-    print(
-        emoji.emojize(
-            f":wrench:  Final columns: {df.columns}", language='alias'
-        )
-    )
-    return df
+    def _collect(self, account):
+        """
+        Collect the report of an account.
 
+        :param account: The label of the account.
+        :return: An AccountSnapshot.
+        """
+        target = self.targets[account]
+        rate_limiter = None
+        if self.rate_limiter is not None:
+            # IAM throttles every account on its own, so each account gets its own limiter.
+            with self._lock:
+                if account not in self._rate_limiters:
+                    self._rate_limiters[account] = self.rate_limiter.for_account()
+                rate_limiter = self._rate_limiters[account]
+        started = time.perf_counter()
+        records = iter_account_authorization_details(
+            profile=target["profile"],
+            region=self.region,
+            role_arn=target.get("role_arn"),
+            policy_cache=self.policy_cache,
+            rate_limiter=rate_limiter,
+            **self.collect_kwargs)
+        results = results_from_records(records, compact=True)
+        seconds = time.perf_counter() - started
+        if self.policy_cache is not None:
+            self.policy_cache.evict()
+        return AccountSnapshot(results, seconds, max_response_bytes=self.max_response_bytes)
 
-def get_account_authorization_details(
-    profile,
-    output,
-    region,
-    include_non_default_policy_versions=False,
-    include_unattached=False,
-    open_in_excel=False,
-    flatten_json=False
-):
-    """
-    Run aws iam get-account-authorization-details and store locally.
-    :param profile: Name of the profile in the AWS Credentials file
-    :param output: The path of a directory to store the results.
-    :param include_non_default_policy_versions: When downloading AWS managed policy documents,
-      also include the non-default policy versions. Note that this will dramatically increase 
-      the size of the downloaded file.
+    def snapshot(self, account):
+        """
+        Return the snapshot of an account, refreshing it first when it is missing or expired.
+
+        :param account: The label of the account.
+        :return: An AccountSnapshot.
+        """
+        if account not in self.targets:
+            raise KeyError(account)
+        with self._lock:
+            current = self._snapshots.get(account)
+            if current is not None and current.age() < self.ttl:
+                return current
+            refresh = self._in_flight.get(account)
+            owner = refresh is None
+            if owner:
+                refresh = Future()
+                self._in_flight[account] = refresh
+                self.refreshes += 1
+
+        if owner:
+            # This request refreshes the account, the concurrent ones wait for it.
+            try:
+                snapshot = self._collect(account)
+            except Exception as e:
+                with self._lock:
+                    del self._in_flight[account]
+                refresh.set_exception(e)
+            else:
+                with self._lock:
+                    self._snapshots[account] = snapshot
+                    del self._in_flight[account]
+                refresh.set_result(snapshot)
+
+        try:
+            return refresh.result()
+        except Exception as e:
+            if current is None:
+                raise
+            logger.warning("Could not refresh %s, serving the previous snapshot: %s", account, e)
+            return current
+
+    def accounts(self):
+        """
+        Describe the accounts of the service.
+
+        :return: A list of dicts with the account label, the age of its snapshot and its rate limiter.
+        """
+        with self._lock:
+            snapshots = dict(self._snapshots)
+            rate_limiters = dict(self._rate_limiters)
+        described = []
+        for account in self.targets:
+            snapshot = snapshots.get(account)
+            rate_limiter = rate_limiters.get(account)
+            described.append({
+                "Account": account,
+                "Age": None if snapshot is None else round(snapshot.age(), 3),
+                "CollectionSeconds": None if snapshot is None else round(snapshot.seconds, 3),
+                "RateLimiter": None if rate_limiter is None else rate_limiter.document(),
+            })
+        return described
+
+
+class SnapshotRequestHandler(http_server.BaseHTTPRequestHandler):
     """
-    print()
-    print(emoji.emojize(
-        ":heavy_exclamation_mark:  Starting report generation.",
-        language='alias'))
+    Serve the snapshots of a SnapshotService as JSON.
 
-    config = Config(connect_timeout=5,
-                    retries={"max_attempts": 10})
+    GET /accounts lists the accounts, GET /accounts/<account> counts its entities,
+    GET /accounts/<account>/<users|groups|roles|policies> returns a list and
+    GET /accounts/<account>/<users|groups|roles|policies>?arn=<arn> returns one entity.
+    The snapshot responses carry an ETag, and a request whose If-None-Match matches it
+    gets a 304 without a body.
+    """
 
-    # Create a boto3 session
-    session = boto3.Session(profile_name=profile,
-                            region_name=region)
-    # Create an IAM client
-    iam_client = session.client("iam",
-                                config=config,
-                                use_ssl=True,
-                                verify=True
-                                )
+    def log_message(self, format, *args):
+        # Requests are logged with the rest of the script, not to stderr.
+        logger.info("%s " + format, self.address_string(), *args)
 
-    results = {
-        "UserDetailList": [],
-        "GroupDetailList": [],
-        "RoleDetailList": [],
-        "Policies": [],
-    }
+    def _send_json(self, status, value, etag=None, body=None, snapshot=None):
+        if body is None:
+            body = json.dumps(value, default=str).encode('utf-8')
+        self.send_response(status)
+        if etag is not None:
+            self.send_header("ETag", etag)
+        if snapshot is not None:
+            self.send_header("Age", str(int(snapshot.age())))
+            remaining = max(0, int(self.server.service.ttl - snapshot.age()))
+            self.send_header("Cache-Control", f"max-age={remaining}")
+        if status == 304:
+            self.end_headers()
+            return
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
 
-    # Get the account authorization details report
-    paginator = iam_client.get_paginator("get_account_authorization_details")
+    def _not_modified(self, etag):
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is None:
+            return False
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        # Weak comparison, as for GET requests.
+        return "*" in tags or etag in tags or f"W/{etag}" in tags
 
-    # Iterate over the pages of results for users
-    for page in paginator.paginate(Filter=["User"]):
-        # Always add inline user policies
-        results["UserDetailList"].extend(page["UserDetailList"])
-    # Iterate over the pages of results for groups
-    for page in paginator.paginate(Filter=["Group"]):
-        results["GroupDetailList"].extend(page["GroupDetailList"])
-    # Iterate over the pages of results for roles
-    for page in paginator.paginate(Filter=["Role"]):
-        results["RoleDetailList"].extend(page["RoleDetailList"])
-        for policy in page["Policies"]:
-            # Ignore Service Linked Roles which cannot be modified and will create messy results.
-            results["RoleDetailList"].append(policy)
-    # Iterate over the pages of results for local managed policies
-    for page in paginator.paginate(Filter=["LocalManagedPolicy"]):
-        # Add customer-managed policies IF they are attached to IAM principals
-        for policy in page["Policies"]:
-            if policy["AttachmentCount"] > 0 or include_unattached:
-                results["Policies"].append(policy)
-    for page in paginator.paginate(Filter=["AWSManagedPolicy"]):
-        for policy in page["Policies"]:
-            # Add customer-managed policies if they are attached to IAM principals or if `--include-unattached` is specified
-            if policy["AttachmentCount"] > 0 or include_unattached:
-                if include_non_default_policy_versions:
-                    results["Policies"].append(policy)
-                else:
-                    policy_version_list = []
-                    for policy_version in policy.get("PolicyVersionList"):
-                        if policy_version.get("VersionId") == policy.get(
-                            "DefaultVersionId"
-                        ):
-                            policy_version_list.append(policy_version)
-                            break
-                    # Create a new entry with only the default policy version
-                    entry = {
-                        "PolicyName": policy.get("PolicyName"),
-                        "PolicyId": policy.get("PolicyId"),
-                        "Arn": policy.get("Arn"),
-                        "Path": policy.get("Path"),
-                        "DefaultVersionId": policy.get("DefaultVersionId"),
-                        "AttachmentCount": policy.get("AttachmentCount"),
-                        "PermissionsBoundaryUsageCount": policy.get(
-                            "PermissionsBoundaryUsageCount"
-                        ),
-                        "IsAttachable": policy.get("IsAttachable"),
-                        "CreateDate": policy.get("CreateDate"),
-                        "UpdateDate": policy.get("UpdateDate"),
-                        "PolicyVersionList": policy_version_list,
-                    }
-                    results["Policies"].append(entry)
+    def do_GET(self):
+        url = urllib_parse.urlsplit(self.path)
+        parts = [urllib_parse.unquote(part) for part in url.path.split('/') if part]
+        arn = urllib_parse.parse_qs(url.query).get("arn", [None])[0]
+        service = self.server.service
 
-    # Let the user know that the report is complete.
-    print(emoji.emojize(":white_check_mark:  JSON Report generation complete.",
-                        language='alias'))
+        if parts == ["accounts"]:
+            self._send_json(200, {"Accounts": service.accounts()})
+            return
+        if len(parts) not in (2, 3) or parts[0] != "accounts":
+            self._send_json(404, {"Error": f"Unknown path: {url.path}"})
+            return
+        if len(parts) == 3 and parts[2] not in SERVICE_ENTITY_TYPES:
+            self._send_json(404, {"Error": f"Unknown entity type: {parts[2]}, "
+                                           f"expected one of {', '.join(SERVICE_ENTITY_TYPES)}"})
+            return
 
-    # Write the results to a file.
-    with open(output, 'w') as f:
-        json.dump(results, f, indent=4, default=str)
-        print(
-            emoji.emojize(
-                f":white_check_mark:  Report written to {output}.",
-                language='alias',
-            )
-        )
+        try:
+            snapshot = service.snapshot(parts[1])
+        except KeyError:
+            self._send_json(404, {"Error": f"Unknown account: {parts[1]}"})
+            return
+        except Exception as e:
+            logger.error("Could not collect %s: %s", parts[1], e)
+            self._send_json(502, {"Error": f"Could not collect {parts[1]}: {e}"})
+            return
 
-    # use pandas to read the json file and convert it to an excel file
-    print(emoji.emojize(
-        ":white_check_mark:  Converting JSON to Excel.", language='alias'))
-    # write the json file to an excel file
-    with open(output) as f:
-        # load the json file
-        data = json.load(f)
-        # # convert the json file to a pandas dataframe
-        df = pd.json_normalize(data, record_path=['UserDetailList'],
-                               # meta=['GroupDetailList', 'RoleDetailList', 'Policies'']
-                               errors='ignore'
-                               )
-        if flatten_json:
-            df_flattened = flatten_nested_json_df(df)
-            # write the excel file
-            df_flattened.to_excel(output.replace('.json', '.xlsx'),
-                                  sheet_name='UserDetailList',
-                                  index=False)
+        if len(parts) == 2:
+            key = None
+            build = lambda: {list_name: len(entities) for list_name, entities in snapshot.results.items()}
+        elif arn is None:
+            key = (parts[2], None)
+            build = lambda: list(snapshot.results[SERVICE_ENTITY_TYPES[parts[2]]])
         else:
-            # write the excel file
-            df.to_excel(output.replace('.json', '.xlsx'),
-                        sheet_name='UserDetailList',
-                        index=False)
-        # Let the user know that the report has been written to an excel file
-        print(
-            emoji.emojize(
-                f":white_check_mark:  Excel report written to {output.replace('.json', '.xlsx')}.",
-                language='alias',
-            )
-        )
+            entity = snapshot.entity(SERVICE_ENTITY_TYPES[parts[2]], arn)
+            if entity is None:
+                self._send_json(404, {"Error": f"No {parts[2]} entity with ARN {arn}"}, snapshot=snapshot)
+                return
+            key = (parts[2], arn)
+            build = lambda: entity
+        etag, body = snapshot.response(key, build, not_modified=self._not_modified)
+        if body is None:
+            self._send_json(304, None, etag=etag, snapshot=snapshot)
+        else:
+            self._send_json(200, None, etag=etag, body=body, snapshot=snapshot)
 
-    # open the excel file
-    if open_in_excel:
-        # determine if platform is Windows, Linux or Mac
-        if platform.system() == 'Windows':
-            # check if Excel is installed
-            # if which('excel.exe') is None:
-            #     print(emoji.emojize(
-            #         'Excel is not installed :cross_mark:',
-            #         language='alias'))
-            #     raise Exception("Excel is not installed")
-            # else:
-            print(emoji.emojize(
-                ":open_file_folder: Opening {} in Excel in Windows").format(output.replace('.json', '.xlsx')))
-            # nosec B605: start is used to open a file with excel.exe
-            os.system(f"start excel.exe {output.replace('.json', '.xlsx')}")
-        elif platform.system() == 'Linux':
-            # check if LibreOffice is installed
-            # if which('libreoffice') is None:
-            #     print(emoji.emojize(
-            #         'LibreOffice is not installed :cross_mark:',
-            #         language='alias'))
-            #     raise Exception("LibreOffice is not installed")
-            # else:
-            print(emoji.emojize(
-                ":open_file_folder: Opening {} in LibreOffice in Linux").format(output.replace('.json', '.xlsx')))
-            # nosec B605: libreoffice is used to open a file with LibreOffice
-            os.system(f"libreoffice {output.replace('.json', '.xlsx')}")
-        elif platform.system() == 'Darwin':
-            # Check if Excel is installed in Mac
-            # if which('Microsoft Excel.app') is None:
-            #     print(emoji.emojize(
-            #         'Excel is not installed :cross_mark:',
-            #         language='alias'))
-            #     raise Exception("Excel is not installed")
-            # else:
-            print(emoji.emojize(
-                ":open_file_folder: Opening {} in Excel in Mac").format(output.replace('.json', '.xlsx')))
-            # nosec B605: open is used to open a file with Microsoft Excel
-            os.system(f"""open -a "Microsoft Excel" {output.replace('.json', '.xlsx')}""")
-        return 0
+
+class SnapshotServer(http_server.ThreadingHTTPServer):
+    """
+    A threaded HTTP server for a SnapshotService, every request is handled on its own thread.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, service, host="127.0.0.1", port=8080):
+        """
+        :param service: The SnapshotService to serve.
+        :param host: The address to listen on, the local interface by default.
+        :param port: The port to listen on, 0 for any free port.
+        """
+        self.service = service
+        super().__init__((host, port), SnapshotRequestHandler)
+
+
+def serve_main(argv):
+    """
+    Take in the arguments of the serve subcommand and serve the account snapshots until interrupted.
+
+    :param argv: The command-line arguments after "serve".
+    """
+    parser = argparse.ArgumentParser(prog=f"{os.path.basename(sys.argv[0])} serve",
+                                     exit_on_error=False)
+
+    # The AWS region argument
+    parser.add_argument('-r', '--region',
+                        help='The AWS region you wish to execute the script in.'
+                             'Defaults to us-east-1.',
+                        default='us-east-1')
+
+    # The AWS CLI profile argument
+    parser.add_argument('-p', '--profile',
+                        help='AWS profile, served when neither --profiles nor --role-arns is given.'
+                             'Default: default',
+                        default='default')
+
+    # The profiles argument
+    parser.add_argument('--profiles',
+                        help='Serve several accounts, one per AWS profile.'
+                             'Example: --profiles dev test prod',
+                        nargs='+',
+                        default=[])
+
+    # The role ARNs argument
+    parser.add_argument('--role-arns',
+                        help='Serve several accounts, one per role assumed with --profile.'
+                             'Example: --role-arns arn:aws:iam::111111111111:role/Audit',
+                        nargs='+',
+                        default=[])
+
+    # The host and port arguments
+    parser.add_argument('--host',
+                        help='The address to listen on.'
+                             'Default: 127.0.0.1',
+                        default='127.0.0.1')
+    parser.add_argument('--port',
+                        help='The port to listen on.'
+                             'Default: 8080',
+                        default=8080,
+                        type=int)
+
+    # The TTL argument
+    parser.add_argument('--ttl',
+                        help='The seconds a snapshot is served before the next request refreshes it.'
+                             'Default: 300',
+                        default=300.0,
+                        type=float)
+
+    # The warm argument
+    parser.add_argument('--warm',
+                        help='Collect every account when the service starts instead of on its first request.',
+                        action='store_true')
+
+    # The collection arguments
+    parser.add_argument('-i', '--include-non-default-policy-versions',
+                        help='Also include the non-default versions of the AWS managed policies.',
+                        action='store_true')
+    parser.add_argument('-u', '--include-unattached',
+                        help='Also include the unattached managed policies.',
+                        action='store_true')
+    parser.add_argument('-c', '--collection-strategy',
+                        help='How to collect the snapshots, see the report --collection-strategy.'
+                             'Default: concurrent',
+                        default='concurrent',
+                        choices=COLLECTION_STRATEGIES)
+    parser.add_argument('--policy-cache',
+                        help='A directory to cache the AWS managed policy documents in, shared by every account.',
+                        default=None)
+    parser.add_argument('--policy-cache-max-mb',
+                        help='The size in MiB past which the least recently used cached documents are evicted, '
+                             'after every refresh.'
+                             'Default: 256',
+                        default=256,
+                        type=int)
+    parser.add_argument('--rate-limit',
+                        help='Pace the IAM calls of every account with an adaptive rate limiter starting at this '
+                             'rate, in calls per second. 0 disables the limiter.'
+                             f'Default: {DEFAULT_RATE_LIMIT:g}',
+                        default=DEFAULT_RATE_LIMIT,
+                        type=float)
+    parser.add_argument('--max-rate',
+                        help='The highest rate the rate limiter raises the IAM calls to, in calls per second.'
+                             f'Default: {DEFAULT_MAX_RATE:g}',
+                        default=DEFAULT_MAX_RATE,
+                        type=float)
+
+    args = parser.parse_args(argv)
+
+    targets = [{"profile": profile} for profile in args.profiles]
+    targets.extend({"profile": args.profile, "role_arn": role_arn} for role_arn in args.role_arns)
+    if not targets:
+        targets = [{"profile": args.profile}]
+    rate_limiter = None
+    if args.rate_limit > 0:
+        rate_limiter = AdaptiveRateLimiter(rate=args.rate_limit,
+                                           max_rate=max(args.rate_limit, args.max_rate))
+    service = SnapshotService(targets,
+                              args.region,
+                              ttl=args.ttl,
+                              policy_cache=args.policy_cache,
+                              rate_limiter=rate_limiter,
+                              policy_cache_max_bytes=args.policy_cache_max_mb * 1024 * 1024,
+                              include_non_default_policy_versions=args.include_non_default_policy_versions,
+                              include_unattached=args.include_unattached,
+                              collection_strategy=args.collection_strategy)
+    server = SnapshotServer(service, host=args.host, port=args.port)
+
+    if args.warm:
+        for account in service.targets:
+            threading.Thread(target=service.snapshot, args=(account,), daemon=True).start()
+
+    print(emoji.emojize(
+        f":globe_with_meridians:  Serving {len(service.targets)} account(s) on "
+        f"http://{args.host}:{server.server_address[1]}/accounts (TTL {args.ttl:g}s).",
+        language='alias'))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    print(emoji.emojize(
+        f":checkered_flag:  Stopped after {service.refreshes} refresh(es).", language='alias'))
 
 
 def main():
@@ -290,6 +4764,16 @@ def main():
     logging.basicConfig(level=logging.ERROR,
                         format='%(levelname)s: %(message)s')
 
+    # The query subcommand answers from the permission index, without AWS or the report.
+    if len(sys.argv) > 1 and sys.argv[1] == "query":
+        query_main(sys.argv[2:])
+        return
+
+    # The serve subcommand keeps the snapshots in memory and serves them over HTTP.
+    if len(sys.argv) > 1 and sys.argv[1] == "serve":
+        serve_main(sys.argv[2:])
+        return
+
     # Add arguments to the parser.
     parser = argparse.ArgumentParser(exit_on_error=False)
 
@@ -376,11 +4860,288 @@ def main():
 
     # The flatten argument
     parser.add_argument('-f', '--flatten',
-                        help='Flatten the JSON file.',
+                        help='Flatten the JSON file, one child sheet per list field.',
+                        action='store_true')
+
+    # The json-only argument
+    parser.add_argument('-j', '--json-only',
+                        help='Only write the JSON report and its snapshot, without the Excel report. '
+                             'pandas and openpyxl are then never loaded, for the fastest startup.',
+                        action='store_true')
+
+    # The permission index argument
+    parser.add_argument('--permission-index',
+                        help='Resolve the inline, attached and group policies of every user, group and role into '
+                             'an effective-permission index next to the output, queried with the query subcommand.',
+                        action='store_true')
+
+    # The expand actions argument
+    parser.add_argument('--expand-actions',
+                        help='Expand the action patterns of every policy against the service-action catalog and '
+                             'write the deduplicated action sets next to the output.',
+                        action='store_true')
+
+    # The action catalog argument
+    parser.add_argument('--action-catalog',
+                        help='The service-action catalog the actions are expanded against. It is built from the '
+                             'botocore service models when missing, and rebuilt when botocore is upgraded.'
+                             'Default: ~/.cache/iam-service-actions.json',
+                        default='~/.cache/iam-service-actions.json')
+
+    # The normalize workers argument
+    parser.add_argument('--normalize-workers',
+                        help='The number of worker processes the Excel tables are built in. '
+                             '1 builds them in the main process.'
+                             'Default: the number of CPUs',
+                        default=None,
+                        type=int)
+
+    # The normalize chunk size argument
+    parser.add_argument('--normalize-chunk-size',
+                        help='The number of entities a worker process normalizes at a time.'
+                             'Default: 5000',
+                        default=NORMALIZE_CHUNK_SIZE,
+                        type=int)
+
+    # The compact argument
+    parser.add_argument('--compact',
+                        help='Hold the report in memory with shared keys, interned strings and policy documents '
+                             'stored once, to process large accounts with less memory.',
+                        action='store_true')
+
+    # The rate limit argument
+    parser.add_argument('--rate-limit',
+                        help='Pace the IAM calls of every account with an adaptive rate limiter starting at this '
+                             'rate, in calls per second: the rate is raised while the calls succeed and cut on '
+                             'throttles. 0 disables the limiter, the calls then only rely on the botocore retries.'
+                             f'Default: {DEFAULT_RATE_LIMIT:g}',
+                        default=DEFAULT_RATE_LIMIT,
+                        type=float)
+
+    # The max rate argument
+    parser.add_argument('--max-rate',
+                        help='The highest rate the rate limiter raises the IAM calls to, in calls per second.'
+                             f'Default: {DEFAULT_MAX_RATE:g}',
+                        default=DEFAULT_MAX_RATE,
+                        type=float)
+
+    # The checkpoint argument
+    parser.add_argument('--checkpoint',
+                        help='Save the progress of the collection next to the output after every page, and resume '
+                             'from it when a previous run was interrupted. It is removed once the report is written.',
+                        action='store_true')
+
+    # The check-aws-cli argument
+    parser.add_argument('--check-aws-cli',
+                        help='Check that the AWS CLI version 2 is installed before the report. '
+                             'The report only uses boto3, the check is skipped by default.',
+                        action='store_true')
+
+    # The collection strategy argument
+    parser.add_argument('-c', '--collection-strategy',
+                        help='How to collect the report. "concurrent" paginates every filter at the same time, '
+                             '"single-pass" walks one unfiltered pagination and makes the fewest API calls.'
+                             'Default: concurrent'
+                             'Example: --collection-strategy single-pass',
+                        default='concurrent',
+                        choices=COLLECTION_STRATEGIES)
+
+    # The max workers argument
+    parser.add_argument('-w', '--max-workers',
+                        help='The maximum number of filters paginated at the same time.'
+                             'Default: 5'
+                             'Example: --max-workers 2',
+                        default=len(COLLECTION_FILTERS),
+                        type=int)
+
+    # The output format argument
+    parser.add_argument('--output-format',
+                        help='The report format. "json" holds the report in memory and writes it at the end, '
+                             '"jsonl" and "json-stream" write each entity as its page arrives.'
+                             'Default: json'
+                             'Example: --output-format jsonl',
+                        default='json',
+                        choices=OUTPUT_FORMATS)
+
+    # The compression argument
+    parser.add_argument('--compression',
+                        help='Compress the streamed report formats.'
+                             'Default: none'
+                             'Example: --compression gzip',
+                        default='none',
+                        choices=tuple(OUTPUT_COMPRESSIONS))
+
+    # The backends argument
+    parser.add_argument('--backends',
+                        help='Output backends to run next to the JSON and Excel reports.'
+                             'Example: --backends parquet sqlite',
+                        nargs='+',
+                        default=[],
+                        choices=tuple(OUTPUT_BACKENDS))
+
+    # The dataset argument
+    parser.add_argument('--dataset',
+                        help='The path of the backend datasets without extension, '
+                             'each backend adds its own (.parquet directory, .sqlite file).'
+                             'Default: the output without .json'
+                             'Example: --dataset ./iam',
+                        default=None)
+
+    # The since argument
+    parser.add_argument('--since',
+                        help='Diff against a previous report (or its .snapshot.jsonl) and only write the '
+                             'added, removed and changed entities to <output>.delta.jsonl.'
+                             'With --profiles or --role-arns, the --output of the previous run.'
+                             'Example: --since ./accountAuthorizationDetailsReport.json',
+                        default=None)
+
+    # The policy cache argument
+    parser.add_argument('--policy-cache',
+                        help='A directory to cache the AWS managed policy documents in, shared by every '
+                             'account and run. The report references the cached documents by DocumentHash.'
+                             'Example: --policy-cache ~/.cache/iam-policies',
+                        default=None)
+
+    # The policy cache size argument
+    parser.add_argument('--policy-cache-max-mb',
+                        help='The size in MiB past which the least recently used cached documents are evicted.'
+                             'Default: 256'
+                             'Example: --policy-cache-max-mb 512',
+                        default=256,
+                        type=int)
+
+    # The from-json argument
+    parser.add_argument('--from-json',
+                        help='Convert a saved report to Excel without calling the AWS API.'
+                             'Example: --from-json ./accountAuthorizationDetailsReport.json',
+                        default=None)
+
+    # The profiles argument
+    parser.add_argument('--profiles',
+                        help='Scan several accounts, one per AWS profile.'
+                             'Example: --profiles dev test prod',
+                        nargs='+',
+                        default=[])
+
+    # The role ARNs argument
+    parser.add_argument('--role-arns',
+                        help='Scan several accounts, one per role assumed with --profile.'
+                             'Example: --role-arns arn:aws:iam::111111111111:role/Audit arn:aws:iam::222222222222:role/Audit',
+                        nargs='+',
+                        default=[])
+
+    # The account workers argument
+    parser.add_argument('--account-workers',
+                        help='The maximum number of accounts scanned at the same time.'
+                             'Default: 4'
+                             'Example: --account-workers 8',
+                        default=4,
+                        type=int)
+
+    # The account pool argument
+    parser.add_argument('--account-pool',
+                        help='Scan the accounts on a thread or a process pool.'
+                             'Default: thread'
+                             'Example: --account-pool process',
+                        default='thread',
+                        choices=ACCOUNT_POOLS)
+
+    # The metrics out argument
+    parser.add_argument('--metrics-out',
+                        help='Write the wall time, API calls, retries, throttles, rows and peak RSS '
+                             'of every stage to a JSON document.'
+                             'Example: --metrics-out ./metrics.json',
+                        default=None)
+
+    # The cProfile out argument
+    parser.add_argument('--cprofile-out',
+                        help='Profile the whole run with cProfile and write the statistics to a file.'
+                             'Example: --cprofile-out ./run.prof',
+                        default=None)
+
+    # The tracemalloc argument
+    parser.add_argument('--tracemalloc',
+                        help='Trace the Python allocations of the whole run, the peak of every stage and '
+                             'the top allocations are added to the metrics.',
                         action='store_true')
 
     args = parser.parse_args()
 
+    if args.json_only and (args.flatten or args.open_in_excel):
+        parser.error("--json-only does not write the Excel report, it cannot be flattened or opened")
+
+    # Instrument the run when metrics or profiles are requested.
+    metrics = RunMetrics() if args.metrics_out else None
+    if args.tracemalloc:
+        tracemalloc.start()
+    profiler = cProfile.Profile() if args.cprofile_out else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        _run(args, metrics)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.cprofile_out)
+            print(emoji.emojize(":stopwatch:  cProfile statistics written to {}",
+                                language='alias').format(args.cprofile_out))
+        if args.tracemalloc:
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            if metrics is not None:
+                metrics.add_tracemalloc_snapshot(snapshot)
+        if metrics is not None:
+            metrics.write(args.metrics_out)
+            print(emoji.emojize(":stopwatch:  Metrics written to {}",
+                                language='alias').format(args.metrics_out))
+
+
+def _print_compact_report(results):
+    """
+    Display what the entities of a CompactReport share.
+
+    :param results: A CompactReport.
+    """
+    stats = results.stats()
+    print(
+        emoji.emojize(
+            f":package:  Compact report: {stats['entities']} entities share {stats['shapes']} key shape(s), "
+            f"{stats['strings']} string(s), {stats['dates']} date(s) and {stats['documents']} policy document(s).",
+            language='alias',
+        )
+    )
+
+
+def _print_rate_limiter(rate_limiter):
+    """
+    Display the throughput achieved by the rate limiter.
+
+    :param rate_limiter: An AdaptiveRateLimiter, or None.
+    """
+    if rate_limiter is None:
+        return
+    document = rate_limiter.document()
+    throughput = ""
+    if document["CallsPerSecond"] is not None:
+        throughput = f" at {document['CallsPerSecond']:.2f}/s"
+    print(
+        emoji.emojize(
+            f":stopwatch:  IAM calls: {document['Calls']}{throughput}, "
+            f"{document['Throttles']} throttle(s), {document['WaitedSeconds']:.2f}s waited, "
+            f"rate {document['LowestRate']:.2f}-{document['HighestRate']:.2f}/s.",
+            language='alias',
+        )
+    )
+
+
+def _run(args, metrics=None):
+    """
+    Generate the reports requested by the command-line arguments.
+
+    :param args: The parsed command-line arguments.
+    :param metrics: A RunMetrics to record the stages of the run in.
+    """
+
     """ 
     The below outputs are for making the end user support staff lives easier;
     especially when dealing with end user PEBKAC & PICNIC issues.
@@ -408,37 +5169,35 @@ def main():
             'Python version is OK :check_mark_button:',
             language='alias'))
 
-    # Check that the AWS CLI is installed.
-    if which('aws') is None:
-        print(emoji.emojize(
-            'AWS CLI is not installed :cross_mark:',
-            language='alias'))
-        raise ValueError("AWS CLI is not installed")
-    else:
-        print(emoji.emojize(
-            'AWS CLI is installed :check_mark_button:',
-            language='alias'))
-        # Get the version of the AWS CLI.
-        aws_cli_version = subprocess.check_output(
-            ['aws', '--version']).decode('utf-8').split(' ')[0]
-        # Check that the AWS CLI version is less than verson 2.
-        if int(aws_cli_version.split('/')[1].split('.')[0]) < 2:
-            # Print an error message and raise an exception.
+    # Check that the AWS CLI is installed when asked, unless only a saved report is converted.
+    if args.check_aws_cli and args.from_json is None:
+        if which('aws') is None:
             print(emoji.emojize(
-                'You must use AWS CLI version 2 or higher :heavy_exclamation_mark:',
+                'AWS CLI is not installed :cross_mark:',
                 language='alias'))
-            raise ValueError("You must use AWS CLI version 2 or higher")
+            raise ValueError("AWS CLI is not installed")
         else:
-            # Display the version of the AWS CLI.
-            print(emoji.emojize(":ok:  AWS CLI version: {}", language='alias').format(
-                aws_cli_version.split('/')[1]))
+            print(emoji.emojize(
+                'AWS CLI is installed :check_mark_button:',
+                language='alias'))
+            # Get the version of the AWS CLI.
+            aws_cli_version = subprocess.check_output(
+                ['aws', '--version']).decode('utf-8').split(' ')[0]
+            # Check that the AWS CLI version is less than verson 2.
+            if int(aws_cli_version.split('/')[1].split('.')[0]) < 2:
+                # Print an error message and raise an exception.
+                print(emoji.emojize(
+                    'You must use AWS CLI version 2 or higher :heavy_exclamation_mark:',
+                    language='alias'))
+                raise ValueError("You must use AWS CLI version 2 or higher")
+            else:
+                # Display the version of the AWS CLI.
+                print(emoji.emojize(":ok:  AWS CLI version: {}", language='alias').format(
+                    aws_cli_version.split('/')[1]))
 
     # Display the version of the Boto3 library.
     print(emoji.emojize(":package:  Boto3 version: {}",
           language='alias').format(boto3.__version__))
-    # Display the version of the Requests library.
-    print(emoji.emojize(":package:  Requests version: {}",
-          language='alias').format(requests.__version__))
     # Display the version of the Emoji library.
     print(emoji.emojize(":package:  Emoji version: {}",
           language='alias').format(emoji.__version__))
@@ -471,6 +5230,12 @@ def main():
         args.output = args.output.split('.')[0]
         #  add .json file extension
         args.output = args.output + '.json'
+    # Display the collection strategy.
+    print(emoji.emojize(":arrow_right:  Collection strategy: {}", language='alias').format(
+        args.collection_strategy))
+    # Display the output format.
+    print(emoji.emojize(":arrow_right:  Output format: {} (compression: {})", language='alias').format(
+        args.output_format, args.compression))
     # Display the output directory.
     print(emoji.emojize(":arrow_right:  Output directory and file: {}",
           language='alias').format(args.output))
@@ -478,6 +5243,74 @@ def main():
     print(emoji.emojize(":arrow_right:  Logging level: {}",
           language='alias').format(args.log_level))
 
+    # Convert a saved report without calling the AWS API.
+    if args.from_json is not None:
+        convert_saved_report(args.from_json,
+                             flatten_json=args.flatten,
+                             open_in_excel=args.open_in_excel,
+                             backends=args.backends,
+                             dataset=args.dataset,
+                             metrics=metrics,
+                             json_only=args.json_only,
+                             permission_index=args.permission_index,
+                             policy_cache=args.policy_cache,
+                             expand_actions=args.expand_actions,
+                             action_catalog=args.action_catalog,
+                             compact=args.compact,
+                             normalize_workers=args.normalize_workers,
+                             normalize_chunk_size=args.normalize_chunk_size)
+        print(emoji.emojize(":checkered_flag:  Done!", language='alias'))
+        print('-' * get_terminal_size()[0])
+        return
+
+    # Pace every IAM call of the run with a single rate limiter.
+    rate_limiter = None
+    if args.rate_limit > 0:
+        rate_limiter = AdaptiveRateLimiter(rate=args.rate_limit,
+                                           max_rate=max(args.rate_limit, args.max_rate))
+        if metrics is not None:
+            metrics.rate_limiter = rate_limiter
+
+    # Scan several accounts when profiles or role ARNs are given.
+    if args.profiles or args.role_arns:
+        targets = [{"profile": profile} for profile in args.profiles]
+        targets.extend({"profile": args.profile, "role_arn": role_arn}
+                       for role_arn in args.role_arns)
+        print(emoji.emojize(":arrow_right:  Accounts: {}", language='alias').format(
+            len(targets)))
+        scan_accounts(
+            targets,
+            output=args.output,
+            region=args.region,
+            account_workers=args.account_workers,
+            account_pool=args.account_pool,
+            include_non_default_policy_versions=args.include_non_default_policy_versions,
+            include_unattached=args.include_unattached,
+            flatten_json=args.flatten,
+            json_only=args.json_only,
+            checkpoint=args.checkpoint,
+            collection_strategy=args.collection_strategy,
+            max_workers=args.max_workers,
+            output_format=args.output_format,
+            compression=args.compression,
+            backends=args.backends,
+            dataset=args.dataset,
+            since=args.since,
+            policy_cache=args.policy_cache,
+            policy_cache_max_bytes=args.policy_cache_max_mb * 1024 * 1024,
+            metrics=metrics,
+            rate_limiter=rate_limiter,
+            permission_index=args.permission_index,
+            expand_actions=args.expand_actions,
+            action_catalog=args.action_catalog,
+            compact=args.compact,
+            normalize_workers=args.normalize_workers,
+            normalize_chunk_size=args.normalize_chunk_size)
+        _print_rate_limiter(rate_limiter)
+        print(emoji.emojize(":checkered_flag:  Done!", language='alias'))
+        print('-' * get_terminal_size()[0])
+        return
+
     # Get account authorization details.
     account_authorization_details = get_account_authorization_details(
         region=args.region,
@@ -486,7 +5319,27 @@ def main():
         include_unattached=args.include_unattached,
         output=args.output,
         open_in_excel=args.open_in_excel,
-        flatten_json=args.flatten)
+        flatten_json=args.flatten,
+        json_only=args.json_only,
+        checkpoint=args.checkpoint,
+        collection_strategy=args.collection_strategy,
+        max_workers=args.max_workers,
+        output_format=args.output_format,
+        compression=args.compression,
+        backends=args.backends,
+        dataset=args.dataset,
+        since=args.since,
+        policy_cache=args.policy_cache,
+        policy_cache_max_bytes=args.policy_cache_max_mb * 1024 * 1024,
+        metrics=metrics,
+        rate_limiter=rate_limiter,
+        permission_index=args.permission_index,
+        expand_actions=args.expand_actions,
+        action_catalog=args.action_catalog,
+        compact=args.compact,
+        normalize_workers=args.normalize_workers,
+        normalize_chunk_size=args.normalize_chunk_size)
+    _print_rate_limiter(rate_limiter)
 
     # Let the user know that the script is done.
     print(emoji.emojize(":checkered_flag:  Done!", language='alias'))
@@ -0,0 +1,82 @@
+import os as os
+import sys as sys
+
+# The report and the benchmark are scripts, not a package: import them from the repository root.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import boto3 as boto3
+import pytest as pytest
+
+import benchmarkAccountAuthorizationDetailReport as benchmark
+import generateAccountAuthorizationDetailReport as report
+
+
+class InterruptedIamEndpoint(benchmark.FakeIamEndpoint):
+    """
+    Serve a SyntheticAccount, then fail every call past the first ones like a dropped connection.
+    """
+
+    def __init__(self, account, served_calls):
+        super().__init__(account)
+        self.served_calls = served_calls
+
+    def _before_call(self, model, context, **kwargs):
+        with self._lock:
+            if sum(self.calls.values()) >= self.served_calls:
+                raise ConnectionError("The connection to IAM dropped")
+        return super()._before_call(model, context, **kwargs)
+
+
+@pytest.fixture
+def iam_client():
+    """
+    Build an IAM client served by a fake endpoint, from a SyntheticAccount or an endpoint.
+    """
+    def build(endpoint):
+        if isinstance(endpoint, benchmark.SyntheticAccount):
+            endpoint = benchmark.FakeIamEndpoint(endpoint)
+        return endpoint.attach(boto3.client("iam",
+                                            region_name="us-east-1",
+                                            aws_access_key_id="test",
+                                            aws_secret_access_key="test"))
+    return build
+
+
+# The AWS managed policy of cached_report, its document is kept in the policy cache.
+POLICY_ARN = "arn:aws:iam::aws:policy/ReadOnly"
+DOCUMENT = {
+    "Version": "2012-10-17",
+    "Statement": [{"Effect": "Allow", "Action": "s3:GetObject", "Resource": "*"}],
+}
+
+
+@pytest.fixture
+def cached_report(tmp_path):
+    """
+    Save a report whose AWS managed policy references its document in a policy cache.
+
+    :return: A tuple of the report path, the PolicyDocumentCache and the document hash.
+    """
+    cache = report.PolicyDocumentCache(str(tmp_path / "cache"))
+    policy = cache.reference_documents({
+        "PolicyName": "ReadOnly",
+        "PolicyId": "ANPA0000000000000001",
+        "Arn": POLICY_ARN,
+        "DefaultVersionId": "v1",
+        "PolicyVersionList": [{"VersionId": "v1", "IsDefaultVersion": True, "Document": DOCUMENT}],
+    })
+    results = {
+        "UserDetailList": [],
+        "GroupDetailList": [],
+        "RoleDetailList": [{
+            "RoleName": "reader",
+            "RoleId": "AROA0000000000000001",
+            "Arn": "arn:aws:iam::111111111111:role/reader",
+            "RolePolicyList": [],
+            "AttachedManagedPolicies": [{"PolicyName": "ReadOnly", "PolicyArn": POLICY_ARN}],
+        }],
+        "Policies": [policy],
+    }
+    report_path = str(tmp_path / "report.json")
+    report.write_json_report(results, report_path)
+    return report_path, cache, policy["PolicyVersionList"][0]["DocumentHash"]
@@ -0,0 +1,84 @@
+import json as json
+
+import generateAccountAuthorizationDetailReport as report
+
+
+def test_services_are_keyed_by_iam_prefix():
+    catalog = report.build_action_catalog()
+    assert "GetMetricData" in catalog["Services"]["cloudwatch"]
+    assert "ListThings" in catalog["Services"]["iot"]
+    assert "monitoring" not in catalog["Services"]
+
+
+def test_expands_cloudwatch_wildcards():
+    expander = report.ActionExpander(report.build_action_catalog())
+    actions = expander.expand("cloudwatch:Get*")
+    assert {"cloudwatch:getmetricdata", "cloudwatch:getmetricstatistics", "cloudwatch:getdashboard"} <= actions
+    assert all(action.startswith("cloudwatch:get") for action in actions)
+
+
+def test_stale_catalog_is_rebuilt(tmp_path):
+    path = tmp_path / "catalog.json"
+    path.write_text(json.dumps({
+        "Version": "botocore-0.0.0",
+        "Source": "botocore",
+        "Services": {"monitoring": ["GetMetricData"]},
+    }))
+    catalog = report.load_action_catalog(str(path))
+    assert catalog["Version"] == report._action_catalog_version()
+    assert "cloudwatch" in catalog["Services"]
+    with open(path) as f:
+        assert json.load(f)["Version"] == catalog["Version"]
+
+
+CATALOG = {
+    "Version": "test",
+    "Services": {
+        "s3": ["GetObject", "GetBucketPolicy", "PutObject", "ListBucket"],
+        "ec2": ["DescribeInstances", "RunInstances"],
+    },
+}
+
+
+def test_patterns_expand_case_insensitively_and_are_memoized():
+    expander = report.ActionExpander(CATALOG)
+    assert expander.expand("S3:Get*") == {"s3:getobject", "s3:getbucketpolicy"}
+    assert expander.expand("s3:?utObject") == {"s3:putobject"}
+    assert expander.expand("*:*Instances") == {"ec2:describeinstances", "ec2:runinstances"}
+    assert expander.expand("iam:Get*") == frozenset()
+    expander.expand("s3:get*")
+    assert expander.cache_info()["Hits"] == 1
+
+
+def test_documents_expand_not_action_and_literal_actions():
+    expander = report.ActionExpander(CATALOG)
+    allow, deny, literal = expander.expand_documents([
+        {"Statement": {"Effect": "Allow", "NotAction": ["s3:*", "ec2:Run*"]}},
+        {"Statement": [{"Effect": "Deny", "Action": "s3:Put*"}]},
+        {"Statement": [{"Effect": "Allow", "Action": ["sqs:SendMessage"]},
+                       {"Effect": "Allow", "Action": "sqs:*"}]},
+    ])
+    # The literal sqs action the catalog misses is added to it, so sqs:* matches it too.
+    assert allow == {"Allow": {"ec2:describeinstances", "sqs:sendmessage"}, "Deny": frozenset()}
+    assert deny == {"Allow": frozenset(), "Deny": {"s3:putobject"}}
+    assert literal["Allow"] == {"sqs:sendmessage"}
+
+
+def test_expanded_action_sets_are_deduplicated(tmp_path):
+    document = {"Statement": [{"Effect": "Allow", "Action": "s3:Get*"}]}
+    results = {key: [] for key in report.ENTITY_KEYS}
+    results["RoleDetailList"] = [
+        {"RoleName": name, "Arn": f"arn:aws:iam::111111111111:role/{name}",
+         "RolePolicyList": [{"PolicyName": "read", "PolicyDocument": document}]}
+        for name in ("a", "b")
+    ]
+    destination = str(tmp_path / "report.actions.json")
+    # The Allow set of both policies and their empty Deny set.
+    assert report.export_expanded_actions(results, destination, report.ActionExpander(CATALOG)) == {
+        "policies": 2, "action_sets": 2, "unresolved": 0}
+    with open(destination) as f:
+        expanded = json.load(f)
+    [allow, deny] = [[policy[effect] for policy in expanded["Policies"]] for effect in ("Allow", "Deny")]
+    assert allow[0] == allow[1] and deny[0] == deny[1]
+    assert expanded["ActionSets"][allow[0]] == ["s3:getbucketpolicy", "s3:getobject"]
+    assert expanded["ActionSets"][deny[0]] == []
@@ -0,0 +1,41 @@
+import os as os
+
+import pytest as pytest
+
+import benchmarkAccountAuthorizationDetailReport as benchmark
+import generateAccountAuthorizationDetailReport as report
+from conftest import InterruptedIamEndpoint
+
+
+def _collect(iam_client, output, **kwargs):
+    return report.get_account_authorization_details(
+        "test", str(output), "us-east-1", json_only=True, iam_client=iam_client, **kwargs)
+
+
+@pytest.mark.parametrize("collection_strategy", report.COLLECTION_STRATEGIES)
+def test_interrupted_collection_resumes_from_its_checkpoint(tmp_path, iam_client, collection_strategy):
+    account = benchmark.SyntheticAccount(450, seed=0)
+    full = benchmark.FakeIamEndpoint(account)
+    _collect(iam_client(full), tmp_path / "full.json", collection_strategy=collection_strategy)
+
+    output = tmp_path / "report.json"
+    checkpoint_path = report.checkpoint_output_path(str(output))
+    with pytest.raises(ConnectionError):
+        _collect(iam_client(InterruptedIamEndpoint(account, served_calls=4)), output,
+                 collection_strategy=collection_strategy, checkpoint=True)
+    assert os.path.exists(checkpoint_path)
+
+    resumed = benchmark.FakeIamEndpoint(account)
+    _collect(iam_client(resumed), output, collection_strategy=collection_strategy, checkpoint=True)
+    # The saved pages are replayed, not collected again.
+    assert sum(resumed.calls.values()) < sum(full.calls.values())
+    assert report.load_report(str(output)) == report.load_report(str(tmp_path / "full.json"))
+    assert not os.path.exists(checkpoint_path)
+
+
+def test_checkpoint_of_other_options_is_discarded(tmp_path):
+    path = str(tmp_path / "report.checkpoint.jsonl")
+    checkpoint = report.CollectionCheckpoint(path, {"include_unattached": False})
+    checkpoint.save_page("User", {"UserDetailList": [{"UserName": "a"}]}, "marker")
+    assert report.CollectionCheckpoint(path, {"include_unattached": False}).resumed
+    assert not report.CollectionCheckpoint(path, {"include_unattached": True}).resumed
@@ -0,0 +1,26 @@
+import benchmarkAccountAuthorizationDetailReport as benchmark
+import generateAccountAuthorizationDetailReport as report
+
+
+def test_concurrent_and_single_pass_collections_are_the_same_report(iam_client):
+    account = benchmark.SyntheticAccount(250, seed=0)
+    concurrent, concurrent_stats = report.collect_account_authorization_details(
+        iam_client(account), strategy="concurrent")
+    single_pass, single_pass_stats = report.collect_account_authorization_details(
+        iam_client(account), strategy="single-pass")
+    assert concurrent == single_pass
+    assert sorted(concurrent_stats) == sorted(report.COLLECTION_FILTERS)
+    assert list(single_pass_stats) == ["All"]
+    assert sum(stats["records"] for stats in concurrent_stats.values()) == sum(
+        len(entities) for entities in concurrent.values())
+    # Customer managed policies before the AWS managed ones, as IAM returns them.
+    aws_managed = [report._is_aws_managed_policy(policy) for policy in concurrent["Policies"]]
+    assert aws_managed == sorted(aws_managed)
+
+
+def test_unattached_policies_are_dropped_unless_asked(iam_client):
+    account = benchmark.SyntheticAccount(100, seed=0)
+    attached, _ = report.collect_account_authorization_details(iam_client(account))
+    every, _ = report.collect_account_authorization_details(iam_client(account), include_unattached=True)
+    assert all(policy["AttachmentCount"] > 0 for policy in attached["Policies"])
+    assert len(every["Policies"]) > len(attached["Policies"])
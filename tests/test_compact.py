@@ -0,0 +1,60 @@
+import json as json
+
+import pytest as pytest
+
+import benchmarkAccountAuthorizationDetailReport as benchmark
+import generateAccountAuthorizationDetailReport as report
+
+
+def _results():
+    """
+    Build the report lists of a synthetic account, with dates and decoded policy documents.
+    """
+    account = benchmark.SyntheticAccount(100, seed=0)
+    results = {key: [] for key in report.ENTITY_KEYS}
+    for filter_name in report.COLLECTION_FILTERS:
+        for list_name, entity in account.entities(filter_name, encode=False):
+            results[list_name].append(entity)
+    results["Policies"].sort(key=report._is_aws_managed_policy)
+    return results
+
+
+def test_compact_report_round_trips():
+    results = _results()
+    compact = report.CompactReport()
+    for list_name, entities in results.items():
+        compact.add_page({list_name: entities})
+    compact.finish()
+    assert compact.to_results() == results
+    assert compact["RoleDetailList"][5] == results["RoleDetailList"][5]
+    assert compact["RoleDetailList"][2:4] == results["RoleDetailList"][2:4]
+    # Every access gets its own copy of a shared document.
+    compact["RoleDetailList"][0]["AssumeRolePolicyDocument"]["Statement"].clear()
+    assert compact["RoleDetailList"][0] == results["RoleDetailList"][0]
+    assert compact.stats()["entities"] == sum(len(entities) for entities in results.values())
+
+
+def test_compact_json_report_is_the_json_report(tmp_path):
+    results = _results()
+    compact = report.results_from_records(
+        [report.EntityRecord.from_entity(list_name, entity)
+         for list_name, entities in results.items() for entity in entities], compact=True)
+    report.write_json_report(compact, str(tmp_path / "compact.json"))
+    with open(tmp_path / "plain.json", 'w') as f:
+        json.dump(results, f, indent=4, default=str)
+    assert (tmp_path / "compact.json").read_bytes() == (tmp_path / "plain.json").read_bytes()
+
+
+@pytest.mark.parametrize("output_format", ["json", "jsonl"])
+def test_compact_load_is_the_plain_load(tmp_path, output_format):
+    results = _results()
+    path = str(tmp_path / "report.json")
+    if output_format == "json":
+        report.write_json_report(results, path)
+    else:
+        path = str(tmp_path / "report.jsonl")
+        with report.StreamingReportWriter(path, output_format=output_format) as writer:
+            writer.write_page(results)
+    loaded = report.load_report(path, compact=True)
+    assert isinstance(loaded, report.CompactReport)
+    assert loaded.to_results() == report.load_report(path)
@@ -0,0 +1,37 @@
+import json
+
+import benchmarkAccountAuthorizationDetailReport as benchmark
+import generateAccountAuthorizationDetailReport as report
+
+
+def test_report_stages_and_api_calls_are_measured(tmp_path, iam_client):
+    endpoint = benchmark.FakeIamEndpoint(benchmark.SyntheticAccount(50, seed=0))
+    metrics = report.RunMetrics()
+    result = report.get_account_authorization_details(
+        "test", str(tmp_path / "report.json"), "us-east-1", json_only=True,
+        iam_client=iam_client(endpoint), metrics=metrics, permission_index=True)
+
+    metrics_path = str(tmp_path / "metrics.json")
+    metrics.write(metrics_path)
+    with open(metrics_path) as f:
+        document = json.load(f)
+
+    assert {"collect", "write_json", "permission_index"} <= set(document["Stages"])
+    collect = document["Stages"]["collect"]
+    assert collect["runs"] == 1
+    assert collect["rows"] == sum(result["records"].values())
+    assert collect["seconds"] >= 0
+    # Every call the endpoint served was counted by the instrumented client.
+    assert document["Api"]["Calls"] == endpoint.calls
+    assert document["Api"]["TotalCalls"] == sum(endpoint.calls.values())
+    assert (document["Api"]["Retries"], document["Api"]["Throttles"]) == (0, 0)
+    assert sorted(document["Collection"]["test"]) == sorted(report.COLLECTION_FILTERS)
+
+
+def test_repeated_stages_accumulate():
+    metrics = report.RunMetrics()
+    for rows in (3, None, 4):
+        with metrics.stage("excel.write_sheets") as stage:
+            stage["rows"] = rows
+    stage = metrics.document()["Stages"]["excel.write_sheets"]
+    assert (stage["runs"], stage["rows"]) == (3, 7)
@@ -0,0 +1,83 @@
+import openpyxl as openpyxl
+import pytest as pytest
+
+import benchmarkAccountAuthorizationDetailReport as benchmark
+import generateAccountAuthorizationDetailReport as report
+
+
+def _synthetic_results(roles=200):
+    """
+    Build the report lists of a synthetic account, with a run of roles without instance profiles.
+    """
+    account = benchmark.SyntheticAccount(roles, seed=0)
+    results = {key: [] for key in report.ENTITY_KEYS}
+    for filter_name in report.COLLECTION_FILTERS:
+        for list_name, entity in account.entities(filter_name, encode=False):
+            results[list_name].append(entity)
+    # A whole chunk of roles whose lists are all empty.
+    for role in results["RoleDetailList"][:60]:
+        role["InstanceProfileList"] = []
+    return results
+
+
+def _workbook(path):
+    workbook = openpyxl.load_workbook(path, read_only=True)
+    return [(sheet.title, [list(row) for row in sheet.iter_rows(values_only=True)])
+            for sheet in workbook.worksheets]
+
+
+@pytest.mark.parametrize("flatten_json", [False, True])
+@pytest.mark.parametrize("max_workers", [1, 2])
+def test_chunked_workbook_is_the_single_chunk_workbook(tmp_path, flatten_json, max_workers):
+    results = _synthetic_results()
+    single = tmp_path / "single.xlsx"
+    chunked = tmp_path / "chunked.xlsx"
+    report.export_excel_report(results, str(single), flatten_json=flatten_json,
+                               max_workers=1, chunk_size=10 ** 9)
+    report.export_excel_report(results, str(chunked), flatten_json=flatten_json,
+                               max_workers=max_workers, chunk_size=37)
+    assert _workbook(chunked) == _workbook(single)
+
+
+@pytest.mark.parametrize("output_format", ["jsonl", "json-stream"])
+def test_streamed_report_workbook_is_the_loaded_report_workbook(tmp_path, output_format):
+    results = _synthetic_results()
+    path = str(tmp_path / "report.jsonl")
+    # Interleave the lists, as the pages of the collection filters arrive.
+    with report.StreamingReportWriter(path, output_format=output_format) as writer:
+        for position in range(max(len(entities) for entities in results.values())):
+            writer.write_page({list_name: entities[position:position + 1]
+                               for list_name, entities in results.items()})
+    loaded = tmp_path / "loaded.xlsx"
+    streamed = tmp_path / "streamed.xlsx"
+    report.export_excel_report(report.load_report(path), str(loaded), flatten_json=True,
+                               max_workers=1, chunk_size=37)
+    report.export_excel_report(None, str(streamed), flatten_json=True,
+                               max_workers=1, chunk_size=37, report_path=path)
+    assert _workbook(streamed) == _workbook(loaded)
+
+
+def test_small_report_is_normalized_without_worker_processes(monkeypatch):
+    def no_pool(*args, **kwargs):
+        raise AssertionError("A small report started worker processes")
+
+    monkeypatch.setattr(report, "ProcessPoolExecutor", no_pool)
+    results = _synthetic_results(roles=20)
+    tables = report.normalize_tables(results, max_workers=4, chunk_size=100)
+    assert sum(len(part) for part in tables["RoleDetailList"]) == 20
+
+
+def test_long_tables_roll_over_to_new_sheets(tmp_path):
+    results = _synthetic_results(roles=45)
+    path = tmp_path / "report.xlsx"
+    rows = report.export_excel_report(results, str(path), max_workers=1, max_rows_per_sheet=11)
+    assert rows["RoleDetailList"] == 45
+    sheets = dict(_workbook(path))
+    role_sheets = [title for title in sheets if title.startswith("RoleDetailList")]
+    # 10 rows and the header per sheet, every sheet repeats the header.
+    assert len(role_sheets) == 5
+    assert [len(sheets[title]) for title in role_sheets] == [11, 11, 11, 11, 6]
+    assert all(sheets[title][0] == sheets[role_sheets[0]][0] for title in role_sheets)
+    column = sheets[role_sheets[0]][0].index("RoleName")
+    assert [row[column] for title in role_sheets for row in sheets[title][1:]] == [
+        role["RoleName"] for role in results["RoleDetailList"]]
@@ -0,0 +1,49 @@
+import json as json
+import os as os
+
+import generateAccountAuthorizationDetailReport as report
+from conftest import POLICY_ARN
+
+
+def test_cached_document_is_indexed(cached_report):
+    report_path, cache, _ = cached_report
+    report.convert_saved_report(report_path, json_only=True, permission_index=True,
+                                policy_cache=cache.directory)
+    answer = report.query_action(report.permission_index_path(report_path), "s3:GetObject")
+    assert [principal["Arn"] for principal in answer["allowed"]] == ["arn:aws:iam::111111111111:role/reader"]
+
+
+def test_evicted_document_is_unresolved(tmp_path, cached_report):
+    report_path, cache, document_hash = cached_report
+    os.remove(cache._document_path(document_hash))
+
+    report.convert_saved_report(report_path, json_only=True, permission_index=True,
+                                policy_cache=cache.directory)
+    answer = report.query_action(report.permission_index_path(report_path), "s3:GetObject")
+    assert answer["allowed"] == []
+
+    expanded = report.export_expanded_actions(report.load_report(report_path),
+                                              str(tmp_path / "actions.json"),
+                                              report.ActionExpander({"Services": {"s3": ["GetObject"]}}),
+                                              report.PolicyDocumentCache(cache.directory))
+    assert expanded["unresolved"] == 1
+    with open(tmp_path / "actions.json") as f:
+        assert json.load(f)["Policies"] == [{"Type": "managed", "PolicyArn": POLICY_ARN, "Unresolved": True}]
+
+
+def test_principal_without_policies_is_indexed(tmp_path):
+    results = {key: [] for key in report.ENTITY_KEYS}
+    results["UserDetailList"].append({
+        "UserName": "idle",
+        "UserId": "AIDA0000000000000001",
+        "Arn": "arn:aws:iam::111111111111:user/idle",
+        "UserPolicyList": [],
+        "AttachedManagedPolicies": [],
+        "GroupList": [],
+    })
+    index_path = str(tmp_path / "report.permissions.sqlite")
+    assert report.build_permission_index(results, index_path)["principals"] == 1
+    assert report.query_principal(index_path, "idle") == [{
+        "Type": "User", "Name": "idle", "Arn": "arn:aws:iam::111111111111:user/idle",
+        "Allow": [], "Deny": [],
+    }]
@@ -0,0 +1,51 @@
+import benchmarkAccountAuthorizationDetailReport as benchmark
+import generateAccountAuthorizationDetailReport as report
+
+
+def _documents(results, policy_cache=None):
+    # The default version document of every AWS managed policy, resolved through the cache.
+    documents = {}
+    for policy in results["Policies"]:
+        if not report._is_aws_managed_policy(policy):
+            continue
+        for version in policy["PolicyVersionList"]:
+            if version.get("IsDefaultVersion"):
+                documents[policy["Arn"]] = (version["Document"] if "Document" in version
+                                            else policy_cache.resolve(policy["Arn"], version))
+    return documents
+
+
+def test_second_collection_reads_the_documents_from_the_cache(tmp_path, iam_client):
+    account = benchmark.SyntheticAccount(100, seed=0)
+    cache = report.PolicyDocumentCache(str(tmp_path / "cache"))
+    uncached, _ = report.collect_account_authorization_details(iam_client(account))
+
+    report.collect_account_authorization_details(iam_client(account), policy_cache=cache)
+    endpoint = benchmark.FakeIamEndpoint(account)
+    cached, stats = report.collect_account_authorization_details(iam_client(endpoint), policy_cache=cache)
+
+    assert endpoint.calls.get("GetPolicyVersion", 0) == 0
+    assert stats["AWSManagedPolicy"]["cache_hits"] == stats["AWSManagedPolicy"]["records"] > 0
+    aws_managed = [policy for policy in cached["Policies"] if report._is_aws_managed_policy(policy)]
+    assert all("Document" not in version and "DocumentHash" in version
+               for policy in aws_managed for version in policy["PolicyVersionList"])
+    assert _documents(cached, cache) == _documents(uncached) != {}
+
+
+def test_identical_documents_are_stored_once(tmp_path):
+    cache = report.PolicyDocumentCache(str(tmp_path / "cache"))
+    document = {"Version": "2012-10-17", "Statement": []}
+    first = cache.put("arn:aws:iam::aws:policy/First", "v1", document)
+    second = cache.put("arn:aws:iam::aws:policy/Second", "v3", dict(document))
+    assert first == second
+    assert cache.lookup("arn:aws:iam::aws:policy/Second", "v3")["Hash"] == first
+    assert cache.lookup("arn:aws:iam::aws:policy/Second", "v1") is None
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert cache.get(first) == document
+
+
+def test_eviction_turns_the_oldest_documents_into_misses(tmp_path):
+    cache = report.PolicyDocumentCache(str(tmp_path / "cache"), max_bytes=0)
+    cache.put("arn:aws:iam::aws:policy/Old", "v1", {"Statement": ["old"]})
+    assert cache.evict() == 1
+    assert cache.lookup("arn:aws:iam::aws:policy/Old", "v1") is None
@@ -0,0 +1,75 @@
+import boto3 as boto3
+import pytest as pytest
+from botocore.awsrequest import AWSResponse
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+import generateAccountAuthorizationDetailReport as report
+
+
+class _Body:
+    def __init__(self, body):
+        self._body = body
+
+    def stream(self, **kwargs):
+        yield self._body
+
+
+def _client(status, code, max_attempts=3):
+    """
+    Create an IAM client whose every call fails with the given error, without any network.
+    """
+    client = boto3.client("iam",
+                          region_name="us-east-1",
+                          aws_access_key_id="test",
+                          aws_secret_access_key="test",
+                          config=Config(retries={"max_attempts": max_attempts, "mode": "legacy"}))
+    body = (f"<ErrorResponse><Error><Type>Sender</Type><Code>{code}</Code><Message>test</Message></Error>"
+            "<RequestId>1</RequestId></ErrorResponse>").encode('utf-8')
+    client.meta.events.register(
+        "before-send.iam", lambda request, **kwargs: AWSResponse(request.url, status, {}, _Body(body)))
+    return client
+
+
+def test_only_retries_acquire_a_token():
+    limiter = report.AdaptiveRateLimiter(rate=1000, max_rate=1000)
+    client = limiter.attach(_client(400, "Throttling", max_attempts=3))
+    sent = []
+    client.meta.events.register_first("before-send.iam", lambda **kwargs: sent.append(1))
+    with pytest.raises(ClientError):
+        client.list_users()
+    # One token per request sent, none after the final throttled attempt that is not retried.
+    assert len(sent) == 4
+    assert limiter.calls == len(sent)
+    assert limiter.throttles == len(sent)
+    assert limiter.rate < 1000
+
+
+def test_errors_do_not_raise_the_rate():
+    limiter = report.AdaptiveRateLimiter(rate=10, max_rate=50)
+    client = limiter.attach(_client(404, "NoSuchEntity"))
+    with pytest.raises(ClientError):
+        client.get_user(UserName="missing")
+    assert limiter.calls == 1
+    assert limiter.rate == 10
+    assert limiter.highest_rate == 10
+
+
+def test_accounts_get_their_own_limiter():
+    template = report.AdaptiveRateLimiter(rate=10, max_rate=20)
+    first = template.for_account()
+    second = template.for_account()
+    first.on_throttle()
+    assert first.rate == 5
+    assert second.rate == 10 and template.rate == 10
+
+    first.acquire()
+    second.acquire()
+    second.acquire()
+    template.record_accounts({"first": first.document(), "second": second.document()}, 2.0)
+    document = template.document()
+    assert document["Calls"] == 3
+    assert document["Throttles"] == 1
+    assert document["CallsPerSecond"] == 1.5
+    assert document["LowestRate"] == 5
+    assert set(document["Accounts"]) == {"first", "second"}
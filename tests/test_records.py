@@ -0,0 +1,41 @@
+import json as json
+
+import benchmarkAccountAuthorizationDetailReport as benchmark
+import generateAccountAuthorizationDetailReport as report
+
+
+def _interleaved_records():
+    """
+    Build the records of a synthetic account, the AWS managed policies arriving first.
+    """
+    account = benchmark.SyntheticAccount(50, seed=0)
+    records = [report.EntityRecord.from_entity(list_name, entity)
+               for filter_name in report.COLLECTION_FILTERS
+               for list_name, entity in account.entities(filter_name, encode=False)]
+    # Concurrent filters: the pages of the AWS managed policies before the local ones.
+    records.sort(key=lambda record: (record.list_name != "Policies",
+                                     not report._is_aws_managed_policy(record.entity)))
+    return records
+
+
+def test_compact_and_plain_results_have_the_same_order():
+    records = _interleaved_records()
+    policies = [record.entity for record in records if record.list_name == "Policies"]
+    assert report._is_aws_managed_policy(policies[0])
+    assert not report._is_aws_managed_policy(policies[-1])
+
+    results = report.results_from_records(records)
+    assert results == report.results_from_records(records, compact=True).to_results()
+    assert [report._is_aws_managed_policy(policy) for policy in results["Policies"]] == sorted(
+        report._is_aws_managed_policy(policy) for policy in policies)
+
+
+def test_report_is_the_gathered_record_stream(tmp_path, iam_client):
+    account = benchmark.SyntheticAccount(50, seed=0)
+    output = str(tmp_path / "report.json")
+    result = report.get_account_authorization_details(
+        "test", output, "us-east-1", json_only=True, iam_client=iam_client(account))
+    records = report.iter_account_authorization_details(iam_client=iam_client(account))
+    assert report.load_report(output) == json.loads(json.dumps(
+        report.results_from_records(records), default=str))
+    assert sorted(result["collection"]) == sorted(report.COLLECTION_FILTERS)
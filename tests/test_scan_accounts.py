@@ -0,0 +1,33 @@
+import json as json
+import os as os
+
+import benchmarkAccountAuthorizationDetailReport as benchmark
+import generateAccountAuthorizationDetailReport as report
+
+
+def test_every_account_gets_its_report_and_index_entry(tmp_path, monkeypatch, iam_client):
+    accounts = {"dev": benchmark.SyntheticAccount(30, seed=1), "prod": benchmark.SyntheticAccount(40, seed=2)}
+
+    def create_iam_client(profile, region, role_arn=None):
+        if profile not in accounts:
+            raise ValueError(f"The config profile ({profile}) could not be found")
+        return iam_client(accounts[profile])
+
+    monkeypatch.setattr(report, "_create_iam_client", create_iam_client)
+    output = str(tmp_path / "report.json")
+    index = report.scan_accounts(
+        [{"profile": "dev"}, {"profile": "missing"}, {"profile": "prod"}], output, "us-east-1",
+        account_workers=3, json_only=True, rate_limiter=report.AdaptiveRateLimiter(rate=1000))
+
+    assert (index["Succeeded"], index["Failed"]) == (2, 1)
+    assert [entry["profile"] for entry in index["Accounts"]] == ["dev", "missing", "prod"]
+    dev, missing, prod = index["Accounts"]
+    assert missing["status"] == "failed" and "missing" in missing["error"]
+    assert dev["records"]["RoleDetailList"] == 30 and prod["records"]["RoleDetailList"] == 40
+    assert report.load_report(prod["output"])["RoleDetailList"][0]["Arn"] == (
+        accounts["prod"].entity("Role", 0)[1]["Arn"])
+    # Every account is paced by its own limiter, summed up in the index.
+    assert index["RateLimiter"]["Calls"] == sum(
+        entry["rate_limiter"]["Calls"] for entry in (dev, prod))
+    with open(os.path.join(tmp_path, "report-index.json")) as f:
+        assert json.load(f)["Succeeded"] == 2
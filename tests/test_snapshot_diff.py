@@ -0,0 +1,55 @@
+import json as json
+import os as os
+
+import pytest as pytest
+
+import benchmarkAccountAuthorizationDetailReport as benchmark
+import generateAccountAuthorizationDetailReport as report
+from conftest import InterruptedIamEndpoint
+
+
+def _collect(iam_client, output, **kwargs):
+    return report.get_account_authorization_details(
+        "test", str(output), "us-east-1", json_only=True, iam_client=iam_client, **kwargs)
+
+
+def _role(name):
+    return {"RoleName": name, "RoleId": f"AROA{name.upper()}", "Arn": f"arn:aws:iam::111111111111:role/{name}"}
+
+
+def test_delta_lists_the_added_changed_and_removed_entities(tmp_path):
+    previous = str(tmp_path / "previous.snapshot.jsonl")
+    report.write_snapshot([("RoleDetailList", _role("kept")),
+                           ("RoleDetailList", _role("changed")),
+                           ("RoleDetailList", _role("removed"))], previous)
+    delta_path = str(tmp_path / "report.delta.jsonl")
+    snapshot_path = str(tmp_path / "report.snapshot.jsonl")
+    with report.SnapshotDiffWriter(previous, delta_path, snapshot_path) as diff:
+        diff.write_page({"RoleDetailList": [_role("kept"), dict(_role("changed"), Path="/new/"),
+                                            _role("added")]})
+    assert diff.changes == {"added": 1, "changed": 1, "removed": 1, "unchanged": 1}
+    with open(delta_path) as f:
+        changes = [(line["Change"], line["Entity"]["Arn"].rsplit("/", 1)[1]) for line in map(json.loads, f)]
+    assert changes == [("changed", "changed"), ("added", "added"), ("removed", "removed")]
+    assert len(report.load_snapshot_index(snapshot_path)) == 3
+
+
+def test_interrupted_run_keeps_the_previous_snapshot(tmp_path, iam_client):
+    output = tmp_path / "report.json"
+    account = benchmark.SyntheticAccount(60, seed=0)
+    _collect(iam_client(account), output)
+    snapshot_path = report.snapshot_output_path(str(output))
+    with open(snapshot_path, 'rb') as f:
+        snapshot = f.read()
+
+    with pytest.raises(ConnectionError):
+        _collect(iam_client(InterruptedIamEndpoint(account, served_calls=2)), output,
+                 since=str(output))
+    with open(snapshot_path, 'rb') as f:
+        assert f.read() == snapshot
+    assert sorted(os.listdir(tmp_path)) == ["report.json", "report.snapshot.jsonl"]
+
+    # The next run diffs against the untouched snapshot: nothing was added or removed.
+    result = _collect(iam_client(account), output, since=str(output))
+    assert result["changes"] == {"added": 0, "changed": 0, "removed": 0,
+                                 "unchanged": sum(result["records"].values())}
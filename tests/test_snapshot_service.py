@@ -0,0 +1,138 @@
+import json as json
+import os as os
+import threading as threading
+import urllib.error as urllib_error
+import urllib.parse as urllib_parse
+import urllib.request as urllib_request
+from concurrent.futures import ThreadPoolExecutor as ThreadPoolExecutor
+
+import pytest as pytest
+
+import benchmarkAccountAuthorizationDetailReport as benchmark
+import conftest as conftest
+import generateAccountAuthorizationDetailReport as report
+
+
+def _compact_results(roles=20):
+    account = benchmark.SyntheticAccount(roles, seed=0)
+    results = report.CompactReport()
+    for filter_name in report.COLLECTION_FILTERS:
+        for list_name, entity in account.entities(filter_name, encode=False):
+            results.add(list_name, entity)
+    results.finish()
+    return results
+
+
+def test_arn_index_does_not_rebuild_the_entities(monkeypatch):
+    results = _compact_results()
+    role = results["RoleDetailList"][3]
+
+    def no_expand(value):
+        raise AssertionError("The index rebuilt an entity")
+
+    monkeypatch.setattr(results, "_expand", no_expand)
+    snapshot = report.AccountSnapshot(results, 0.0)
+    monkeypatch.undo()
+    assert snapshot.entity("RoleDetailList", role["Arn"]) == role
+    assert snapshot.entity("Policies", role["Arn"]) is None
+
+
+def test_only_small_bodies_are_kept():
+    snapshot = report.AccountSnapshot(_compact_results(), 0.0, max_response_bytes=1024)
+    builds = []
+
+    def build(value):
+        builds.append(value)
+        return value
+
+    small_etag, small = snapshot.response("small", lambda: build("x"))
+    large_etag, large = snapshot.response("large", lambda: build("x" * 4096))
+    assert snapshot.response("small", lambda: build("x")) == (small_etag, small)
+    assert snapshot.response("large", lambda: build("x" * 4096)) == (large_etag, large)
+    assert builds == ["x", "x" * 4096, "x" * 4096]
+    # A client with the ETag gets no body, and the large response is not encoded again.
+    assert snapshot.response("large", lambda: build("x" * 4096), lambda etag: etag == large_etag) == (
+        large_etag, None)
+    assert len(builds) == 3
+
+
+def test_refresh_evicts_the_policy_cache(tmp_path, iam_client):
+    cache = tmp_path / "cache"
+    service = report.SnapshotService([{"profile": "test"}], "us-east-1",
+                                     policy_cache=str(cache), policy_cache_max_bytes=0,
+                                     iam_client=iam_client(benchmark.SyntheticAccount(20, seed=0)))
+    snapshot = service.snapshot("test")
+    assert len(snapshot.results["Policies"]) > 0
+    assert service.policy_cache.misses > 0
+    assert [files for _, _, files in os.walk(cache / "documents") if files] == []
+
+
+@pytest.fixture
+def server(iam_client):
+    """
+    Serve a synthetic account on a free local port.
+
+    :return: A tuple of the SnapshotServer and the fake IAM endpoint of the account.
+    """
+    endpoint = benchmark.FakeIamEndpoint(benchmark.SyntheticAccount(20, seed=0), latency=0.02)
+    service = report.SnapshotService([{"profile": "test"}], "us-east-1", iam_client=iam_client(endpoint))
+    server = report.SnapshotServer(service, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server, endpoint
+    server.shutdown()
+    server.server_close()
+
+
+def _get(server, path, etag=None):
+    request = urllib_request.Request(f"http://127.0.0.1:{server.server_address[1]}{path}")
+    if etag is not None:
+        request.add_header("If-None-Match", etag)
+    try:
+        with urllib_request.urlopen(request) as response:
+            return response.status, response.headers, response.read()
+    except urllib_error.HTTPError as e:
+        return e.code, e.headers, e.read()
+
+
+def test_etag_answers_not_modified(server):
+    server, _ = server
+    status, headers, body = _get(server, "/accounts/test/roles")
+    assert status == 200 and len(json.loads(body)) == 20
+    etag = headers["ETag"]
+    assert _get(server, "/accounts/test/roles", etag)[::2] == (304, b"")
+    assert _get(server, "/accounts/test/roles", "\"other\"")[0] == 200
+
+    arn = json.loads(body)[0]["Arn"]
+    status, _, body = _get(server, "/accounts/test/roles?" + urllib_parse.urlencode({"arn": arn}))
+    assert status == 200 and json.loads(body)["Arn"] == arn
+    assert _get(server, "/accounts/test/users?" + urllib_parse.urlencode({"arn": arn}))[0] == 404
+    assert _get(server, "/accounts/other")[0] == 404
+
+
+def test_concurrent_requests_share_one_refresh(server, iam_client):
+    server, endpoint = server
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        statuses = list(executor.map(lambda _: _get(server, "/accounts/test")[0], range(8)))
+    assert statuses == [200] * 8
+    assert server.service.refreshes == 1
+    # The IAM calls of a single collection, whatever the number of requests.
+    single = benchmark.FakeIamEndpoint(endpoint.account)
+    list(report.iter_account_authorization_details(iam_client=iam_client(single)))
+    assert endpoint.calls == single.calls
+
+
+def test_failed_refresh_serves_the_previous_snapshot(server, iam_client):
+    server, endpoint = server
+    service = server.service
+    status, headers, _ = _get(server, "/accounts/test/groups")
+    service.ttl = 0
+    service.collect_kwargs["iam_client"] = iam_client(
+        conftest.InterruptedIamEndpoint(endpoint.account, served_calls=0))
+    stale_status, stale_headers, _ = _get(server, "/accounts/test/groups")
+    assert (stale_status, stale_headers["ETag"]) == (status, headers["ETag"])
+    assert service.refreshes == 2
+
+    # Without a previous snapshot the failure is a bad gateway.
+    service._snapshots.clear()
+    assert _get(server, "/accounts/test")[0] == 502
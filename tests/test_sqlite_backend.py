@@ -0,0 +1,35 @@
+import json as json
+import sqlite3 as sqlite3
+
+import generateAccountAuthorizationDetailReport as report
+from conftest import DOCUMENT
+from conftest import POLICY_ARN
+
+
+def _policy_versions(path):
+    connection = sqlite3.connect(path)
+    try:
+        return connection.execute(
+            "SELECT policy_arn, version_id, document, document_hash FROM policy_versions").fetchall()
+    finally:
+        connection.close()
+
+
+def test_cached_document_is_resolved(tmp_path, cached_report):
+    report_path, cache, document_hash = cached_report
+    report.convert_saved_report(report_path, json_only=True, backends=["sqlite"],
+                                policy_cache=cache.directory)
+    [(arn, version_id, document, stored_hash)] = _policy_versions(str(tmp_path / "report.sqlite"))
+    assert (arn, version_id, stored_hash) == (POLICY_ARN, "v1", document_hash)
+    assert json.loads(document) == DOCUMENT
+
+
+def test_document_hash_is_kept_without_the_cache(tmp_path, cached_report):
+    report_path, _, document_hash = cached_report
+    destination = str(tmp_path / "report.sqlite")
+    # A database written before the policy versions kept their document hash.
+    connection = sqlite3.connect(destination)
+    connection.executescript(report.SQLITE_SCHEMA.replace("    document_hash TEXT,\n", ""))
+    connection.close()
+    report.export_sqlite_database(report.load_report(report_path), destination, "111111111111")
+    assert _policy_versions(destination) == [(POLICY_ARN, "v1", None, document_hash)]
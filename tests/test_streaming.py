@@ -0,0 +1,52 @@
+import gzip as gzip
+import json as json
+
+import pytest as pytest
+
+import benchmarkAccountAuthorizationDetailReport as benchmark
+import generateAccountAuthorizationDetailReport as report
+
+
+def _by_arn(results):
+    # The streamed formats keep the page arrival order, compare the lists as sets of entities.
+    return {list_name: sorted(entities, key=lambda entity: entity["Arn"])
+            for list_name, entities in results.items()}
+
+
+@pytest.fixture
+def json_report(tmp_path, iam_client):
+    output = str(tmp_path / "full.json")
+    report.get_account_authorization_details(
+        "test", output, "us-east-1", json_only=True,
+        iam_client=iam_client(benchmark.SyntheticAccount(120, seed=0)))
+    return report.load_report(output)
+
+
+@pytest.mark.parametrize("output_format", ["jsonl", "json-stream"])
+@pytest.mark.parametrize("compression", ["none", "gzip", "zstd"])
+def test_streamed_report_holds_the_json_report(tmp_path, iam_client, json_report, output_format, compression):
+    if compression == "zstd":
+        pytest.importorskip("zstandard")
+    output = str(tmp_path / "report.json")
+    result = report.get_account_authorization_details(
+        "test", output, "us-east-1", json_only=True, output_format=output_format,
+        compression=compression, iam_client=iam_client(benchmark.SyntheticAccount(120, seed=0)))
+    assert result["output"] == report.stream_output_path(output, output_format, compression)
+    assert result["output"].endswith(report.OUTPUT_COMPRESSIONS[compression])
+    assert result["records"] == {key: len(entities) for key, entities in json_report.items()}
+    assert _by_arn(report.load_report(result["output"])) == _by_arn(json_report)
+
+
+def test_json_stream_report_is_a_json_array(tmp_path):
+    path = str(tmp_path / "report.json.gz")
+    with report.StreamingReportWriter(path, output_format="json-stream", compression="gzip") as writer:
+        writer.write_page({"RoleDetailList": [{"RoleName": "a"}, {"RoleName": "b"}], "Policies": []})
+        writer.write_page({"UserDetailList": [{"UserName": "c"}]})
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        assert json.load(f) == [
+            {"List": "RoleDetailList", "Entity": {"RoleName": "a"}},
+            {"List": "RoleDetailList", "Entity": {"RoleName": "b"}},
+            {"List": "UserDetailList", "Entity": {"UserName": "c"}},
+        ]
+    assert writer.counts["RoleDetailList"] == 2
+    assert list(report.iter_report_entities(path, "UserDetailList")) == [("UserDetailList", {"UserName": "c"})]